@@ -21,7 +21,10 @@ from amivapi.auth.link_methods import (
     add_permitted_methods_after_update,
     add_permitted_methods_for_home
 )
+from amivapi.auth.passwords import init_password_hasher
+from amivapi.auth.session_cache import init_session_cache
 from amivapi.auth.sessions import process_login, sessiondomain
+from amivapi.auth.timestamps import init_timestamp_buffer
 from amivapi.utils import register_domain
 
 
@@ -33,6 +36,9 @@ def init_app(app):
     # Sessions
     register_domain(app, sessiondomain)
     app.on_insert_sessions += process_login
+    init_session_cache(app)
+    init_timestamp_buffer(app)
+    init_password_hasher(app)
 
     # on_pre_METHOD, triggered right after auth by Eve
     for method in ['GET', 'POST', 'PATCH', 'DELETE']:
@@ -60,8 +66,8 @@ def init_app(app):
     app.on_inserted += add_permitted_methods_after_insert
     app.on_fetched_item += add_permitted_methods_after_fetch_item
     app.on_fetched_resource += add_permitted_methods_after_fetch_resource
-    app.on_post_GET += add_permitted_methods_for_home
-    app.on_post_PATCH += add_permitted_methods_after_update
+    app.on_render_GET += add_permitted_methods_for_home
+    app.on_render_PATCH += add_permitted_methods_after_update
 
     # Add apikey authorization
     apikeys.init_apikeys(app)
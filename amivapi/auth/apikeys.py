@@ -10,11 +10,13 @@ Provides the apikey resource and hooks to handle authorization with a key.
 API keys should only be created or modified by admins.
 """
 from datetime import datetime as dt
+from threading import Lock
 
 from flask import abort, current_app, g
 
 from amivapi.auth.auth import AdminOnlyAuth
-from amivapi.utils import register_domain
+from amivapi.auth.timestamps import touch
+from amivapi.utils import get_version, increment_version, register_domain
 
 try:
     from secrets import token_urlsafe
@@ -23,23 +25,73 @@ except ImportError:
     from amivapi.utils import token_urlsafe
 
 
+class ApiKeyRegistry(object):
+    """In-memory registry mapping tokens to API keys.
+
+    The registry is rebuilt whenever API keys are changed through the API.
+    To notice changes made by other processes, a version counter is stored in
+    the `config` collection and checked at most once per `interval`.
+    Looking up a token otherwise needs no database access at all.
+
+    Checking the version and rebuilding is done under a lock, and the map is
+    replaced as a whole, so threads never see a partially rebuilt map.
+
+    Args:
+        interval (timedelta): Time between version checks.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._keys = None  # token -> {'_id': ..., 'permissions': ...}
+        self._version = None
+        self._checked = None
+        self._lock = Lock()
+
+    def get(self, token):
+        """Return the API key for a token or None."""
+        with self._lock:
+            now = dt.utcnow()
+            if self._keys is None or now - self._checked >= self.interval:
+                self._checked = now
+                version = get_version(VERSION_ID)
+                if self._keys is None or version != self._version:
+                    self._load(version)
+            keys = self._keys
+
+        return keys.get(token)
+
+    def changed(self):
+        """Notify other processes about a change and rebuild now."""
+        with self._lock:
+            self._checked = dt.utcnow()
+            self._load(increment_version(VERSION_ID))
+
+    def _load(self, version):
+        """Build a new map and replace the old one (with the lock held)."""
+        apikeys = current_app.data.driver.db['apikeys'].find(
+            {}, {'token': 1, 'permissions': 1})
+        self._keys = {key['token']: key for key in apikeys}
+        self._version = version
+
+
+# `_id` of the version counter in the `config` collection
+VERSION_ID = 'APIKEYS_VERSION'
+
+
 def authorize_apikeys(resource):
     """Check if user is an apikey, and if it is, do authorization.
 
     Also update 'updated' timestamp everytime a key is accessed
     """
-    apikeys = current_app.data.driver.db['apikeys']
-    apikey = apikeys.find_one({'token': g.get('current_token')},
-                              {'permissions': 1})
+    token = g.get('current_token')
+    apikey = token and current_app.config['apikey_registry'].get(token)
 
     if apikey:
         # Get permission for resource if they exist
         permission = apikey['permissions'].get(resource)
 
-        # Update timestamp (remove microseconds to match mongo precision)
-        new_time = dt.utcnow().replace(microsecond=0)
-        apikeys.update_one({'_id': apikey['_id']},
-                           {'$set': {'_updated': new_time}})
+        # Update timestamp (written to the db by `touch` in bulk)
+        touch('apikeys', apikey['_id'])
 
         if permission == 'read':
             g.resource_admin_readonly = True
@@ -50,6 +102,11 @@ def authorize_apikeys(resource):
                        "permissions.")
 
 
+def apikeys_changed(*_):
+    """Hook to rebuild the registry after API keys were modified."""
+    current_app.config['apikey_registry'].changed()
+
+
 description = ("""
 API keys can be used to give permissions to other applications.
 
@@ -142,5 +199,15 @@ def generate_tokens(items):
 def init_apikeys(app):
     """Register API Key resource and add auth hook."""
     register_domain(app, apikeydomain)
+    app.config['apikey_registry'] = ApiKeyRegistry(
+        app.config['APIKEY_REFRESH_INTERVAL'])
+
     app.after_auth += authorize_apikeys
     app.on_insert_apikeys += generate_tokens
+
+    # Keep the registry up to date
+    app.on_inserted_apikeys += apikeys_changed
+    app.on_updated_apikeys += apikeys_changed
+    app.on_replaced_apikeys += apikeys_changed
+    app.on_deleted_item_apikeys += apikeys_changed
+    app.on_deleted_resource_apikeys += apikeys_changed
@@ -38,6 +38,9 @@
 3. Use your auth class in your resource settings. Done!
 4. Tip: You can still use all Eve settings like 'public_methods' and
    'public_item_methods'!
+5. If `has_item_write_permission` needs database queries, implement
+   `has_item_write_permission_many` as well, which is used to check a whole
+   page of items for the methods in '_links'.
 
 Take a look at `users.security` for an example.
 
@@ -71,12 +74,14 @@ Item endpoints:
   - `AmivTokenAuth.has_item_write_permission`
 """
 
-from datetime import datetime as dt
 from functools import wraps
 
 from eve.auth import BasicAuth, resource_auth
 from flask import abort, current_app, g, request
 
+from amivapi.auth.session_cache import get_session
+from amivapi.auth.timestamps import touch
+
 
 class AmivTokenAuth(BasicAuth):
     """Amiv authentication and authorization base class.
@@ -129,6 +134,23 @@ class AmivTokenAuth(BasicAuth):
         """
         return False
 
+    def has_item_write_permission_many(self, user_id, items):
+        """Check if the user is allowed to modify each of the items.
+
+        Implement this function if checking the items together is faster,
+        e.g. because related documents can be fetched with a single query.
+        Default behaviour: Call `has_item_write_permission` for each item.
+
+        Args:
+            user (str): The id of the user that wants to access the items
+            items (list): The items the user wants to change or delete.
+
+        Returns:
+            list: For each item, True if user has permission to change it.
+        """
+        return [self.has_item_write_permission(user_id, item)
+                for item in items]
+
     def create_user_lookup_filter(self, user_id):
         """Create a filter for item lookup in GET, PATCH and DELETE.
 
@@ -213,18 +235,14 @@ def authenticate_token(token):
     if token:
         g.current_token = token
 
-        # Get session
-        sessions = current_app.data.driver.db['sessions']
-        session = sessions.find_one({'token': token})
+        # Get session (cached, see `amivapi.auth.session_cache`)
+        session = get_session(token)
 
         if session:
-            # Update timestamp (remove microseconds to match mongo precision)
-            new_time = dt.utcnow().replace(microsecond=0)
-            sessions.update_one({'_id': session['_id']},
-                                {'$set': {
-                                    '_updated': new_time
-                                }})
+            # Update timestamp (written to the db by `touch` in bulk)
+            new_time = touch('sessions', session['_id'])
             session['_updated'] = new_time
+            current_app.config['session_cache'].touch(token, new_time)
 
             # Save user_id and session with updated timestamp in g
             g.current_session = session
@@ -9,27 +9,34 @@ Links are only added for resources using AmivTokenAuth.
 """
 
 from eve.auth import resource_auth
-from flask import current_app, g
+from flask import current_app, g, has_request_context, request
 
 from amivapi.auth import AmivTokenAuth, authenticate, check_if_admin
-from amivapi.utils import on_post_hook
 
 
-def _get_item_methods(resource, item):
+def _get_item_methods_many(resource, items):
+    """Get the methods for several items of a resource at once."""
     res = current_app.config['DOMAIN'][resource]
     user = g.get('current_user')  # TODO: post_internal_problem
     auth = resource_auth(resource)
-    is_admin = g.get('resource_admin')
 
     # If the item is displayed, the read methods are obviously allowed
-    methods = ['GET', 'HEAD', 'OPTIONS'] + res['public_item_methods']
+    read_methods = list(set(['GET', 'HEAD', 'OPTIONS'] +
+                            res['public_item_methods']))
+    write_methods = list(set(read_methods + res['item_methods']))
 
     # Admins have access to all methods. For non admins check user permission.
-    if is_admin or auth.has_item_write_permission(user, item):
-        methods += res['item_methods']
+    if g.get('resource_admin'):
+        permissions = [True] * len(items)
+    else:
+        permissions = auth.has_item_write_permission_many(user, items)
 
-    # Remove duplicates before returning
-    return list(set(methods))
+    return [write_methods if permitted else read_methods
+            for permitted in permissions]
+
+
+def _get_item_methods(resource, item):
+    return _get_item_methods_many(resource, [item])[0]
 
 
 def _get_resource_methods(resource):
@@ -67,22 +74,42 @@ def add_methods_to_item_links(resource, item):
         resource (str): The name of the resource
         item (dict): The item, must have a 'links' key.
     """
-    if '_links' not in item:
-        # Embedded objects don't have a _links field
+    add_methods_to_item_links_many(resource, [item])
+
+
+def add_methods_to_item_links_many(resource, items):
+    """Add methods to all links of several items.
+
+    The write permissions are checked for all items at once.
+
+    Args:
+        resource (str): The name of the resource
+        items (list): The items. Items without '_links' are skipped.
+    """
+    # Embedded objects don't have a _links field
+    items = [item for item in items if '_links' in item]
+    if not items:
         return
 
-    links = item['_links']
+    item_methods = _get_item_methods_many(resource, items)
+    home_methods = _home_link_methods()
+    resource_methods = None
+
+    for item, methods in zip(items, item_methods):
+        links = item['_links']
 
-    # self
-    links['self']['methods'] = _get_item_methods(resource, item)
+        # self
+        links['self']['methods'] = methods
 
-    # parent, i.e. home -> only read methods (optional)
-    if 'parent' in links:
-        links['parent']['methods'] = _home_link_methods()
+        # parent, i.e. home -> only read methods (optional)
+        if 'parent' in links:
+            links['parent']['methods'] = home_methods
 
-    # collection -> resource (optional)
-    if 'collection' in links:
-        links['collection']['methods'] = _get_resource_methods(resource)
+        # collection -> resource (optional)
+        if 'collection' in links:
+            if resource_methods is None:
+                resource_methods = _get_resource_methods(resource)
+            links['collection']['methods'] = resource_methods
 
 
 def add_methods_to_resource_links(resource, response):
@@ -105,52 +132,61 @@ def add_methods_to_resource_links(resource, response):
             links[link]['methods'] = res_links
 
 
+def link_methods_requested():
+    """Check if the client wants methods in the links.
+
+    Clients which don't need them can omit them with `?link_methods=false`,
+    which saves the permission checks.
+    """
+    return (not has_request_context() or
+            request.args.get('link_methods', '').lower() != 'false')
+
+
+def _add_link_methods(resource):
+    return (link_methods_requested() and
+            isinstance(resource_auth(resource), AmivTokenAuth))
+
+
 def add_permitted_methods_after_insert(resource, items):
     """Add link methods with an on_inserted hook."""
-    if isinstance(resource_auth(resource), AmivTokenAuth):
-        for item in items:
-            add_methods_to_item_links(resource, item)
+    if _add_link_methods(resource):
+        add_methods_to_item_links_many(resource, items)
 
 
 def add_permitted_methods_after_fetch_item(resource, item):
     """Add link methods with an on_fetched_item hook."""
-    if isinstance(resource_auth(resource), AmivTokenAuth):
+    if _add_link_methods(resource):
         add_methods_to_item_links(resource, item)
 
 
 def add_permitted_methods_after_fetch_resource(resource, response):
     """Add link methods with an on_fetched_resource hook."""
-    if isinstance(resource_auth(resource), AmivTokenAuth):
+    if _add_link_methods(resource):
         # Item links
-        for item in response['_items']:
-            add_methods_to_item_links(resource, item)
+        add_methods_to_item_links_many(resource, response['_items'])
 
-        # Resource links
-        add_methods_to_resource_links(resource, response)
+        # Resource links (embedded objects don't have a _links field)
+        if '_links' in response:
+            add_methods_to_resource_links(resource, response)
 
 
-@on_post_hook
-def add_permitted_methods_after_update(resource, request, response, payload):
-    """Add link methods with an on_post_PATCH hook.
+def add_permitted_methods_after_update(resource, request, payload):
+    """Add link methods with an on_render_PATCH hook.
 
     The on_updated hook doesn't work since it doesn't include the links.
-
-    This hook will also be called for errors which do not contain _links.
-    => Make sure to only add methods for successful patches (status 200 only)
     """
-    if isinstance(resource_auth(resource), AmivTokenAuth):
+    if _add_link_methods(resource):
         add_methods_to_item_links(resource, payload)
 
 
-@on_post_hook
-def add_permitted_methods_for_home(resource, request, response, payload):
-    """Add link methods to home endpoint with an on_post_GET hook.
+def add_permitted_methods_for_home(resource, request, payload):
+    """Add link methods to home endpoint with an on_render_GET hook.
 
     The home endpoint doesn't call any database hooks and no on_pre_GET hook.
     Therefore authentication needs to be done manually so we can check
     permissions.
     """
-    if resource is None:
+    if resource is None and link_methods_requested():
         authenticate()
 
         try:
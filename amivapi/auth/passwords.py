@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Password hashing and verification, optionally in a process pool.
+
+Hashing with `PASSWORD_CONTEXT` is deliberately slow. If
+`PASSWORD_HASH_WORKERS` is greater than zero, hashes are computed in a pool
+of worker processes, so a burst of logins does not occupy the CPU time of
+request threads (the waiting request thread does not hold the GIL).
+
+At most `PASSWORD_HASH_QUEUE_SIZE` hashing jobs may be pending at the same
+time. If the queue is full, requests wait up to `PASSWORD_HASH_QUEUE_TIMEOUT`
+for a free slot and are then rejected with `503 Service Unavailable` instead
+of piling up.
+
+With `PASSWORD_HASH_WORKERS = 0` (default), hashing happens on the request
+thread. The pool has to be configured explicitly, and only helps together
+with a threaded server (`amivapi run threaded`): the single-threaded bjoern
+server waits for every hash anyway, so a burst of logins still stalls it.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock
+
+from flask import abort, current_app
+from passlib.context import CryptContext
+
+
+class PasswordHasher(object):
+    """Run hashing jobs for a password context inline or in a process pool.
+
+    The context is sent to the workers as its configuration string, since
+    contexts themselves can't be pickled.
+
+    Args:
+        context (CryptContext): The context used for hashing.
+        workers (int): Number of worker processes, 0 to hash inline.
+        queue_size (int): Maximum number of pending jobs.
+        timeout (timedelta): Time to wait for a free slot in the queue.
+    """
+
+    def __init__(self, context, workers, queue_size, timeout):
+        self.context = context
+        self.workers = workers
+        self.timeout = timeout
+        self._config = context.to_string()
+        self._slots = BoundedSemaphore(queue_size)
+        self._executor = None
+        self._lock = Lock()
+
+    def hash(self, plaintext):
+        """Hash a password."""
+        return self._run(_hash, plaintext)
+
+    def verify(self, plaintext, hashed):
+        """Verify a password.
+
+        Returns:
+            tuple: (bool, bool) whether the password matches and whether the
+                hash needs to be updated (only True if it matches)
+        """
+        return self._run(_verify, plaintext, hashed)
+
+    @contextmanager
+    def slot(self):
+        """Occupy a slot in the queue, abort with 503 if none is free."""
+        if not self._slots.acquire(timeout=self.timeout.total_seconds()):
+            current_app.logger.warning("Password hashing queue is full.")
+            abort(503, description="Too many logins at the moment, "
+                                   "please try again.")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def shutdown(self):
+        """Stop the worker processes, if any."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(self.context, *args)
+
+        with self.slot():
+            return self._get_executor().submit(
+                _run_in_worker, func, self._config, *args).result()
+
+    def _get_executor(self):
+        # Create lazily, i.e. after the server has forked its workers
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers)
+            return self._executor
+
+
+def _hash(context, plaintext):
+    return context.encrypt(plaintext)
+
+
+def _verify(context, plaintext, hashed):
+    is_valid = context.verify(plaintext, hashed)
+    return is_valid, is_valid and context.needs_update(hashed)
+
+
+@lru_cache(maxsize=8)
+def _context_from_string(config):
+    return CryptContext.from_string(config)
+
+
+def _run_in_worker(func, config, *args):
+    return func(_context_from_string(config), *args)
+
+
+def hash_password(plaintext):
+    """Hash a password with the hasher of the current app."""
+    return current_app.config['password_hasher'].hash(plaintext)
+
+
+def verify_password_hash(plaintext, hashed):
+    """Verify a password with the hasher of the current app.
+
+    Returns:
+        tuple: (bool, bool) whether the password matches and whether the
+            hash needs to be updated
+    """
+    return current_app.config['password_hasher'].verify(plaintext, hashed)
+
+
+def init_password_hasher(app):
+    """Attach the password hasher to the app."""
+    app.config['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_CONTEXT'],
+        app.config['PASSWORD_HASH_WORKERS'],
+        app.config['PASSWORD_HASH_QUEUE_SIZE'],
+        app.config['PASSWORD_HASH_QUEUE_TIMEOUT'])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""In-process cache mapping tokens to sessions.
+
+`authenticate_token` is called for every request, even for public resources.
+To avoid a database round trip each time, sessions are kept in a bounded
+LRU cache with a time-to-live (TTL).
+
+The TTL bounds how long another process (e.g. `amivapi cron` or a second
+worker) can delete a session without this process noticing. Sessions which
+are expired according to `SESSION_TIMEOUT` are never returned from the cache,
+regardless of the TTL.
+
+Tokens which do not belong to any session (e.g. API keys) are cached as well,
+so they cost no database round trip either.
+
+Attributes of the user needed by auth classes (see `IDENTITY_FIELDS`) are
+resolved once per session with `get_identity` and cached with the session.
+Changing them evicts all sessions of the user from the cache.
+
+The cache is available as `app.config['session_cache']`:
+
+    cache = current_app.config['session_cache']
+    cache.hits, cache.misses    # counters to size the cache
+    cache.stats()               # all of the above and the current size
+"""
+
+from datetime import datetime as dt
+
+from flask import current_app, g
+
+from amivapi.utils import LRUCache, get_id
+
+# User fields cached with the session, add fields needed by auth classes here
+IDENTITY_FIELDS = ('membership',)
+
+
+class SessionCache(LRUCache):
+    """LRU cache with TTL for sessions, keyed by token.
+
+    Tokens without session are cached as `None`.
+
+    Args:
+        maxsize (int): Maximum number of cached tokens. 0 disables the cache.
+        ttl (timedelta): Maximum time an entry is used before the database is
+            queried again.
+    """
+
+    def touch(self, token, timestamp):
+        """Update the `_updated` timestamp of a cached session."""
+        def _set_timestamp(session):
+            if session is not None:
+                session['_updated'] = timestamp
+        self.update(token, _set_timestamp)
+
+    def evict_user(self, user_id):
+        """Remove all sessions of a user from the cache."""
+        user_id = str(user_id)
+        self.evict_where(lambda _, session: (
+            session is not None and str(session['user']) == user_id))
+
+    def evict_expired(self, deadline):
+        """Remove all sessions last used before the deadline."""
+        self.evict_where(lambda _, session: (
+            session is not None and _is_expired(session, deadline)))
+
+
+def _is_expired(session, deadline):
+    """Check if a session was last used before the deadline (naive UTC)."""
+    updated = session.get('_updated')
+    # Sessions without timestamp are only removed by the database job
+    return updated is not None and updated.replace(tzinfo=None) < deadline
+
+
+def get_session(token):
+    """Get the session for a token using the cache of the current app.
+
+    Sessions that have exceeded `SESSION_TIMEOUT` are treated as non-existent,
+    even if the cleanup job has not removed them yet.
+    """
+    cache = current_app.config['session_cache']
+    session = cache.get(token, _load_session)
+
+    deadline = dt.utcnow() - current_app.config['SESSION_TIMEOUT']
+    if session is not None and _is_expired(session, deadline):
+        cache.evict(token)
+        return None
+    return session
+
+
+def _load_session(token):
+    return current_app.data.driver.db['sessions'].find_one({'token': token})
+
+
+def get_identity(user_id):
+    """Get the `IDENTITY_FIELDS` of a user.
+
+    The fields of the user of the current session are loaded once and cached
+    with the session. Fields of other users (e.g. without session) are loaded
+    once per request.
+
+    Args:
+        user_id (str): The user, e.g. `g.current_user`. None, e.g. for API
+            keys or anonymous requests, returns an empty dict without query.
+
+    Returns:
+        dict: The fields of the user, missing fields are not included.
+    """
+    if user_id is None:
+        return {}
+
+    session = g.get('current_session')
+    if session is None or str(session['user']) != str(user_id):
+        identities = g.setdefault('user_identities', {})
+        if str(user_id) not in identities:
+            identities[str(user_id)] = _load_identity(user_id)
+        return identities[str(user_id)]
+
+    if 'user_identity' not in session:
+        identity = _load_identity(session['user'])
+        session['user_identity'] = identity
+
+        def _set_identity(cached):
+            if cached is not None and cached['_id'] == session['_id']:
+                cached['user_identity'] = dict(identity)
+        current_app.config['session_cache'].update(g.current_token,
+                                                   _set_identity)
+    return session['user_identity']
+
+
+def _load_identity(user_id):
+    if user_id is None:
+        return {}
+    projection = {field: 1 for field in IDENTITY_FIELDS}
+    user = current_app.data.driver.db['users'].find_one(
+        {'_id': get_id(user_id)}, projection)
+    if user is None:
+        return {}
+    user.pop('_id')
+    return user
+
+
+# Hooks to keep the cache in sync
+
+def evict_deleted_session(item):
+    """Remove a session deleted via /sessions from the cache."""
+    current_app.config['session_cache'].evict(item['token'])
+
+
+def evict_inserted_sessions(items):
+    """Drop cached (negative) entries for new tokens."""
+    cache = current_app.config['session_cache']
+    for item in items:
+        cache.evict(item['token'])
+
+
+def evict_sessions_after_user_update(updates, original):
+    """Remove the sessions of a user if cached fields have changed."""
+    if any(field in updates for field in IDENTITY_FIELDS):
+        current_app.config['session_cache'].evict_user(original['_id'])
+
+
+def init_session_cache(app):
+    """Attach the session cache to the app and add invalidation hooks."""
+    app.config['session_cache'] = SessionCache(
+        app.config['SESSION_CACHE_SIZE'],
+        app.config['SESSION_CACHE_TTL'])
+
+    app.on_inserted_sessions += evict_inserted_sessions
+    app.on_deleted_item_sessions += evict_deleted_session
+    app.on_updated_users += evict_sessions_after_user_update
+    app.on_replaced_users += evict_sessions_after_user_update
@@ -14,6 +14,8 @@ from flask import abort, current_app as app
 
 from amivapi import ldap
 from amivapi.auth import AmivTokenAuth
+from amivapi.auth.passwords import verify_password_hash
+from amivapi.auth.timestamps import flush_timestamps
 from amivapi.cron import periodic
 from amivapi.utils import admin_permissions, get_id
 
@@ -237,14 +239,12 @@ def verify_password(user, plaintext):
         bool: True if password matches. False if it doesn't or if there is no
             password set and/or provided.
     """
-    password_context = app.config['PASSWORD_CONTEXT']
-
     if (plaintext is None) or (user['password'] is None):
         return False
 
-    is_valid = password_context.verify(plaintext, user['password'])
+    is_valid, needs_update = verify_password_hash(plaintext, user['password'])
 
-    if is_valid and password_context.needs_update(user['password']):
+    if needs_update:
         # update password - hook will handle hashing
         update = {'password': plaintext}
         with admin_permissions():
@@ -265,4 +265,10 @@ def delete_expired_sessions():
     >>>     delete_expired_sessions()
     """
     deadline = datetime.datetime.utcnow() - app.config['SESSION_TIMEOUT']
-    app.data.driver.db['sessions'].remove({'_updated': {'$lt': deadline}})
+    app.config['session_cache'].evict_expired(deadline)
+
+    # Workers flush their timestamps at least every flush interval, so the
+    # database is behind by at most that (twice to allow for slow flushes)
+    flush_timestamps()
+    db_deadline = deadline - 2 * app.config['TIMESTAMP_FLUSH_INTERVAL']
+    app.data.driver.db['sessions'].remove({'_updated': {'$lt': db_deadline}})
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Write-behind buffer for the `_updated` timestamps of sessions and API keys.
+
+Every authenticated request marks its session (or API key) as used. Instead of
+writing to the database each time, the latest timestamp per document is kept
+in memory and written with one `bulk_write` per collection as soon as
+
+- `TIMESTAMP_FLUSH_INTERVAL` has passed since the last flush (this is the
+  maximum staleness of the timestamps in the database), or
+- `TIMESTAMP_FLUSH_SIZE` documents are waiting,
+
+and when the process exits. A background thread flushes every
+`TIMESTAMP_FLUSH_INTERVAL`, so idle workers don't hold back timestamps either.
+Servers started with `amivapi run` also flush on SIGTERM and SIGINT, see
+`install_signal_handlers`. Flushing uses `$max`, so timestamps never move
+backwards if several workers flush in arbitrary order.
+
+Set `TIMESTAMP_FLUSH_INTERVAL` to zero to write every timestamp immediately.
+
+A timestamp waits at most `TIMESTAMP_FLUSH_INTERVAL` in the buffer of any
+worker, `delete_expired_sessions` only removes sessions which are expired for
+longer than twice that. Requests still respect `SESSION_TIMEOUT` exactly, see
+`amivapi.auth.session_cache.get_session`.
+"""
+
+import atexit
+from datetime import datetime as dt
+import os
+import signal
+from threading import Event, Lock, Thread
+from time import time
+from weakref import WeakSet, ref
+
+from flask import current_app
+from pymongo import UpdateOne
+
+
+class TimestampBuffer(object):
+    """Coalesce timestamp updates in memory and flush them in bulk.
+
+    Args:
+        app (Eve): The app to flush to, only a weak reference is kept.
+        interval (timedelta): Maximum time between flushes.
+        maxsize (int): Number of buffered documents triggering a flush.
+    """
+
+    def __init__(self, app, interval, maxsize):
+        self.interval = interval
+        self.maxsize = maxsize
+        self._app = ref(app)
+        self._pending = {}  # (collection, _id) -> timestamp
+        self._last_flush = dt.utcnow()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        """Flush every `interval` in a daemon thread.
+
+        The thread stops with `stop` or when the app is garbage collected.
+        """
+        if self.interval.total_seconds() > 0:
+            self._thread = Thread(target=_flush_periodically,
+                                  args=(ref(self),), daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the flushing thread after a final flush.
+
+        Only sets an event, so this can be called from signal handlers. Waits
+        up to `timeout` seconds for the final flush if given.
+        """
+        self._stopped.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
+
+    def record(self, collection, _id, timestamp):
+        """Remember the latest timestamp of a document."""
+        key = (collection, _id)
+        with self._lock:
+            if timestamp > self._pending.get(key, timestamp.min):
+                self._pending[key] = timestamp
+
+    def due(self):
+        """Check if the buffer needs to be flushed."""
+        with self._lock:
+            return bool(self._pending) and (
+                len(self._pending) >= self.maxsize or
+                dt.utcnow() - self._last_flush >= self.interval)
+
+    def flush(self):
+        """Write all buffered timestamps, one `bulk_write` per collection."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = dt.utcnow()
+
+        app = self._app()
+        if not pending or app is None:
+            return
+
+        operations = {}
+        for (collection, _id), timestamp in pending.items():
+            operations.setdefault(collection, []).append(
+                UpdateOne({'_id': _id}, {'$max': {'_updated': timestamp}}))
+
+        with app.app_context():
+            db = app.data.driver.db
+            for collection, requests in operations.items():
+                db[collection].bulk_write(requests, ordered=False)
+
+
+def _flush_periodically(buffer_ref):
+    """Flush a buffer until it is stopped, then flush a last time. Only keeps
+    a weak reference while waiting, so apps can be garbage collected."""
+    buffer = buffer_ref()
+    stopped, interval = buffer._stopped, buffer.interval.total_seconds()
+    del buffer
+
+    while True:
+        is_stopped = stopped.wait(interval)
+        buffer = buffer_ref()
+        app = buffer._app() if buffer is not None else None
+        if app is None:
+            return
+        try:
+            buffer.flush()
+        except Exception as error:
+            app.logger.error("Failed to flush timestamps: %s" % error)
+        del buffer, app
+        if is_stopped:
+            return
+
+
+# Flush all buffers on shutdown. Buffers only reference their app weakly,
+# so this does not keep apps (e.g. in tests) alive.
+_buffers = WeakSet()
+_previous_handlers = {}
+
+SIGNAL_FLUSH_TIMEOUT = 5  # seconds
+
+
+@atexit.register
+def _flush_all():
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+def _flush_on_signal(signum, frame):
+    """Let the flushing threads flush and continue with the handler which
+    was installed before.
+
+    The handler can interrupt the main thread while it holds the lock of a
+    buffer, so it must not flush itself. If a thread can't finish within
+    `SIGNAL_FLUSH_TIMEOUT`, the remaining timestamps are lost.
+    """
+    buffers = list(_buffers)
+    for buffer in buffers:
+        buffer.stop()
+    deadline = time() + SIGNAL_FLUSH_TIMEOUT
+    for buffer in buffers:
+        buffer.stop(timeout=max(deadline - time(), 0))
+
+    previous = _previous_handlers[signum]
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        # Default action, i.e. terminate
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+
+def install_signal_handlers():
+    """Flush all buffers on SIGTERM and SIGINT.
+
+    atexit does not run if servers like bjoern or waitress are terminated.
+    Signal handlers are global for the process, so only servers install them,
+    and only from the main thread.
+    """
+    if _previous_handlers:
+        return
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        _previous_handlers[signum] = signal.getsignal(signum)
+        signal.signal(signum, _flush_on_signal)
+
+
+def touch(collection, _id):
+    """Mark a document as used now and flush the buffer if needed.
+
+    Returns:
+        datetime: The new timestamp (without microseconds to match mongo).
+    """
+    timestamp = dt.utcnow().replace(microsecond=0)
+    buffer = current_app.config['timestamp_buffer']
+    buffer.record(collection, _id, timestamp)
+    if buffer.due():
+        buffer.flush()
+    return timestamp
+
+
+def flush_timestamps():
+    """Write all buffered timestamps of the current app."""
+    current_app.config['timestamp_buffer'].flush()
+
+
+def init_timestamp_buffer(app):
+    """Attach the timestamp buffer to the app."""
+    buffer = TimestampBuffer(app,
+                             app.config['TIMESTAMP_FLUSH_INTERVAL'],
+                             app.config['TIMESTAMP_FLUSH_SIZE'])
+    app.config['timestamp_buffer'] = buffer
+    _buffers.add(buffer)
+    buffer.start()
@@ -24,10 +24,13 @@ from amivapi import (
     groups,
     joboffers,
     ldap,
+    media,
+    outbox,
     studydocs,
     users,
     utils
 )
+from amivapi.data import IdentityMapMongo
 from amivapi.validation import ValidatorAMIV
 
 
@@ -87,7 +90,8 @@ def create_app(config_file=None, **kwargs):
 
     app = Eve("amivapi",  # Flask needs this name to find the static folder
               settings=config,
-              validator=ValidatorAMIV)
+              validator=ValidatorAMIV,
+              data=IdentityMapMongo)
     app.logger.info(config_status)
 
     # Set up error logging with sentry
@@ -106,6 +110,8 @@ def create_app(config_file=None, **kwargs):
     studydocs.init_app(app)
     cascade.init_app(app)
     cron.init_app(app)
+    outbox.init_app(app)
+    media.init_app(app)
     documentation.init_app(app)
 
     # Fix that eve doesn't run hooks on embedded documents
@@ -8,49 +8,140 @@
 This adds an option 'cascade_delete' to data_relations in the schema. If it is
 set to true, then deleting the referenced object will also delete the
 referencing object. If false, the reference will be set to NULL, when the
-referenced object is deleted.
+referenced object is deleted (only possible for nullable fields).
+
+Which resources refer to a resource is looked up in a map built once from the
+domain. Referencing objects are processed in batches of `CASCADE_BATCH_SIZE`:
+The hooks of all objects in a batch are called, but the batch is deleted (or
+updated) with a single database query.
 """
 
-from eve.methods.delete import deleteitem_internal
-from eve.methods.patch import patch_internal
+from datetime import datetime
+from itertools import islice
+
+from eve.methods.common import resolve_document_etag
 from flask import current_app
-from werkzeug.exceptions import NotFound
+from pymongo import UpdateOne
 
+from amivapi.data import forget
 from amivapi.utils import admin_permissions
 
 
+def build_reverse_relations(domain):
+    """Find all references between resources.
+
+    Returns:
+        dict: For every resource a list of (resource, field, cascade) tuples,
+            where `field` of `resource` refers to the resource.
+    """
+    reverse_relations = {}
+    for res, res_domain in domain.items():
+        for field, field_def in res_domain['schema'].items():
+            data_relation = field_def.get('data_relation')
+            if data_relation is None or 'resource' not in data_relation:
+                continue
+            reverse_relations.setdefault(data_relation['resource'], []).append(
+                (res, field, data_relation.get('cascade_delete', False)))
+    return reverse_relations
+
+
+def get_reverse_relations(resource):
+    """Get all references to a resource.
+
+    The map is rebuilt if resources were added after initialization.
+    """
+    config = current_app.config
+    if config.get('reverse_relations_of') != set(config['DOMAIN']):
+        config['reverse_relations'] = build_reverse_relations(config['DOMAIN'])
+        config['reverse_relations_of'] = set(config['DOMAIN'])
+    return config['reverse_relations'].get(resource, [])
+
+
 def cascade_delete(resource, item):
     """Cascade DELETE.
 
     Hook to delete all objects, which have the 'cascade_delete' option set
     in the data_relation and relate to the object, which was just deleted.
     """
-    domain = current_app.config['DOMAIN']
-    deleted_id = item[domain[resource]['id_field']]
+    deleted_id = item[current_app.config['DOMAIN'][resource]['id_field']]
 
-    for res, res_domain in domain.items():
-        # Filter schema of `res` to get all fields containing references
-        # to the resource of the deleted item
-        relations = ((field, field_def['data_relation'])
-                     for field, field_def in res_domain['schema'].items()
-                     if 'data_relation' in field_def and
-                     field_def['data_relation'].get('resource') == resource)
-        for field, data_relation in relations:
-            # All items in `res` with reference to the deleted item
-            lookup = {field: deleted_id}
-            with admin_permissions():
-                try:
-                    if data_relation.get('cascade_delete'):
-                        # Delete the item as well
-                        deleteitem_internal(res, concurrency_check=False,
-                                            **lookup)
-                    else:
-                        # Don't delete, only remove reference
-                        patch_internal(res, payload={field: None},
-                                       concurrency_check=False,
-                                       **lookup)
-                except NotFound:
-                    pass
+    for res, field, cascade in get_reverse_relations(resource):
+        # All items in `res` with reference to the deleted item
+        with admin_permissions():
+            for batch in _batches(res, {field: deleted_id}):
+                if cascade:
+                    # Delete the items as well
+                    delete_batch(res, batch)
+                else:
+                    # Don't delete, only remove reference
+                    remove_references(res, field, batch)
+
+
+def delete_batch(resource, items):
+    """Delete items with a single query and call the delete hooks for each."""
+    for item in items:
+        current_app.on_delete_item(resource, item)
+        getattr(current_app, 'on_delete_item_%s' % resource)(item)
+
+    for field in current_app.config['DOMAIN'][resource]['_media']:
+        for item in items:
+            files = item.get(field)
+            for file_id in (files if isinstance(files, list) else [files]):
+                if file_id is not None:
+                    current_app.media.delete(file_id, resource)
+
+    current_app.data.remove(
+        resource, {'_id': {'$in': [item['_id'] for item in items]}})
+
+    for item in items:
+        current_app.on_deleted_item(resource, item)
+        getattr(current_app, 'on_deleted_item_%s' % resource)(item)
+
+
+def remove_references(resource, field, items):
+    """Set a reference to None for all items with a single query.
+
+    The update hooks are called for each item. References which must not be
+    None are kept.
+    """
+    if not current_app.config['DOMAIN'][resource]['schema'][field].get(
+            'nullable'):
+        return
+
+    now = datetime.utcnow().replace(microsecond=0)
+    operations = []
+    all_updates = []
+    for original in items:
+        updates = {field: None}
+        current_app.on_update(resource, updates, original)
+        getattr(current_app, 'on_update_%s' % resource)(updates, original)
+
+        updates['_updated'] = now
+        updated = dict(original, **updates)
+        resolve_document_etag(updated, resource)
+        updates['_etag'] = updated['_etag']
+
+        operations.append(UpdateOne({'_id': original['_id']},
+                                    {'$set': updates}))
+        all_updates.append(updates)
+
+    current_app.data.driver.db[resource].bulk_write(operations)
+    for updates, original in zip(all_updates, items):
+        forget(resource, original['_id'])
+        current_app.on_updated(resource, updates, original)
+        getattr(current_app, 'on_updated_%s' % resource)(updates, original)
+
+
+def _batches(resource, lookup):
+    """Iterate over all matching items in lists of `CASCADE_BATCH_SIZE`."""
+    batch_size = current_app.config['CASCADE_BATCH_SIZE']
+    cursor = current_app.data.driver.db[resource].find(
+        lookup, batch_size=batch_size)
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
 def cascade_delete_collection(resource, items):
@@ -60,6 +151,10 @@ def cascade_delete_collection(resource, items):
 
 
 def init_app(app):
-    """Add hooks to app."""
+    """Build the map of references and add hooks to app."""
+    app.config['reverse_relations'] = build_reverse_relations(
+        app.config['DOMAIN'])
+    app.config['reverse_relations_of'] = set(app.config['DOMAIN'])
+
     app.on_deleted_item += cascade_delete
     app.on_deleted += cascade_delete_collection
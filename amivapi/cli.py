@@ -9,18 +9,28 @@ from os.path import join, isdir
 from datetime import datetime as dt
 from time import sleep
 
+from bson import ObjectId
 from click import argument, echo, group, option, Path, Choice, ClickException
 
+from amivapi.auth.timestamps import install_signal_handlers
 from amivapi.bootstrap import create_app
-from amivapi.cron import run_scheduled_tasks
+from amivapi.cron import run_scheduled_tasks, wait_for_next_task
 from amivapi import ldap
+from amivapi.events.queue import rebuild_queue_ranks
 from amivapi.groups.mailing_lists import updated_group
+from amivapi.outbox import SMTPConnection, send_mails
+from amivapi.studydocs.summary import rebuild_summary
 
 try:
     import bjoern
 except ImportError:
     bjoern = False
 
+try:
+    import waitress
+except ImportError:
+    waitress = False
+
 
 @group()
 def cli():
@@ -65,10 +75,15 @@ def recreate_mailing_lists(config):
 
 
 def run_cron(app):
-    """Run scheduled tasks with the given app."""
+    """Run scheduled tasks with the given app and print their timings."""
     echo("Executing scheduled tasks...")
     with app.app_context():
-        run_scheduled_tasks()
+        timings = run_scheduled_tasks()
+
+    for function, timing in sorted(timings.items()):
+        echo('%s: %i runs (%i failed), %.3f seconds total, %.3f seconds max.'
+             % (function, timing['runs'], timing['failures'],
+                timing['total'], timing['max']))
 
 
 @cli.command()
@@ -78,7 +93,8 @@ def run_cron(app):
 def cron(config, continuous):
     """Run scheduled tasks.
 
-    Use --continuous to keep running and execute tasks periodically.
+    Use --continuous to keep running and execute tasks as soon as they are
+    due.
     """
     app = create_app(config_file=config)
 
@@ -87,8 +103,8 @@ def cron(config, continuous):
     else:
         interval = app.config['CRON_INTERVAL']
 
-        echo('Running scheduled tasks periodically (every %i seconds).'
-             % interval.total_seconds())
+        echo('Running scheduled tasks when they are due (checking at least '
+             'every %i seconds).' % interval.total_seconds())
 
         while True:
             checkpoint = dt.utcnow()
@@ -97,10 +113,54 @@ def cron(config, continuous):
             echo('Tasks executed, total execution time: %.3f seconds.'
                  % execution_time.total_seconds())
 
-            if execution_time > interval:
-                echo('Warning: Execution time exceeds interval length.')
+            # Sleep until the next task is due or a new task is scheduled
+            with app.app_context():
+                wait_for_next_task(interval)
+
+
+def run_send_mails(app, connection):
+    """Send all due mails with the given app.
+
+    Returns:
+        int: Number of processed mails.
+    """
+    total = 0
+    with app.app_context():
+        while True:
+            processed = send_mails(connection)
+            total += processed
+            if processed < app.config['MAIL_BATCH_SIZE']:
+                return total
+
+
+@cli.command('send_mails')
+@config_option
+@option("--continuous", is_flag=True,
+        help="If set, continue running in a loop.")
+def send_mails_command(config, continuous):
+    """Send mails from the outbox.
+
+    Use --continuous to keep running and send new mails as they arrive.
+    """
+    app = create_app(config_file=config)
+    connection = SMTPConnection(app.config)
 
-            sleep((interval - execution_time).total_seconds())
+    if not continuous:
+        echo("Processed %i mails." % run_send_mails(app, connection))
+        connection.close()
+        return
+
+    interval = app.config['MAIL_POLL_INTERVAL'].total_seconds()
+    echo('Sending mails continuously (checking every %i seconds).'
+         % interval)
+    while True:
+        processed = run_send_mails(app, connection)
+        if processed:
+            echo('Processed %i mails.' % processed)
+        else:
+            # Don't keep idle connections open
+            connection.close()
+            sleep(interval)
 
 
 @cli.command()
@@ -134,15 +194,70 @@ def ldap_sync(config, sync_all, nethz):
 
 @cli.command()
 @config_option
-@argument('mode', type=Choice(['prod', 'dev']))
-def run(config, mode):
+@argument('event', nargs=-1)
+def rebuild_signup_ranks(config, event):
+    """Renumber the queue ranks of event signups.
+
+    The ranks determine the position of signups and are assigned on signup.
+    Use this to assign ranks to existing signups after an update or to repair
+    them after manual changes to the database.
+
+    Examples:
+
+        amivapi rebuild_signup_ranks
+
+        amivapi rebuild_signup_ranks 5bd19211d57724603b489882
+    """
+    for event_id in event:
+        if not ObjectId.is_valid(event_id):
+            raise ClickException("'%s' is not a valid event id." % event_id)
+
+    app = create_app(config_file=config)
+    with app.app_context():
+        for event_id in event:
+            if app.data.driver.db['events'].count_documents(
+                    {'_id': ObjectId(event_id)}) == 0:
+                raise ClickException("Event '%s' does not exist." % event_id)
+
+        if event:
+            for event_id in event:
+                rebuild_queue_ranks(event_id)
+            echo("Renumbered signups of %i events." % len(event))
+        else:
+            echo("Renumbered signups of %i events." % rebuild_queue_ranks())
+
+
+@cli.command()
+@config_option
+def rebuild_studydoc_summary(config):
+    """Recount the values in the summary of studydocuments.
+
+    The counters are kept up to date when studydocuments are changed through
+    the API and are rebuilt every hour. Use this to correct them right away
+    after changing studydocuments directly in the database.
+    """
+    app = create_app(config_file=config)
+    with app.app_context():
+        rebuild_summary()
+    echo("Rebuilt the studydocument summary.")
+
+
+@cli.command()
+@config_option
+@argument('mode', type=Choice(['prod', 'threaded', 'dev']))
+@option('--threads', default=8, show_default=True,
+        help="Number of threads for the threaded server.")
+def run(config, mode, threads):
     """Run production/development server.
 
-    Two modes of operation are available:
+    Three modes of operation are available:
 
     - dev: Run a development server
 
     - prod: Run a production server (requires the `bjoern` module)
+
+    - threaded: Run a production server handling several requests at the
+      same time in threads (requires the `waitress` module)
     """
     if mode == 'dev':
         app = create_app(config_file=config,
@@ -151,10 +266,23 @@ def run(config, mode):
                          TESTING=True)
         app.run(threaded=True)
 
+    elif mode == 'threaded':
+        if waitress:
+            echo('Starting waitress with %i threads on port 8080...' % threads)
+            app = create_app(config_file=config)
+            install_signal_handlers()
+            waitress.serve(app, host='0.0.0.0', port=8080, threads=threads)
+        else:
+            raise ClickException('The threaded server requires `waitress`, '
+                                 'try installing it with '
+                                 '`pip install waitress`.')
+
     elif mode == 'prod':
         if bjoern:
             echo('Starting bjoern on port 8080...')
-            bjoern.run(create_app(config_file=config), '0.0.0.0', 8080)
+            app = create_app(config_file=config)
+            install_signal_handlers()
+            bjoern.run(app, '0.0.0.0', 8080)
         else:
             raise ClickException('The production server requires `bjoern`, '
                                  'try installing it with '
@@ -38,6 +38,17 @@ Notes:
 For all kind of scheduled tasks an app context is available, but no request
 context. If you need a request context, you can use the flask test client.
 
+Tasks are claimed with a lease: A claimed task is hidden from other runners
+for `CRON_LEASE_TIMEOUT` and only deleted after it has finished. The lease is
+renewed while the task is running, so long tasks are not claimed twice. If the
+runner crashes, the task is executed again after the lease has expired, so
+several `amivapi cron` processes can safely share the work. Running tasks are
+not changed by `update_scheduled_task`. Tasks raising an exception
+are retried with exponential backoff (`CRON_RETRY_DELAY`, up to
+`CRON_MAX_ATTEMPTS` attempts). Failed runs of periodic tasks are not retried,
+since the next run is already scheduled. Up to `CRON_WORKERS` tasks are
+executed in parallel by every runner, so long tasks don't block others.
+
 The time intervals at which periodic functions are called are subject to
 variations depending on when the scheduler is running. This might lead to
 drifting of the exact point in time, when a function is called.
@@ -46,11 +57,19 @@ run every day at the same time, but will drift into the future slowly. This
 might sum up to a missing period, so after a year the function might have been
 called only 364 times.
 """
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime, timedelta
 from functools import wraps
 import pickle
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
 
+from bson import ObjectId
 from flask import current_app
+from pymongo import ASCENDING, CursorType, DESCENDING, ReturnDocument
+from pymongo.errors import CollectionInvalid
 
 
 #
@@ -80,9 +99,16 @@ def periodic(period, *args):
     def wrap(func):
         @wraps(func)
         def wrapped():
-            schedule_task(datetime.utcnow() + period, wrapped)
+            # Unless a previous (crashed) attempt of this run already did,
+            # schedule the next run. Running tasks are leased.
+            tasks = current_app.data.driver.db['scheduled_tasks']
+            if not tasks.count_documents({'function': func_str(wrapped),
+                                          'lease': {'$exists': False}}):
+                schedule_task(datetime.utcnow() + period, wrapped)
             func(*args)
 
+        # Don't retry failed runs, the next one is already scheduled
+        wrapped.is_periodic = True
         schedulable(wrapped)
 
         # if init_app has already run, schedule the first execution
@@ -109,23 +135,35 @@ def schedule_task(time, func, *args):
         'function': func_s,
         'args': pickle.dumps(args)
     })
+    _wake_up_scheduler(time)
 
 
 def update_scheduled_task(time, func, *args):
-    """ Update a scheduled task that was previously registered. """
+    """ Update a scheduled task that was previously registered.
+
+    A task which is running right now is not modified, the updated task is
+    scheduled in addition.
+    """
     func_s = func_str(func)
 
     if func_s not in schedulable_functions:
         raise NotSchedulable("%s is not schedulable. Did you forget the "
                              "@schedulable decorator?" % func.__name__)
 
-    current_app.data.driver.db['scheduled_tasks'].update_one({
-        'function': func_s
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    result = tasks.update_one({
+        'function': func_s,
+        'lease': {'$exists': False}
     },
         {'$set': {
                  'time': time,
                  'args': pickle.dumps(args)
         }})
+    if not result.matched_count and tasks.count_documents(
+            {'function': func_s, 'lease': {'$exists': True}}):
+        schedule_task(time, func, *args)
+        return
+    _wake_up_scheduler(time)
 
 
 def schedule_once_soon(func, *args):
@@ -138,6 +176,65 @@ def schedule_once_soon(func, *args):
     schedule_task(datetime.utcnow(), func, *args)
 
 
+def wait_for_next_task(max_wait):
+    """ Sleep until the next task is due, but at most `max_wait`.
+
+    `schedule_task` and `update_scheduled_task` send a wake-up signal through
+    a capped collection, which we follow with a tailable cursor. If a task is
+    scheduled earlier than the one we are waiting for, we wake up early.
+    If signals were removed from the capped collection before we read them,
+    the tasks are checked again right away. This needs an app context.
+
+    Args:
+        max_wait (timedelta): Maximum time to sleep, also limits how long
+            changes to tasks made by other means go unnoticed.
+    """
+    db = current_app.data.driver.db
+    signals = db[SIGNAL_COLLECTION]
+    # Only signals sent from now on are relevant
+    last_id = _newest_signal_id(signals)
+
+    latest = datetime.utcnow() + max_wait
+    while True:
+        next_task = db['scheduled_tasks'].find_one(
+            {}, {'time': 1}, sort=[('time', ASCENDING)])
+        deadline = latest
+        if next_task is not None:
+            deadline = min(deadline, _naive(next_task['time']))
+
+        remaining = deadline - datetime.utcnow()
+        if remaining <= timedelta(0):
+            return
+
+        if _signal_lost(signals, last_id):
+            # The last signal we have seen was removed from the capped
+            # collection, so we may have missed newer ones. Continue from
+            # the newest signal and check the tasks again.
+            last_id = _newest_signal_id(signals)
+            continue
+
+        # Tailable cursors die if nothing matches, so we can't filter
+        # for new signals
+        cursor = signals.find(cursor_type=CursorType.TAILABLE_AWAIT)
+        cursor.max_await_time_ms(int(remaining.total_seconds() * 1000) + 1)
+        try:
+            # Skip signals up to the last one we have seen
+            seen_last = last_id is None
+            for signal in _follow(cursor):
+                if seen_last:
+                    last_id = signal['_id']
+                    break
+                seen_last = signal['_id'] == last_id
+            else:
+                # The cursor also dies if the signals it points to are
+                # removed, which is handled on the next iteration
+                if not cursor.alive and not _signal_lost(signals, last_id):
+                    # No signals at all, don't spin
+                    sleep(min(remaining.total_seconds(), 1))
+        finally:
+            cursor.close()
+
+
 #
 # Internal functions
 #
@@ -145,31 +242,185 @@ def schedule_once_soon(func, *args):
 schedulable_functions = {}
 periodic_functions = []
 
+# Capped collection to wake up `wait_for_next_task`
+SIGNAL_COLLECTION = 'scheduled_tasks_signals'
+
 
 def func_str(func):
     """ Return a string describing the function """
     return "%s.%s" % (func.__module__, func.__name__)
 
 
+def _wake_up_scheduler(time):
+    """ Notify schedulers waiting in `wait_for_next_task`. """
+    current_app.data.driver.db[SIGNAL_COLLECTION].insert_one({'time': time})
+
+
+def _newest_signal_id(signals):
+    """ Id of the newest wake-up signal, None if there are none. """
+    signal = signals.find_one(sort=[('$natural', DESCENDING)])
+    return signal['_id'] if signal else None
+
+
+def _signal_lost(signals, signal_id):
+    """ Check if a signal has been removed from the capped collection. """
+    return (signal_id is not None and
+            signals.count_documents({'_id': signal_id}, limit=1) == 0)
+
+
+def _naive(time):
+    """ Remove the timezone, all times are in UTC. """
+    return time.replace(tzinfo=None)
+
+
+def _follow(cursor):
+    """ Iterate a tailable cursor until it times out or dies. """
+    while cursor.alive:
+        signal = next(cursor, None)
+        if signal is None:
+            return
+        yield signal
+
+
 def run_scheduled_tasks():
     """ Check for scheduled task, which have passed the deadline and run them.
     This needs an app context.
+
+    Returns:
+        dict: Timings of this run per function, with the number of `runs`,
+            `failures`, the `total` and `max` execution time in seconds.
     """
-    while True:
-        task = (current_app.data.driver.db['scheduled_tasks']
-                .find_one_and_delete(
-                    {'time': {'$lte': datetime.utcnow()}}))
+    app = current_app._get_current_object()
+    timings = TaskTimings()
+    workers = app.config['CRON_WORKERS']
+
+    if workers <= 1:
+        _run_due_tasks(app, timings)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_due_tasks, app, timings)
+                       for _ in range(workers)]
+            for future in futures:
+                future.result()
+
+    return timings.summary()
+
+
+class TaskTimings(object):
+    """ Thread-safe collection of execution times per function. """
+
+    def __init__(self):
+        self._timings = {}
+        self._lock = Lock()
+
+    def record(self, function, elapsed, failed):
+        with self._lock:
+            timing = self._timings.setdefault(
+                function, {'runs': 0, 'failures': 0, 'total': 0., 'max': 0.})
+            timing['runs'] += 1
+            timing['failures'] += int(failed)
+            timing['total'] += elapsed
+            timing['max'] = max(timing['max'], elapsed)
+
+    def summary(self):
+        with self._lock:
+            return deepcopy(self._timings)
+
+
+def _run_due_tasks(app, timings):
+    """ Claim and run due tasks until there are none left. """
+    with app.app_context():
+        while True:
+            task = _claim_task()
+            if task is None:
+                return
+            _run_task(task, timings)
+
+
+def _claim_task():
+    """ Claim the next due task by hiding it for the lease timeout. """
+    now = datetime.utcnow()
+    return current_app.data.driver.db['scheduled_tasks'].find_one_and_update(
+        {'time': {'$lte': now}},
+        {'$set': {'time': now + current_app.config['CRON_LEASE_TIMEOUT'],
+                  'lease': ObjectId()}},
+        sort=[('time', ASCENDING)],
+        return_document=ReturnDocument.AFTER)
+
+
+def _run_task(task, timings):
+    """ Run a claimed task, delete it on success or schedule a retry. """
+    collection = current_app.data.driver.db['scheduled_tasks']
+    # Only modify the task if our lease has not been taken over
+    lookup = {'_id': task['_id'], 'lease': task['lease']}
+
+    func = schedulable_functions.get(task['function'])
+    if func is None:
+        current_app.logger.error("Dropping scheduled task %s: function is "
+                                 "not schedulable." % task['function'])
+        collection.delete_one(lookup)
+        return
 
-        if task is None:
-            return
+    start = perf_counter()
+    try:
+        with _renewed_lease(collection, lookup,
+                            current_app.config['CRON_LEASE_TIMEOUT']):
+            func(*pickle.loads(task['args']))
+    except Exception:
+        timings.record(task['function'], perf_counter() - start, True)
+        current_app.logger.exception("Scheduled task %s failed."
+                                     % task['function'])
+    else:
+        timings.record(task['function'], perf_counter() - start, False)
+        collection.delete_one(lookup)
+        return
+
+    attempts = task.get('attempts', 0) + 1
+    if (getattr(func, 'is_periodic', False) or
+            attempts >= current_app.config['CRON_MAX_ATTEMPTS']):
+        collection.delete_one(lookup)
+        return
+
+    delay = current_app.config['CRON_RETRY_DELAY'] * 2 ** (attempts - 1)
+    collection.update_one(lookup, {
+        '$set': {'time': datetime.utcnow() + delay, 'attempts': attempts},
+        '$unset': {'lease': ''},
+    })
+
+
+@contextmanager
+def _renewed_lease(collection, lookup, timeout):
+    """ Extend the lease of a running task every third of the lease timeout
+    in a background thread. """
+    done = Event()
+
+    def renew():
+        while not done.wait(timeout.total_seconds() / 3):
+            collection.update_one(lookup, {
+                '$set': {'time': datetime.utcnow() + timeout}})
 
-        args = pickle.loads(task['args'])
-        func = schedulable_functions[task['function']]
-        func(*args)
+    thread = Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
 
 
 def init_app(app):
     # Periodic functions: If no execution is scheduled so far, schedule one
     with app.app_context():  # this is needed to run db queries
+        db = app.data.driver.db
+        db['scheduled_tasks'].create_index('time')
+
+        # Tailable cursors need a capped collection
+        if SIGNAL_COLLECTION not in db.list_collection_names():
+            try:
+                db.create_collection(SIGNAL_COLLECTION, capped=True,
+                                     size=2 ** 16, max=100)
+                db[SIGNAL_COLLECTION].insert_one({'time': None})
+            except CollectionInvalid:
+                pass  # Created by another process in the meantime
         for func in periodic_functions:
             schedule_once_soon(func)
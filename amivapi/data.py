@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Data layer with a request-scoped identity map.
+
+Handling a single request often looks up the same document several times,
+e.g. validators, auth and hooks all fetch the event of a signup with
+`current_app.data.find_one('events', None, _id=...)`.
+
+Within a request, such lookups by id (and without parsed request) are
+answered from a map in `flask.g` after the first query. Writes through the
+data layer evict the affected documents. Code writing directly with
+`data.driver.db` has to call `forget` if it reads the document again in the
+same request.
+
+`app.data.saved_queries` counts the lookups answered from the map, which
+helps to find out whether it is worth it.
+
+Furthermore, the filters allowed for a resource can be restricted for the
+current request with `set_allowed_filters`, e.g. depending on the user.
+Eve only checks the `allowed_filters` of the domain, which is shared by all
+requests (and threads) and must not be modified.
+
+Queries with a `$text` search return the relevance as `_score` and are sorted
+by it, unless the client requests another sort.
+"""
+
+from copy import deepcopy
+import json
+
+from eve.io.mongo import Mongo
+from eve.io.mongo.parser import parse, ParseError
+from flask import abort, current_app, g, has_request_context
+
+
+class IdentityMapMongo(Mongo):
+    """Mongo data layer caching `find_one` by id for the current request."""
+
+    saved_queries = 0
+
+    def find_one(self, resource, req, check_auth_value=True,
+                 force_auth_field_projection=False, **lookup):
+        """Retrieve a single document, from the identity map if possible."""
+        key = self._identity_key(resource, req, lookup)
+        if (key is None or not check_auth_value or
+                force_auth_field_projection):
+            return super().find_one(
+                resource, req, check_auth_value=check_auth_value,
+                force_auth_field_projection=force_auth_field_projection,
+                **lookup)
+
+        identity_map = _identity_map()
+        if key in identity_map:
+            IdentityMapMongo.saved_queries += 1
+        else:
+            identity_map[key] = super().find_one(resource, req, **lookup)
+        # Callers may modify the document
+        return deepcopy(identity_map[key])
+
+    def find(self, resource, req, sub_resource_lookup, *args, **kwargs):
+        """Find documents, the filters are checked for the request first."""
+        allowed_filters = get_allowed_filters(resource)
+        if (req is not None and req.where and allowed_filters is not None and
+                '*' not in allowed_filters):
+            bad_filter = _validate_filters(
+                _parse_where(req.where),
+                list(allowed_filters) + list(self.operators))
+            if bad_filter:
+                abort(400, bad_filter)
+
+        return super().find(resource, req, sub_resource_lookup,
+                            *args, **kwargs)
+
+    def _datasource_ex(self, resource, query=None, client_projection=None,
+                       client_sort=None, *args, **kwargs):
+        """Add the relevance of text searches to projection and sort."""
+        datasource, query, projection, sort = super()._datasource_ex(
+            resource, query, client_projection, client_sort, *args, **kwargs)
+
+        if _has_text_search(query):
+            score = {'$meta': 'textScore'}
+            projection = dict(projection or {}, _score=score)
+            if not sort:
+                sort = [('_score', score)]
+
+        return datasource, query, projection, sort
+
+    def insert(self, resource, doc_or_docs):
+        """Insert documents, lookups of the new ids are not cached."""
+        ids = super().insert(resource, doc_or_docs)
+        for _id in ids:
+            forget(resource, _id)
+        return ids
+
+    def update(self, resource, id_, updates, original):
+        """Update a document and remove it from the identity map."""
+        forget(resource, id_)
+        return super().update(resource, id_, updates, original)
+
+    def replace(self, resource, id_, document, original):
+        """Replace a document and remove it from the identity map."""
+        forget(resource, id_)
+        return super().replace(resource, id_, document, original)
+
+    def remove(self, resource, lookup):
+        """Remove documents and all documents of the resource from the map."""
+        forget(resource)
+        return super().remove(resource, lookup)
+
+    def _identity_key(self, resource, req, lookup):
+        """Key for lookups by id only, None for all other lookups."""
+        id_field = current_app.config['DOMAIN'][resource]['id_field']
+        if (req is not None or not has_request_context() or
+                list(lookup) != [id_field]):
+            return None
+
+        # Convert string ids like Eve does, so both map to the same document
+        lookup = dict(lookup)
+        self._mongotize(lookup, resource)
+        key = (resource, lookup[id_field])
+        try:
+            hash(key)
+        except TypeError:
+            return None  # e.g. queries like {'$in': [...]}
+        return key
+
+
+def _identity_map():
+    if 'identity_map' not in g:
+        g.identity_map = {}
+    return g.identity_map
+
+
+def forget(resource, _id=None):
+    """Remove a document (or all documents of a resource) from the map.
+
+    Does nothing outside of requests.
+    """
+    if not has_request_context() or 'identity_map' not in g:
+        return
+    if _id is None:
+        for key in [key for key in g.identity_map if key[0] == resource]:
+            del g.identity_map[key]
+    else:
+        g.identity_map.pop((resource, _id), None)
+
+
+def set_allowed_filters(resource, allowed_filters):
+    """Restrict the filters of a resource for the current request.
+
+    Args:
+        resource (str): The resource.
+        allowed_filters (list): Fields which can be used in `where`, in
+            addition to the `allowed_filters` of the domain. `['*']` allows
+            all fields.
+    """
+    if 'allowed_filters' not in g:
+        g.allowed_filters = {}
+    g.allowed_filters[resource] = allowed_filters
+
+
+def get_allowed_filters(resource):
+    """Get the filters allowed for the current request, None if unrestricted.
+    """
+    if not has_request_context():
+        return None
+    return g.get('allowed_filters', {}).get(resource)
+
+
+def _has_text_search(query):
+    """Check for a `$text` query.
+
+    Eve combines the lookup of hooks with other filters using `$and`, so the
+    operator can also be part of a top-level `$and`.
+    """
+    if not isinstance(query, dict):
+        return False
+    return '$text' in query or any(_has_text_search(clause)
+                                   for clause in query.get('$and', []))
+
+
+def _parse_where(where):
+    """Parse `where` like Eve does, errors are reported by Eve later."""
+    try:
+        return json.loads(where)
+    except ValueError:
+        try:
+            return parse(where)
+        except ParseError:
+            return {}
+
+
+def _validate_filters(spec, allowed_filters):
+    """Check all fields in the query like `eve.utils.validate_filters`.
+
+    Returns:
+        str: Error message if a field is not allowed, None otherwise.
+    """
+    if not isinstance(spec, dict):
+        return None
+
+    for key, value in spec.items():
+        if key in ('$or', '$and', '$nor'):
+            # Every clause has to be checked, otherwise a nested clause could
+            # filter on any field
+            if not isinstance(value, list) or not all(
+                    isinstance(sub_spec, dict) for sub_spec in value):
+                return "operator '%s' expects a list of sub-queries" % key
+            for sub_spec in value:
+                error = _validate_filters(sub_spec, allowed_filters)
+                if error:
+                    return error
+            continue
+
+        # Nested fields are allowed if the parent field is allowed
+        parts = key.split('.')
+        if not any('.'.join(parts[:index]) in allowed_filters
+                   for index in range(1, len(parts) + 1)):
+            return "filter on '%s' not allowed" % key
+    return None
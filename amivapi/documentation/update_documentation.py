@@ -127,6 +127,15 @@ def _update_definitions(app):
                 "description": "Show/hide fields in response."
                                "<br />[(Cheatsheet)](#section/Cheatsheet)",
             },
+            'link_methods': {
+                "in": "query",
+                "name": "link_methods",
+                "type": "boolean",
+                "default": True,
+                "description": "Set to `false` to omit the permitted "
+                               "`methods` in `_links`, which makes large "
+                               "responses faster.",
+            },
         },
 
         # Error Responses
@@ -261,7 +270,8 @@ def _update_methods(resource, domain):
             parameters.append('auth')
 
         if method == 'GET':
-            parameters += ['filter', 'max_results', 'page', 'sort']
+            parameters += ['filter', 'max_results', 'page', 'sort',
+                           'link_methods']
 
         if method == 'POST':
             errors.append(422)
@@ -284,7 +294,7 @@ def _update_methods(resource, domain):
             parameters.append('auth')
 
         if method == 'GET':
-            parameters.append('filter')
+            parameters += ['filter', 'link_methods']
 
         if method == 'PATCH':
             errors += [412, 422, 428]
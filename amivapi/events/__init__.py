@@ -10,6 +10,12 @@ logic needed for signup of non members to events.
 
 
 from amivapi.events.authorization import EventAuthValidator
+from amivapi.events.counters import (
+    add_counters_before_insert,
+    count_deleted_signup,
+    count_inserted_signups,
+    count_updated_signup,
+)
 from amivapi.events.emails import (
     add_confirmed_before_insert,
     email_blueprint,
@@ -26,10 +32,14 @@ from amivapi.events.projections import (
 )
 from amivapi.events.queue import (
     add_accepted_before_insert,
+    add_queue_rank_before_insert,
     update_waiting_list_after_delete,
     update_waiting_list_after_insert,
 )
-from amivapi.events.validation import EventValidator
+from amivapi.events.validation import (
+    EventValidator,
+    init_signup_validator_cache,
+)
 from amivapi.events.utils import create_token_secret_on_startup
 from amivapi.utils import register_domain, register_validator
 
@@ -41,6 +51,7 @@ def init_app(app):
     register_domain(app, eventdomain)
     register_validator(app, EventValidator)
     register_validator(app, EventAuthValidator)
+    init_signup_validator_cache(app)
 
     # Show user's email in registered signups
     app.on_fetched_resource_eventsignups += add_email_to_signup_collection
@@ -62,6 +73,16 @@ def init_app(app):
     # Auto accept registrations for fcfs system
     app.on_insert_eventsignups += add_accepted_before_insert
 
+    # Assign the queue rank used to compute the position
+    app.on_insert_eventsignups += add_queue_rank_before_insert
+
+    # Keep signup counters of events up to date. Signups have to be counted
+    # before the waiting list is updated, which relies on the counters
+    app.on_insert_events += add_counters_before_insert
+    app.on_inserted_eventsignups += count_inserted_signups
+    app.on_updated_eventsignups += count_updated_signup
+    app.on_deleted_item_eventsignups += count_deleted_signup
+
     # Update waiting list after insert or delete of signups
     app.on_inserted_eventsignups += update_waiting_list_after_insert
     app.on_deleted_item_eventsignups += update_waiting_list_after_delete
@@ -7,6 +7,7 @@
 from flask import g, current_app
 from datetime import datetime as dt
 from amivapi.auth import AmivTokenAuth
+from amivapi.utils import get_id
 
 
 class EventSignupAuth(AmivTokenAuth):
@@ -19,18 +20,32 @@ class EventSignupAuth(AmivTokenAuth):
 
         Signups of other users are not visible and thus cannot be changed.
         """
-        if isinstance(item['event'], dict):
-            event = item['event']
-        else:
-            # Event is not embedded, get the event first
-            lookup = {current_app.config['ID_FIELD']: item['event']}
-            event = current_app.data.find_one('events', None, **lookup)
+        return self.has_item_write_permission_many(user_id, [item])[0]
 
-        # Remove tzinfo to compare to utcnow (API only accepts UTC anyways)
-        time_register_start = event['time_register_start'].replace(tzinfo=None)
-        time_register_end = event['time_register_end'].replace(tzinfo=None)
+    def has_item_write_permission_many(self, user_id, items):
+        """Check the registration window of all signups.
 
-        return time_register_start <= dt.utcnow() <= time_register_end
+        Events which are not embedded are fetched with a single query.
+        """
+        events = {str(item['event']['_id']): item['event'] for item in items
+                  if isinstance(item['event'], dict)}
+        missing = {get_id(item['event']) for item in items
+                   if not isinstance(item['event'], dict)}
+        missing = [event_id for event_id in missing
+                   if str(event_id) not in events]
+        if len(missing) == 1:
+            # Single event, e.g. for item requests
+            lookup = {current_app.config['ID_FIELD']: missing[0]}
+            events[str(missing[0])] = current_app.data.find_one(
+                'events', None, **lookup)
+        elif missing:
+            fetched = current_app.data.driver.db['events'].find(
+                {'_id': {'$in': missing}},
+                {'time_register_start': 1, 'time_register_end': 1})
+            events.update((str(event['_id']), event) for event in fetched)
+
+        return [_registration_open(events[str(get_id(item['event']))])
+                for item in items]
 
     def has_resource_write_permission(self, user_id):
         """Anyone can sign up. Further requirements are enforced with validators
@@ -42,6 +57,14 @@ class EventSignupAuth(AmivTokenAuth):
         return True
 
 
+def _registration_open(event):
+    # Remove tzinfo to compare to utcnow (API only accepts UTC anyways)
+    time_register_start = event['time_register_start'].replace(tzinfo=None)
+    time_register_end = event['time_register_end'].replace(tzinfo=None)
+
+    return time_register_start <= dt.utcnow() <= time_register_end
+
+
 class EventAuthValidator(object):
     """ Custom validator to check permissions for events. """
 
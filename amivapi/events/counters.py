@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Signup counters stored on events.
+
+Every event stores its `signup_count` and `accepted_count`, so fetching an
+event with its counts needs a single read. The hooks below keep the counters
+up to date with atomic `$inc` updates whenever signups are created, deleted
+or (un)accepted.
+
+Any drift (e.g. from direct database changes) is corrected by
+`reconcile_signup_counts`.
+
+The waiting list reserves spots by increasing `accepted_count` before it
+accepts the signups, see `amivapi.events.queue.admit_waiting_signups`. Until
+the signups are accepted, the counter is ahead of the signups on purpose, so
+events with admissions in progress are not recounted. An admission which does
+not finish (e.g. because the worker crashed) only blocks recounting for
+`ADMISSION_TIMEOUT`.
+"""
+
+from datetime import datetime as dt, timedelta
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from amivapi.cron import periodic
+from amivapi.data import forget
+from amivapi.utils import get_id
+
+
+def increment_signup_counts(event_id, signups=0, accepted=0):
+    """Atomically change the counters of an event."""
+    increments = {key: value for key, value in (('signup_count', signups),
+                                                ('accepted_count', accepted))
+                  if value}
+    if increments:
+        current_app.data.driver.db['events'].update_one(
+            {'_id': get_id(event_id)}, {'$inc': increments})
+        forget('events', get_id(event_id))
+
+
+ADMISSION_TIMEOUT = timedelta(minutes=1)
+
+
+def reserve_accepted(lookup, count):
+    """Increase `accepted_count` for an admission starting now.
+
+    Call `finish_admission` once the signups are accepted.
+
+    Returns:
+        bool: Whether an event matched the lookup.
+    """
+    result = current_app.data.driver.db['events'].update_one(lookup, {
+        '$inc': {'accepted_count': count, '_admissions': 1},
+        '$max': {'_admission_until': dt.utcnow() + ADMISSION_TIMEOUT},
+    })
+    forget('events', lookup['_id'])
+    return result.matched_count > 0
+
+
+def finish_admission(event_id, released=0):
+    """Mark an admission as done and release unused spots."""
+    current_app.data.driver.db['events'].update_one(
+        {'_id': event_id},
+        {'$inc': {'accepted_count': -released, '_admissions': -1}})
+    forget('events', event_id)
+
+
+def _admission_pending(event):
+    return (event.get('_admissions', 0) > 0 and
+            event.get('_admission_until', dt.min) > dt.utcnow())
+
+
+def recount_signups(event_ids=None):
+    """Recount the signups of some or all events and fix the counters.
+
+    Counters are only overwritten if they did not change since they were read,
+    so concurrent `$inc` updates are never lost. Events skipped because of
+    this or because of admissions in progress are corrected on the next run.
+
+    Returns:
+        int: Number of corrected events.
+    """
+    db = current_app.data.driver.db
+    lookup = {} if event_ids is None else {'_id': {'$in': list(event_ids)}}
+
+    # Read counters before counting, see above
+    events = [event for event in db['events'].find(lookup, {
+        'signup_count': 1, 'accepted_count': 1,
+        '_admissions': 1, '_admission_until': 1,
+    }) if not _admission_pending(event)]
+
+    match = {} if event_ids is None else {'event': lookup['_id']}
+    counts = {count['_id']: count for count in db['eventsignups'].aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': '$event',
+            'signup_count': {'$sum': 1},
+            'accepted_count': {'$sum': {'$cond': ['$accepted', 1, 0]}},
+        }},
+    ])}
+
+    updates = []
+    for event in events:
+        count = counts.get(event['_id'], {})
+        current = {key: event.get(key)
+                   for key in ('signup_count', 'accepted_count')}
+        expected = {key: count.get(key, 0) for key in current}
+        # Also remove admissions which did not finish in time
+        if current != expected or event.get('_admissions', 0) > 0:
+            updates.append(UpdateOne(dict(current, _id=event['_id']),
+                                     {'$set': dict(expected, _admissions=0)}))
+
+    if updates:
+        db['events'].bulk_write(updates, ordered=False)
+        forget('events')
+    return len(updates)
+
+
+@periodic(timedelta(hours=1))
+def reconcile_signup_counts():
+    """Correct the counters of all events."""
+    corrected = recount_signups()
+    if corrected:
+        current_app.logger.info("Corrected signup counts of %i events."
+                                % corrected)
+
+
+# Hooks
+
+def add_counters_before_insert(events):
+    """New events have no signups."""
+    for event in events:
+        event['signup_count'] = 0
+        event['accepted_count'] = 0
+
+
+def count_inserted_signups(signups):
+    """Count new signups (before the waiting list accepts any of them)."""
+    for signup in signups:
+        increment_signup_counts(signup['event'], signups=1,
+                                accepted=int(signup.get('accepted', False)))
+
+
+def count_updated_signup(updates, original):
+    """Count signups accepted or unaccepted via PATCH."""
+    if 'accepted' in updates:
+        was_accepted = original.get('accepted', False)
+        increment_signup_counts(original['event'], accepted=(
+            int(updates['accepted']) - int(was_accepted)))
+
+
+def count_deleted_signup(signup):
+    """Remove a deleted signup from the counters."""
+    increment_signup_counts(signup['event'], signups=-1,
+                            accepted=-int(signup.get('accepted', False)))
@@ -453,6 +453,12 @@ eventdomain = {
             'signup_count': {
                 'description': 'Current number of singups',
 
+                'readonly': True,
+                'type': 'integer'
+            },
+            'accepted_count': {
+                'description': 'Current number of accepted signups',
+
                 'readonly': True,
                 'type': 'integer'
             },
@@ -472,6 +478,13 @@ eventdomain = {
 
         'authentication': EventSignupAuth,
 
+        'mongo_indexes': {
+            # Signups are almost always queried per event
+            'event': ([('event', 1)], {'background': True}),
+            'queue_rank': ([('event', 1), ('queue_rank', 1)],
+                           {'background': True}),
+        },
+
         'schema': {
             'event': {
                 'description': "The event to sign up to (must require "
@@ -556,6 +569,15 @@ eventdomain = {
                 'admin_only': True,
                 'default': False,
             },
+            'queue_rank': {
+                'description': "Sequence number of the signup within the "
+                               "event, assigned on signup. Used to compute "
+                               "the `position` of the signup.",
+                'example': 42,
+
+                'type': 'integer',
+                'readonly': True,
+            },
             'checked_in': {
                 'description': "For some events, it might be useful to track "
                                "who is currently attending, i.e. is checked "
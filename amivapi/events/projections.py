@@ -4,8 +4,12 @@
 #          you to buy us beer if we meet and you like the software.
 """Hooks to generate fields in events and eventsignups"""
 
+from bisect import bisect_right
+
 from flask import current_app
 
+from amivapi.utils import get_id
+
 
 def add_email_to_signup(item):
     if 'email' not in item:
@@ -20,30 +24,115 @@ def add_email_to_signup(item):
 
 
 def add_email_to_signup_collection(response):
-    for item in response['_items']:
-        add_email_to_signup(item)
+    """Add emails to all signups of a page with a single query."""
+    items = [item for item in response['_items'] if 'email' not in item]
+
+    # Resolve all users which are not embedded at once
+    user_ids = [item['user'] for item in items
+                if not isinstance(item['user'], dict)]
+    if user_ids:
+        id_field = current_app.config['ID_FIELD']
+        users = current_app.data.driver.db['users'].find(
+            {id_field: {'$in': user_ids}}, {'email': 1})
+        emails = {user[id_field]: user['email'] for user in users}
+    else:
+        emails = {}
+
+    for item in items:
+        if isinstance(item['user'], dict):
+            item['email'] = item['user']['email']
+        else:
+            item['email'] = emails[item['user']]
 
 
 def add_position_to_signup(item):
-    signup_time = item['_created']
-    position = current_app.data.driver.db['eventsignups'].find({
-        '_created': {'$lte': signup_time},
-        'event': item['event']}).count()
-    item['position'] = position
+    """Add the position of the signup in the queue of its event.
+
+    The position is the number of signups of the event with a lower or equal
+    `queue_rank`, which only requires the (event, queue_rank) index.
+
+    Signups without rank (created before ranks existed, until
+    `amivapi rebuild_signup_ranks` is run) are in front of all ranked signups
+    and ordered by creation time, like the waiting list orders them.
+    """
+    event = get_id(item['event'])
+    if item.get('queue_rank') is not None:
+        lookup = {'event': event, '$or': [
+            {'queue_rank': {'$lte': item['queue_rank']}},
+            {'queue_rank': None},
+        ]}
+    else:
+        lookup = {'event': event, 'queue_rank': None,
+                  '_created': {'$lte': item['_created']}}
+    item['position'] = current_app.data.driver.db['eventsignups'].find(
+        lookup).count()
 
 
 def add_position_to_signup_collection(response):
+    """Add positions to all signups of a page with a single query.
+
+    Fetch the ranks of all signups up to the highest rank on the page and
+    the creation times of all signups without rank for every event. The
+    position of each signup is then its index in these lists (see
+    `add_position_to_signup` for the order).
+    """
+    events = {get_id(item['event']) for item in response['_items']}
+    max_ranks = {}
     for item in response['_items']:
-        add_position_to_signup(item)
+        if item.get('queue_rank') is not None:
+            event = get_id(item['event'])
+            max_ranks[event] = max(max_ranks.get(event, 0), item['queue_rank'])
+
+    ranks = {event: [] for event in events}
+    unranked = {event: [] for event in events}
+    if events:
+        lookup = {'$or': [
+            {'event': event, 'queue_rank': {'$lte': max_ranks[event]}}
+            for event in max_ranks
+        ] + [{'event': event, 'queue_rank': None} for event in events]}
+        for signup in current_app.data.driver.db['eventsignups'].find(
+                lookup, {'event': 1, 'queue_rank': 1, '_created': 1}):
+            if signup.get('queue_rank') is None:
+                unranked[signup['event']].append(signup['_created'])
+            else:
+                ranks[signup['event']].append(signup['queue_rank'])
+    for sorted_list in list(ranks.values()) + list(unranked.values()):
+        sorted_list.sort()
+
+    for item in response['_items']:
+        event = get_id(item['event'])
+        if item.get('queue_rank') is not None:
+            item['position'] = (len(unranked[event]) +
+                                bisect_right(ranks[event], item['queue_rank']))
+        else:
+            item['position'] = bisect_right(unranked[event], item['_created'])
 
 
 def add_signup_count_to_event(item):
-    """After an event is fetched from the database we add the current signup
-    count"""
-    item['signup_count'] = current_app.data.driver.db['eventsignups'].find(
-        {'event': item['_id']}).count()
+    """Add the signup count to events without stored counters.
+
+    Counters are stored on the event (see `amivapi.events.counters`), this is
+    only needed for events created before and until the counters are
+    reconciled for the first time.
+    """
+    if 'signup_count' not in item:
+        item['signup_count'] = current_app.data.driver.db[
+            'eventsignups'].find({'event': item['_id']}).count()
 
 
 def add_signup_count_to_event_collection(items):
-    for item in items['_items']:
-        add_signup_count_to_event(item)
+    """Add the signup count to all events of a page without stored counters
+    with one aggregation."""
+    missing = [item for item in items['_items'] if 'signup_count' not in item]
+    if not missing:
+        return
+
+    ids = [item['_id'] for item in missing]
+    counts = current_app.data.driver.db['eventsignups'].aggregate([
+        {'$match': {'event': {'$in': ids}}},
+        {'$group': {'_id': '$event', 'count': {'$sum': 1}}},
+    ])
+    signup_counts = {count['_id']: count['count'] for count in counts}
+
+    for item in missing:
+        item['signup_count'] = signup_counts.get(item['_id'], 0)
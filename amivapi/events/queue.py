@@ -4,11 +4,18 @@
 #          you to buy us beer if we meet and you like the software.
 """Logic to implement different signup queues."""
 
+from bson import ObjectId
 from flask import current_app, url_for
 from itsdangerous import Signer
-from pymongo import ASCENDING
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
 
-from amivapi.utils import mail
+from amivapi.data import forget
+from amivapi.utils import get_id, mail
+from amivapi.events.counters import (
+    finish_admission,
+    recount_signups,
+    reserve_accepted,
+)
 from amivapi.events.utils import get_token_secret
 
 
@@ -28,36 +35,108 @@ def update_waiting_list(event_id):
     lookup = {id_field: event_id}
     event = current_app.data.find_one('events', None, **lookup)
 
-    accepted_ids = []
+    if event['selection_strategy'] != 'fcfs':
+        return []
 
-    if event['selection_strategy'] == 'fcfs':
-        lookup = {'event': event_id, 'accepted': True}
-        signup_count = current_app.data.driver.db['eventsignups'].find(
-            lookup).count()
+    if event.get('accepted_count') is None:
+        # Counters not initialized yet, see `amivapi.events.counters`
+        recount_signups([event[id_field]])
 
-        # 0 spots == infinite spots
-        if event['spots'] == 0 or signup_count < event['spots']:
-            lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
-            new_list = current_app.data.driver.db['eventsignups'].find(
-                lookup).sort('_created', ASCENDING)
+    accepted = admit_waiting_signups(event)
 
-            if event['spots'] > 0:
-                to_accept = new_list.limit(event['spots'] - signup_count)
-            else:
-                # infinite spots, so just accept everyone
-                to_accept = new_list
+    # Notify users
+    title = event.get('title_en', event.get('title_de'))
+    for signup in accepted:
+        notify_signup_accepted(title, signup)
 
-            for new_accepted in to_accept:
-                accepted_ids.append(new_accepted['_id'])
-                # Set accepted flag
-                current_app.data.update('eventsignups', new_accepted[id_field],
-                                        {'accepted': True}, new_accepted)
+    return [signup[id_field] for signup in accepted]
 
-                # Notify user
-                title = event.get('title_en', event.get('title_de'))
-                notify_signup_accepted(title, new_accepted)
 
-    return accepted_ids
+def admit_waiting_signups(event):
+    """Accept confirmed signups from the waiting list while spots are free.
+
+    Spots are reserved atomically by increasing the `accepted_count` of the
+    event with a compare-and-swap, so concurrent workers can never accept
+    more signups than there are spots. The reserved number of signups is then
+    accepted with a single `update_many`. If another worker accepted some of
+    the same signups in the meantime, the unused spots are released and we
+    try again.
+
+    Returns:
+        list: All accepted signups.
+    """
+    db = current_app.data.driver.db
+    event_id = event['_id']
+    spots = event['spots']  # 0 spots == infinite spots
+
+    accepted = []
+    while True:
+        lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
+        waiting = db['eventsignups'].find(lookup, {'_id': 1}).sort(
+            [('queue_rank', ASCENDING), ('_created', ASCENDING)])
+        if spots > 0:
+            waiting = waiting.limit(spots)
+        candidates = [signup['_id'] for signup in waiting]
+        if not candidates:
+            break
+
+        reserved = _reserve_spots(event_id, spots, len(candidates))
+        if not reserved:
+            break
+
+        lost = reserved
+        try:
+            # Mark the batch to find out which signups we accepted
+            batch = ObjectId()
+            lookup = {'_id': {'$in': candidates[:reserved]}}
+            result = db['eventsignups'].update_many(
+                dict(lookup, accepted=False),
+                {'$set': {'accepted': True, '_admission': batch}})
+            lost = reserved - result.modified_count
+        finally:
+            finish_admission(event_id, released=lost)
+
+        for signup_id in candidates[:reserved]:
+            forget('eventsignups', signup_id)
+
+        if result.modified_count:
+            admitted = list(db['eventsignups'].find(
+                dict(lookup, _admission=batch), {'_admission': 0}))
+            db['eventsignups'].update_many({'_admission': batch},
+                                           {'$unset': {'_admission': ''}})
+            accepted.extend(admitted)
+
+        if not lost:
+            # Either everyone was accepted or the event is full
+            break
+
+    return accepted
+
+
+def _reserve_spots(event_id, spots, wanted):
+    """Atomically increase `accepted_count` by up to `wanted` free spots.
+
+    Returns:
+        int: Number of reserved spots.
+    """
+    events = current_app.data.driver.db['events']
+    if spots == 0:
+        reserve_accepted({'_id': event_id}, wanted)
+        return wanted
+
+    while True:
+        current = events.find_one({'_id': event_id},
+                                  {'accepted_count': 1}).get('accepted_count')
+        if current is None:
+            # Counters not initialized (e.g. a concurrent recount failed)
+            recount_signups([event_id])
+            continue
+        reserved = min(wanted, spots - current)
+        if reserved <= 0:
+            return 0
+        if reserve_accepted({'_id': event_id, 'accepted_count': current},
+                            reserved):
+            return reserved
 
 
 def notify_signup_accepted(event_name, signup):
@@ -101,6 +180,58 @@ Hooks that trigger fcfs execution
 """
 
 
+def add_queue_rank_before_insert(signups):
+    """Give every new signup the next sequence number of its event.
+
+    The numbers are taken atomically from a per-event counter, so they are
+    unique and increasing even for concurrent signups. The `position` of a
+    signup is derived from them, see `amivapi.events.projections`.
+    """
+    counters = current_app.data.driver.db['eventsignup_counters']
+    for signup in signups:
+        counter = counters.find_one_and_update(
+            {'_id': signup['event']}, {'$inc': {'sequence': 1}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        signup['queue_rank'] = counter['sequence']
+
+
+def rebuild_queue_ranks(event_id=None):
+    """Renumber the signups of one or all events.
+
+    Signups are ordered by creation time and by their current rank, if they
+    have one. Use this to assign ranks to signups created before ranks
+    existed or to repair ranks after manual database changes.
+
+    The new ranks are reserved from the counter of the event like for new
+    signups, so signups created concurrently never get the same rank. Only
+    the order of ranks matters, they don't need to start at 1.
+
+    Returns:
+        int: Number of events which were renumbered.
+    """
+    db = current_app.data.driver.db
+    lookup = {} if event_id is None else {'event': get_id(event_id)}
+
+    signups_per_event = {}
+    for signup in db['eventsignups'].find(
+            lookup, {'event': 1, 'queue_rank': 1, '_created': 1}):
+        signups_per_event.setdefault(signup['event'], []).append(signup)
+
+    for event, signups in signups_per_event.items():
+        signups.sort(key=lambda signup: (signup['_created'],
+                                         signup.get('queue_rank') or 0,
+                                         signup['_id']))
+        counter = db['eventsignup_counters'].find_one_and_update(
+            {'_id': event}, {'$inc': {'sequence': len(signups)}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        first = counter['sequence'] - len(signups) + 1
+        db['eventsignups'].bulk_write([
+            UpdateOne({'_id': signup['_id']}, {'$set': {'queue_rank': rank}})
+            for rank, signup in enumerate(signups, start=first)])
+
+    return len(signups_per_event)
+
+
 def add_accepted_before_insert(signups):
     """Add the accepted field before inserting signups."""
     for signup in signups:
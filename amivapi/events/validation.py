@@ -11,6 +11,49 @@ from flask import current_app, g, request
 from jsonschema import Draft4Validator, SchemaError
 import pytz
 
+from amivapi.utils import LRUCache
+
+
+def get_signup_validator(event):
+    """Get the compiled validator for the `additional_fields` of an event.
+
+    Compiled validators are cached by event id and `_etag`, so an updated
+    schema is never validated with an outdated validator.
+    """
+    def _compile(_):
+        return Draft4Validator(json.loads(event['additional_fields']))
+
+    cache = current_app.config['signup_validator_cache']
+    return cache.get((str(event['_id']), event.get('_etag')), _compile)
+
+
+def evict_signup_validators(event):
+    """Remove all cached validators of an event."""
+    event_id = str(event['_id'])
+    current_app.config['signup_validator_cache'].evict_where(
+        lambda key, _: key[0] == event_id)
+
+
+def evict_signup_validators_after_update(updates, original):
+    """Hook to remove outdated validators of an updated event."""
+    evict_signup_validators(original)
+
+
+def clear_signup_validators():
+    """Hook to remove all validators if all events are deleted."""
+    current_app.config['signup_validator_cache'].clear()
+
+
+def init_signup_validator_cache(app):
+    """Attach the validator cache to the app and add invalidation hooks."""
+    # Validators are not modified, no need to copy them
+    app.config['signup_validator_cache'] = LRUCache(
+        app.config['SIGNUP_VALIDATOR_CACHE_SIZE'], copy=False)
+
+    app.on_updated_events += evict_signup_validators_after_update
+    app.on_deleted_item_events += evict_signup_validators
+    app.on_deleted_resource_events += clear_signup_validators
+
 
 class EventValidator(object):
     """Custom Validator for event validation rules."""
@@ -56,8 +99,7 @@ class EventValidator(object):
         # Load schema, we can use this without caution because only valid
         # json schemas can be written to the database
         if event is not None:
-            schema = json.loads(event['additional_fields'])
-            validator = Draft4Validator(schema)
+            validator = get_signup_validator(event)
 
             # search for errors and move them into main validator
             for error in validator.iter_errors(data):
@@ -22,7 +22,7 @@ from amivapi.groups.mailing_lists import (
     updated_group,
     updated_user)
 from amivapi.groups.model import groupdomain
-from amivapi.groups.permissions import check_group_permissions
+from amivapi.groups.permissions import clear_permissions, init_permissions
 from amivapi.groups.validation import GroupValidator
 from amivapi.utils import register_domain, register_validator
 
@@ -33,7 +33,7 @@ def init_app(app):
     register_validator(app, GroupValidator)
 
     # authentication
-    app.after_auth += check_group_permissions
+    init_permissions(app)
 
     # email lists
     app.on_inserted_groups += new_groups
@@ -50,3 +50,4 @@ def init_app(app):
 def remove_expired_group_members():
     current_app.data.driver.db['groupmemberships'].remove(
         {'expiry': {'$lte': datetime.utcnow()}})
+    clear_permissions()
@@ -69,6 +69,22 @@ class GroupMembershipAuth(AmivTokenAuth):
                                         {'moderator': 1})
             return user_id == str(group.get('moderator'))
 
+    def has_item_write_permission_many(self, user_id, items):
+        """Check memberships of several groups with a single query."""
+        group_ids = {get_id(item['group']) for item in items
+                     if user_id != str(get_id(item['user']))}
+        if not group_ids:
+            return [True] * len(items)
+
+        collection = current_app.data.driver.db['groups']
+        moderated = {group['_id'] for group in collection.find(
+            {'_id': {'$in': list(group_ids)}}, {'moderator': 1})
+            if user_id == str(group.get('moderator'))}
+
+        return [user_id == str(get_id(item['user'])) or
+                get_id(item['group']) in moderated
+                for item in items]
+
     def create_user_lookup_filter(self, user_id):
         """Lookup for group members.
 
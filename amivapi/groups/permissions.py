@@ -3,12 +3,81 @@
 # license: AGPLv3, see LICENSE for details. In addition we strongly encourage
 #          you to buy us beer if we meet and you like the software.
 
-"""Permissions for group members."""
+"""Permissions for group members.
+
+The permissions of all groups of a user are resolved once into a snapshot
+mapping every resource to the granted permissions, e.g.
+
+    {'users': {'read'}, 'events': {'read', 'readwrite'}}
+
+Snapshots are cached in `app.config['permission_cache']` and invalidated by
+the hooks below whenever groups or memberships change. The hooks also increase
+a version counter in the database, so other processes (e.g. the cron process
+removing expired memberships) clear their caches as well, see
+`PermissionCache`. Changes made directly in the database are noticed when
+snapshots expire after `PERMISSION_CACHE_TTL`.
+"""
+
+from datetime import datetime as dt
+from threading import Lock
 
 from bson import ObjectId
 
 from flask import current_app, g
 
+from amivapi.utils import LRUCache, get_version, increment_version
+
+
+class PermissionCache(LRUCache):
+    """LRU cache of permission snapshots, invalidated across processes.
+
+    Changes are signaled with a version counter in the `config` collection,
+    which is checked at most once per `interval`. If another process has
+    changed permissions in the meantime, the whole cache is cleared.
+
+    Args:
+        maxsize (int): Maximum number of snapshots.
+        ttl (timedelta): Maximum age of a snapshot.
+        interval (timedelta): Time between version checks.
+    """
+
+    def __init__(self, maxsize, ttl, interval):
+        super().__init__(maxsize, ttl)
+        self.interval = interval
+        self._version = None
+        self._checked = None
+        self._version_lock = Lock()
+
+    def check_version(self):
+        """Clear the cache if another process changed permissions."""
+        with self._version_lock:
+            now = dt.utcnow()
+            if (self._checked is not None and
+                    now - self._checked < self.interval):
+                return
+            self._checked = now
+            version = get_version(VERSION_ID)
+            if version != self._version:
+                self.clear()
+                self._version = version
+
+    def changed(self, user_id=None):
+        """Notify other processes and evict a user (or everyone)."""
+        version = increment_version(VERSION_ID)
+        with self._version_lock:
+            # If the counter skipped a version, we missed another change
+            missed = self._version is None or version != self._version + 1
+            self._version = max(version, self._version or 0)
+
+        if user_id is None or missed:
+            self.clear()
+        else:
+            self.evict(user_id)
+
+
+# `_id` of the version counter in the `config` collection
+VERSION_ID = 'PERMISSIONS_VERSION'
+
 
 def check_group_permissions(resource):
     """Retrieve groups for current user and apply permissions for resource.
@@ -20,17 +89,81 @@ def check_group_permissions(resource):
     user = g.get('current_user')
 
     if user:
-        # Find the users groups giving permission for a resource
-        memberships = current_app.data.driver.db['groupmemberships'].find(
-            {'user': ObjectId(user)}, {'group': 1})
-        group_ids = [m['group'] for m in memberships]
-        permission_key = 'permissions.%s' % resource
-        groups = current_app.data.driver.db['groups'].find(
-            {'_id': {'$in': group_ids}, permission_key: {'$exists': True}},
-            {permission_key: 1})
-        permissions = [group['permissions'][resource] for group in groups]
+        permissions = get_permissions(user).get(resource, ())
 
         if 'read' in permissions:
             g.resource_admin_readonly = True
         if 'readwrite' in permissions:
             g.resource_admin = True
+
+
+def get_permissions(user_id):
+    """Get the permission snapshot of a user (str)."""
+    cache = current_app.config['permission_cache']
+    cache.check_version()
+    return cache.get(str(user_id), _resolve_permissions)
+
+
+def _resolve_permissions(user_id):
+    """Merge the permissions of all groups of the user."""
+    db = current_app.data.driver.db
+    memberships = db['groupmemberships'].find({'user': ObjectId(user_id)},
+                                              {'group': 1})
+    group_ids = [m['group'] for m in memberships]
+    groups = db['groups'].find({'_id': {'$in': group_ids}},
+                               {'permissions': 1})
+
+    permissions = {}
+    for group in groups:
+        for resource, permission in (group.get('permissions') or {}).items():
+            permissions.setdefault(resource, set()).add(permission)
+    return permissions
+
+
+# Hooks to invalidate snapshots
+
+def _cache():
+    return current_app.config['permission_cache']
+
+
+def clear_permissions(*_):
+    """Clear all snapshots, e.g. if group permissions change."""
+    _cache().changed()
+
+
+def evict_permissions_of_members(items):
+    """Clear snapshots of users with new memberships."""
+    for item in items:
+        _cache().changed(str(item['user']))
+
+
+def evict_permissions_of_member(item):
+    """Clear the snapshot of a user with removed membership."""
+    _cache().changed(str(item['user']))
+
+
+def evict_permissions_of_user(item):
+    """Clear the snapshot of a deleted user."""
+    _cache().changed(str(item['_id']))
+
+
+def init_permissions(app):
+    """Attach the snapshot cache to the app and add invalidation hooks."""
+    app.config['permission_cache'] = PermissionCache(
+        app.config['PERMISSION_CACHE_SIZE'],
+        app.config['PERMISSION_CACHE_TTL'],
+        app.config['PERMISSION_REFRESH_INTERVAL'])
+
+    app.after_auth += check_group_permissions
+
+    # New groups have no members yet, so only changes matter
+    app.on_updated_groups += clear_permissions
+    app.on_replaced_groups += clear_permissions
+    app.on_deleted_item_groups += clear_permissions
+    app.on_deleted_resource_groups += clear_permissions
+
+    app.on_inserted_groupmemberships += evict_permissions_of_members
+    app.on_deleted_item_groupmemberships += evict_permissions_of_member
+    app.on_deleted_resource_groupmemberships += clear_permissions
+
+    app.on_deleted_item_users += evict_permissions_of_user
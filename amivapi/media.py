@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Media downloads.
+
+Replaces the media endpoint of Eve, which reads requested ranges completely
+into memory. Files are streamed from GridFS chunk by chunk instead:
+
+- A single `Range` is answered with `206 Partial Content`, e.g. to resume
+  downloads of large PDFs. Unsatisfiable ranges get `416`, and multiple
+  ranges are ignored (the complete file is sent).
+- The `ETag` is strong: the stored MD5 if available, otherwise the file id
+  and length. `If-None-Match`, `If-Modified-Since` and `If-Range` are
+  respected.
+- Files are never modified (a new upload gets a new id), so responses can be
+  cached for a long time with `MEDIA_CACHE_CONTROL`.
+"""
+
+from flask import abort, current_app, request, Response
+from werkzeug.http import http_date, parse_range_header
+
+
+def media_endpoint(_id):
+    """Stream a media file."""
+    file_ = current_app.media.get(_id)
+    if file_ is None:
+        return abort(404)
+
+    size = file_.length
+    headers = {
+        'ETag': _etag(file_),
+        'Last-Modified': http_date(file_.upload_date),
+        'Cache-Control': current_app.config['MEDIA_CACHE_CONTROL'],
+        'Accept-Ranges': 'bytes',
+    }
+
+    if _not_modified(file_):
+        file_.close()
+        return Response(status=304, headers=headers)
+
+    start, stop = 0, size
+    status = 200
+    byte_range = _get_range(headers['ETag'])
+    if byte_range is not None:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            file_.close()
+            headers['Content-Range'] = 'bytes */%i' % size
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status = 206
+        headers['Content-Range'] = 'bytes %i-%i/%i' % (start, stop - 1, size)
+
+    headers['Content-Length'] = stop - start
+    return Response(_stream(file_, start, stop),
+                    status=status,
+                    headers=headers,
+                    mimetype=file_.content_type,
+                    direct_passthrough=True)
+
+
+def _etag(file_):
+    """Strong ETag of a stored file."""
+    md5 = getattr(file_, 'md5', None)
+    if md5:
+        return '"%s"' % md5
+    return '"%s-%x"' % (file_._id, file_.length)
+
+
+def _not_modified(file_):
+    """Check `If-None-Match` or, if not given, `If-Modified-Since`."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(_etag(file_).strip('"'))
+
+    if_modified_since = request.if_modified_since
+    if if_modified_since is None:
+        return False
+    # Compare in UTC without timezone, the header has no microseconds
+    return (_naive_utc(if_modified_since) >=
+            _naive_utc(file_.upload_date).replace(microsecond=0))
+
+
+def _get_range(etag):
+    """The requested range, None if the complete file should be sent."""
+    byte_range = parse_range_header(request.headers.get('Range'))
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return None
+
+    # Only send a part if the client has the current version of the file
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range != etag:
+        return None
+
+    return byte_range
+
+
+def _naive_utc(date):
+    if date.tzinfo is not None:
+        date = date.replace(tzinfo=None) - date.utcoffset()
+    return date
+
+
+def _stream(file_, start, stop):
+    """Read the file from `start` to `stop` one GridFS chunk at a time."""
+    try:
+        file_.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = file_.read(min(remaining, file_.chunk_size))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file_.close()
+
+
+def init_app(app):
+    """Replace the media endpoint of Eve."""
+    if 'media' in app.view_functions:
+        app.view_functions['media'] = media_endpoint
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Persistent outbox for mails sent by the API.
+
+Requests do not talk to the SMTP server. `amivapi.utils.mail` only appends
+the mail to the `outbox` collection, which is drained by `amivapi send_mails`
+(see `amivapi.cli`):
+
+- Mails are sent in batches of `MAIL_BATCH_SIZE` over a single SMTP
+  connection, which is reused as long as there are mails to send.
+- Every mail is claimed before sending by moving its `next_attempt` into
+  the future by `MAIL_CLAIM_TIMEOUT`, so several senders never send the
+  same mail, and mails of a crashed sender are sent again later.
+- If sending fails, the mail is retried with exponential backoff starting at
+  `MAIL_RETRY_DELAY`. After `MAIL_MAX_ATTEMPTS` attempts, or if the server
+  refuses all recipients, the mail is dropped and logged.
+"""
+
+from datetime import datetime as dt
+from email.mime.text import MIMEText
+import smtplib
+
+from flask import current_app
+from pymongo import ASCENDING, ReturnDocument
+
+
+def enqueue_mail(sender, to, subject, text):
+    """Append a mail to the outbox."""
+    now = dt.utcnow()
+    current_app.data.driver.db['outbox'].insert_one({
+        'sender': sender,
+        'to': to,
+        'subject': subject,
+        'text': text,
+        'attempts': 0,
+        'next_attempt': now,
+        '_created': now,
+    })
+
+
+class SMTPConnection(object):
+    """Lazily opened SMTP connection, reused for several mails.
+
+    Args:
+        config (dict): App config with the `SMTP_*` settings.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._smtp = None
+
+    def send(self, message):
+        """Send a mail from the outbox, open the connection if needed."""
+        if self._smtp is None:
+            self._smtp = self._connect()
+
+        msg = MIMEText(message['text'])
+        msg['Subject'] = message['subject']
+        msg['From'] = message['sender']
+        msg['To'] = ';'.join(message['to'])
+        self._smtp.sendmail(message['sender'], message['to'], msg.as_string())
+
+    def close(self):
+        """Close the connection, if open."""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass  # Connection is gone already
+            self._smtp = None
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.config['SMTP_SERVER'],
+                            port=self.config['SMTP_PORT'],
+                            timeout=self.config['SMTP_TIMEOUT'])
+        try:
+            status_code, _ = smtp.starttls()
+            if status_code != 220:
+                raise smtplib.SMTPException("Failed to create secure SMTP "
+                                            "connection!")
+
+            username = self.config.get('SMTP_USERNAME')
+            password = self.config.get('SMTP_PASSWORD')
+            if username and password:
+                smtp.login(username, password)
+            else:
+                smtp.ehlo()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+            raise
+        return smtp
+
+
+def claim_mails(limit):
+    """Claim up to `limit` due mails, oldest first."""
+    config = current_app.config
+    outbox = current_app.data.driver.db['outbox']
+
+    claimed = []
+    while len(claimed) < limit:
+        now = dt.utcnow()
+        message = outbox.find_one_and_update(
+            {'next_attempt': {'$lte': now}},
+            {'$set': {'next_attempt': now + config['MAIL_CLAIM_TIMEOUT']}},
+            sort=[('next_attempt', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+        if message is None:
+            break
+        claimed.append(message)
+    return claimed
+
+
+def send_mails(connection):
+    """Send one batch of mails from the outbox.
+
+    Args:
+        connection (SMTPConnection): The connection to use. It stays open,
+            so it can be used for the next batch.
+
+    Returns:
+        int: Number of processed mails (sent or failed).
+    """
+    config = current_app.config
+    outbox = current_app.data.driver.db['outbox']
+    batch = claim_mails(config['MAIL_BATCH_SIZE'])
+
+    for index, message in enumerate(batch):
+        try:
+            connection.send(message)
+        except smtplib.SMTPRecipientsRefused:
+            # Retrying will not help
+            _log_failed_mail(message, "recipients refused")
+        except (smtplib.SMTPException, OSError) as error:
+            # Probably a connection problem. Don't try the rest of the batch
+            # now, as the server is likely unavailable for them as well
+            connection.close()
+            _retry_later(message, error)
+            _release(batch[index + 1:])
+            break
+
+        outbox.delete_one({'_id': message['_id']})
+
+    return len(batch)
+
+
+def _release(messages):
+    """Give up the claim, the messages are sent after the retry delay."""
+    if messages:
+        next_attempt = dt.utcnow() + current_app.config['MAIL_RETRY_DELAY']
+        current_app.data.driver.db['outbox'].update_many(
+            {'_id': {'$in': [message['_id'] for message in messages]}},
+            {'$set': {'next_attempt': next_attempt}})
+
+
+def _retry_later(message, error):
+    config = current_app.config
+    attempts = message['attempts'] + 1
+    if attempts >= config['MAIL_MAX_ATTEMPTS']:
+        _log_failed_mail(message, "%i attempts, last error: %s"
+                         % (attempts, error))
+        current_app.data.driver.db['outbox'].delete_one(
+            {'_id': message['_id']})
+        return
+
+    current_app.logger.warning("SMTP error trying to send mail (attempt %i): "
+                               "%s" % (attempts, error))
+    delay = config['MAIL_RETRY_DELAY'] * 2 ** (attempts - 1)
+    current_app.data.driver.db['outbox'].update_one(
+        {'_id': message['_id']},
+        {'$set': {'attempts': attempts,
+                  'next_attempt': dt.utcnow() + delay}})
+
+
+def _log_failed_mail(message, reason):
+    error = ("Failed to send mail (%s):\n"
+             "From: %s\nTo: %s\n"
+             "Subject: %s\n\n%s")
+    current_app.logger.error(error % (reason, message['sender'],
+                                      str(message['to']),
+                                      message['subject'], message['text']))
+
+
+def init_app(app):
+    """Create the index used to find due mails."""
+    with app.app_context():
+        app.data.driver.db['outbox'].create_index('next_attempt')
@@ -36,7 +36,7 @@ AUTO_CREATE_LISTS = True
 MERGE_NESTED_DOCUMENTS = False
 RESOURCE_METHODS = ['GET', 'POST']
 ITEM_METHODS = ['GET', 'PATCH', 'DELETE']
-RENDERERS = ['eve.render.JSONRenderer']
+RENDERERS = ['amivapi.utils.JSONRenderer']  # Calls `on_render` hooks
 X_DOMAINS = '*'
 X_HEADERS = ['Authorization', 'Content-Type', 'Cache-Control',
              'If-Match', 'If-None-Match', 'If-Modified-Since']
@@ -55,6 +55,9 @@ RETURN_MEDIA_AS_BASE64_STRING = False
 RETURN_MEDIA_AS_URL = True
 MEDIA_URL = 'string'  # Very important to match url properly
 EXTENDED_MEDIA_INFO = ['name', 'content_type', 'length', 'upload_date']
+# Files are never modified (a new upload gets a new id), so downloads can be
+# cached for a long time
+MEDIA_CACHE_CONTROL = 'max-age=31536000, immutable'
 
 # Mailing Lists, local and remote options (by default no storage)
 MAILING_LIST_FILE_PREFIX = '.forward+'  # default file name: .forward+groupname
@@ -69,16 +72,57 @@ SMTP_HOST = 'localhost'
 SMTP_PORT = 587
 SMTP_TIMEOUT = 10
 
+# Mails are stored in an outbox and sent by `amivapi send_mails` in batches
+# over one connection. Failed mails are retried with exponential backoff,
+# starting with RETRY_DELAY. Claimed mails of a crashed sender are sent again
+# after CLAIM_TIMEOUT. With --continuous, the outbox is checked for new mails
+# every POLL_INTERVAL.
+MAIL_BATCH_SIZE = 100
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_DELAY = timedelta(minutes=1)
+MAIL_CLAIM_TIMEOUT = timedelta(minutes=5)
+MAIL_POLL_INTERVAL = timedelta(seconds=5)
+
+# Objects referencing a deleted object are deleted (or updated) in batches
+CASCADE_BATCH_SIZE = 1000
+
 # LDAP
 LDAP_USERNAME = None
 LDAP_PASSWORD = None
 
-# Execution of periodic tasks with `amivapi run cron`
-CRON_INTERVAL = timedelta(minutes=5)  # per default, check tasks every 5 min
+# Execution of periodic tasks with `amivapi cron --continuous`. The scheduler
+# sleeps until the next task is due and wakes up early if a task is scheduled,
+# but it checks for tasks at least every CRON_INTERVAL.
+CRON_INTERVAL = timedelta(minutes=5)
+# Number of tasks run in parallel by every `amivapi cron` process
+CRON_WORKERS = 1
+# Running tasks are hidden from other processes for LEASE_TIMEOUT. Failed
+# tasks are retried with exponential backoff, starting at RETRY_DELAY.
+CRON_LEASE_TIMEOUT = timedelta(minutes=30)
+CRON_RETRY_DELAY = timedelta(minutes=1)
+CRON_MAX_ATTEMPTS = 3
 
 # Security
 ROOT_PASSWORD = u"root"  # Will be overwridden by config.py
 SESSION_TIMEOUT = timedelta(days=365)
+# Tokens are cached in memory to avoid a database lookup for every request.
+# The TTL limits how long a session deleted by another process stays valid.
+# Set the size to 0 to disable the cache.
+SESSION_CACHE_SIZE = 10000
+SESSION_CACHE_TTL = timedelta(seconds=60)
+# Last-used timestamps of sessions and API keys are written in bulk after
+# at most FLUSH_INTERVAL (the maximum staleness) or when FLUSH_SIZE documents
+# are waiting. Set the interval to 0 to write every timestamp immediately.
+TIMESTAMP_FLUSH_INTERVAL = timedelta(seconds=30)
+TIMESTAMP_FLUSH_SIZE = 1000
+# Resolved group permissions per user, invalidated when groups or memberships
+# change. Check for changes by other processes every REFRESH_INTERVAL. The TTL
+# limits how long changes made directly in the database go unnoticed.
+PERMISSION_CACHE_SIZE = 10000
+PERMISSION_CACHE_TTL = timedelta(seconds=60)
+PERMISSION_REFRESH_INTERVAL = timedelta(seconds=10)
+# API keys are kept in memory. Check for changes by other processes this often.
+APIKEY_REFRESH_INTERVAL = timedelta(seconds=10)
 PASSWORD_CONTEXT = CryptContext(
     schemes=["pbkdf2_sha256"],
 
@@ -90,6 +134,23 @@ PASSWORD_CONTEXT = CryptContext(
     # min_rounds is used to determine if a hash needs to be upgraded
     pbkdf2_sha256__min_rounds=8 * 10 ** 2,
 )
+# Hash passwords in a pool of worker processes (0: hash on request thread).
+# Disabled by default: the pool must be configured and only helps with a
+# threaded server (`amivapi run threaded`), bjoern waits for every hash. At
+# most QUEUE_SIZE hashing jobs can be pending, further logins wait up to
+# QUEUE_TIMEOUT and then receive a 503.
+PASSWORD_HASH_WORKERS = 0
+PASSWORD_HASH_QUEUE_SIZE = 32
+PASSWORD_HASH_QUEUE_TIMEOUT = timedelta(seconds=5)
+
+# Compiled validators for the `additional_fields` schemas of events, keyed by
+# event id and _etag. Set the size to 0 to disable the cache.
+SIGNUP_VALIDATOR_CACHE_SIZE = 256
+
+# Summaries of filtered studydocument listings, keyed by the `where`. Cleared
+# on writes, the TTL limits how long writes by other processes go unnoticed.
+STUDYDOC_SUMMARY_CACHE_SIZE = 256
+STUDYDOC_SUMMARY_CACHE_TTL = timedelta(seconds=60)
 
 # Newsletter subscriber list view authorization
 SUBSCRIBER_LIST_USERNAME = None
@@ -12,7 +12,8 @@ from amivapi.studydocs.authorization import (
     add_uploader_on_bulk_insert,
     add_uploader_on_insert
 )
-from amivapi.studydocs.summary import add_summary
+from amivapi.studydocs.search import add_search_to_lookup
+from amivapi.studydocs.summary import init_summary
 from amivapi.studydocs.model import studydocdomain, StudyDocValidator
 from amivapi.utils import register_domain, register_validator
 
@@ -25,4 +26,5 @@ def init_app(app):
     app.on_insert_item_studydocuments += add_uploader_on_insert
     app.on_insert_studydocuments += add_uploader_on_bulk_insert
 
-    app.on_fetched_resource_studydocuments += add_summary
+    app.on_pre_GET_studydocuments += add_search_to_lookup
+    init_summary(app)
@@ -58,6 +58,18 @@ _summary:
 The summary is only computed for documents matching the current `where` query,
 e.g. when searching for ITET documents, only professors related to ITET
 documents will show up in the summary.
+
+<br />
+
+## Search
+
+Use the `search` query parameter to find documents by `title`, `lecture`,
+`professor` and `author`, e.g. `?search=analysis` or `?search="signals and
+systems"` for a phrase. Matches in the title are ranked highest.
+
+The results are sorted by relevance, unless a `sort` is given, and the
+relevance is returned in the `_score` field of each document. The `_summary`
+is computed for the search results and can be combined with a `where` query.
 """)
 
 
@@ -82,9 +94,19 @@ studydocdomain = {
 
         'mongo_indexes': {
             # Create indices for all meta fields to optimize filtering
-            field: ([(field, 1)], {'background': True})
-            for field in ('author', 'departement', 'lecture', 'professor',
-                          'semester', 'type', 'course_year')
+            **{field: ([(field, 1)], {'background': True})
+               for field in ('author', 'departement', 'lecture', 'professor',
+                             'semester', 'type', 'course_year')},
+            # Text index for `?search=`. Documents are in different languages,
+            # so words are not stemmed.
+            'search': (
+                [(field, 'text')
+                 for field in ('title', 'lecture', 'professor', 'author')],
+                {'background': True,
+                 'default_language': 'none',
+                 'weights': {'title': 10, 'lecture': 5, 'professor': 3,
+                             'author': 1}}
+            ),
         },
 
         'schema': {
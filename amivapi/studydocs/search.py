@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Full-text search for studydocuments.
+
+`?search=<terms>` adds a `$text` query, which uses the weighted text index
+of the resource. The data layer sorts such queries by relevance (unless the
+client sorts) and adds the relevance as `_score` to every document.
+"""
+
+from flask import request
+
+
+def get_search_lookup():
+    """Lookup for the search terms of the current request, if any."""
+    search = request.args.get('search', '').strip()
+    return {'$text': {'$search': search}} if search else {}
+
+
+def add_search_to_lookup(request, lookup):
+    """Only return documents matching the search terms."""
+    lookup.update(get_search_lookup())
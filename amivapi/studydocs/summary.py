@@ -2,24 +2,50 @@
 #
 # license: AGPLv3, see LICENSE for details. In addition we strongly encourage
 #          you to buy us beer if we meet and you like the software.
-"""Summarize unique keys to facilitate further studydoc filtering."""
+"""Summarize unique keys to facilitate further studydoc filtering.
 
+The summary of all studydocuments is materialized in the `studydocsummary`
+collection, which holds one counter per field and value. The counters are
+updated by the hooks below whenever studydocuments are written. They are built
+on the first request needing them, which is recorded in a marker document.
+Writes bypassing the hooks (e.g. directly in the database) are corrected by
+`reconcile_summary` every hour or with `amivapi rebuild_studydoc_summary`.
+
+Summaries of filtered listings are aggregated and cached in
+`app.config['studydoc_summary_cache']`, keyed by the normalized `where`. The
+cache is cleared on writes. As other processes can write as well, summaries
+also expire after `STUDYDOC_SUMMARY_CACHE_TTL`.
+"""
+
+from datetime import timedelta
 import json
 
+from bson import json_util
 from werkzeug.exceptions import HTTPException
 from flask import current_app
 from eve.utils import parse_request
 from eve.io.mongo.parser import parse
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from amivapi.cron import periodic
+from amivapi.studydocs.search import get_search_lookup
+from amivapi.utils import LRUCache
 
 
 def add_summary(response):
     """Add summary to response."""
     # Get the where clause to return summary only for matching documents
-    lookup = _get_lookup()
+    lookup = dict(_get_lookup(), **get_search_lookup())
 
-    # Compute distinct values per field (remove fields without any values)
-    summary = {fieldname: _count_distinct(lookup, fieldname)
-               for fieldname in _summary_fields()}
+    if lookup:
+        summary = _cache().get(json_util.dumps(lookup, sort_keys=True),
+                               lambda _: _count_distinct(lookup,
+                                                         _summary_fields()))
+    else:
+        summary = _materialized_summary()
+
+    # Remove fields without any values
     response['_summary'] = {k: v for k, v in summary.items() if v}
 
 
@@ -31,14 +57,182 @@ def _summary_fields():
     ]
 
 
-def _count_distinct(lookup, fieldname):
-    """Use mongodb aggregation to count distinct values."""
+def _cache():
+    return current_app.config['studydoc_summary_cache']
+
+
+def _collection():
+    return current_app.data.driver.db['studydocsummary']
+
+
+# `_id` of the document marking that the counters have been built
+INITIALIZED = 'initialized'
+
+
+def _materialized_summary():
+    """Read the counters of all studydocuments, build them if needed."""
+    # Read the marker with the counters to save a query
+    counters = list(_collection().find(
+        {'$or': [{'count': {'$gt': 0}}, {'_id': INITIALIZED}]}))
+    if not any(counter['_id'] == INITIALIZED for counter in counters):
+        rebuild_summary()
+        try:
+            _collection().insert_one({'_id': INITIALIZED})
+        except DuplicateKeyError:
+            pass  # Another worker was faster
+        counters = _collection().find({'count': {'$gt': 0}})
+
+    summary = {}
+    for counter in counters:
+        if counter['_id'] != INITIALIZED:
+            summary.setdefault(counter['field'], {})[counter['value']] = \
+                counter['count']
+    return summary
+
+
+def rebuild_summary():
+    """Recompute all counters from the studydocuments.
+
+    Counters are upserted, so several workers can rebuild at the same time.
+    Changes by hooks running during the rebuild can be overwritten, they are
+    corrected by the next rebuild.
+    """
+    collection = _collection()
+    summary = _count_distinct({}, _summary_fields())
+    _upsert([
+        UpdateOne({'field': field, 'value': value}, {'$set': {'count': count}},
+                  upsert=True)
+        for field, counts in summary.items()
+        for value, count in counts.items()
+    ])
+    # Remove counters of values which do not exist anymore
+    existing = [{'field': field, 'value': {'$in': list(counts)}}
+                for field, counts in summary.items()]
+    stale = {'field': {'$exists': True}}
+    if existing:
+        stale['$nor'] = existing
+    collection.delete_many(stale)
+    _cache().clear()
+
+
+@periodic(timedelta(hours=1))
+def reconcile_summary():
+    """Correct counters changed without hooks, if they have been built."""
+    if _collection().find_one({'_id': INITIALIZED}) is not None:
+        rebuild_summary()
+
+
+def _upsert(operations):
+    """Bulk write upserts and retry those which failed because another
+    process inserted the same counter at the same time."""
+    if not operations:
+        return
+    try:
+        _collection().bulk_write(operations, ordered=False)
+    except BulkWriteError as error:
+        errors = error.details['writeErrors']
+        if any(item['code'] != 11000 for item in errors):
+            raise
+        # The counters exist now, so the retried upserts only update them
+        _collection().bulk_write(
+            [operations[item['index']] for item in errors], ordered=False)
+
+
+def _update_counters(increments):
+    """Apply a list of (field, value, increment) to the counters."""
+    increments = [(field, value, inc) for field, value, inc in increments
+                  if value is not None]
+    _cache().clear()
+    if not increments:
+        return
+
+    _upsert([
+        UpdateOne({'field': field, 'value': value}, {'$inc': {'count': inc}},
+                  upsert=True)
+        for field, value, inc in increments
+    ])
+    _collection().delete_many({'count': {'$lte': 0}})
+
+
+def _changes(old, new):
+    """Counter increments to get from document `old` to document `new`."""
+    increments = []
+    for field in _summary_fields():
+        old_value, new_value = old.get(field), new.get(field)
+        if old_value != new_value:
+            increments += [(field, old_value, -1), (field, new_value, 1)]
+    return increments
+
+
+def update_summary_on_inserted(items):
+    """Count the values of new studydocuments."""
+    _update_counters([increment for item in items
+                      for increment in _changes({}, item)])
+
+
+def update_summary_on_updated(updates, original):
+    """Move the counts of changed values."""
+    _update_counters(_changes(original, dict(original, **updates)))
+
+
+def update_summary_on_replaced(document, original):
+    """Move the counts of changed values."""
+    _update_counters(_changes(original, document))
+
+
+def update_summary_on_deleted_item(item):
+    """Remove the values of a deleted studydocument."""
+    _update_counters(_changes(item, {}))
+
+
+def clear_summary(*_):
+    """Remove all counters after all studydocuments have been deleted."""
+    _collection().delete_many({'field': {'$exists': True}})
+    _cache().clear()
+
+
+def init_summary(app):
+    """Attach the cache and add hooks. The counters are built on first use.
+    """
+    app.config['studydoc_summary_cache'] = LRUCache(
+        app.config['STUDYDOC_SUMMARY_CACHE_SIZE'],
+        app.config['STUDYDOC_SUMMARY_CACHE_TTL'])
+
+    app.on_fetched_resource_studydocuments += add_summary
+
+    app.on_inserted_studydocuments += update_summary_on_inserted
+    app.on_updated_studydocuments += update_summary_on_updated
+    app.on_replaced_studydocuments += update_summary_on_replaced
+    app.on_deleted_item_studydocuments += update_summary_on_deleted_item
+    app.on_deleted_resource_studydocuments += clear_summary
+
+    with app.app_context():
+        app.data.driver.db['studydocsummary'].create_index(
+            [('field', 1), ('value', 1)], unique=True)
+
+
+def _count_distinct(lookup, fieldnames):
+    """Use a single mongodb aggregation to count distinct values of all fields.
+
+    The matching documents are only scanned once, and grouped by every field
+    in a separate facet.
+    """
+    if not fieldnames:
+        return {}
+
     aggregation = current_app.data.driver.db['studydocuments'].aggregate([
         {'$match': lookup},
-        {'$group': {'_id': '$' + fieldname, '_count': {'$sum': 1}}},
+        {'$facet': {
+            fieldname: [
+                {'$group': {'_id': '$' + fieldname, '_count': {'$sum': 1}}},
+            ] for fieldname in fieldnames
+        }},
     ])
-    return {item['_id']: item['_count'] for item in aggregation
-            if item['_id'] is not None}
+    facets = next(aggregation, {})
+    return {fieldname: {item['_id']: item['_count']
+                        for item in facets.get(fieldname, [])
+                        if item['_id'] is not None}
+            for fieldname in fieldnames}
 
 
 def _get_lookup():
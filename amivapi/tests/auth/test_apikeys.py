@@ -4,6 +4,11 @@
 #          you to buy us beer if we meet and you like the software.
 """Test apikey authorization."""
 
+from datetime import datetime
+from threading import Barrier, Thread
+
+from freezegun import freeze_time
+
 from amivapi.tests.utils import WebTest, WebTestNoAuth
 
 
@@ -131,3 +136,78 @@ class ApiKeyModelTests(WebTestNoAuth):
         self.api.post("/apikeys", data=wrong_value, status_code=422)
         self.api.post("/apikeys", data=read_ok, status_code=201)
         self.api.post("/apikeys", data=readwrite_ok, status_code=201)
+
+
+class ApiKeyRegistryTest(WebTest):
+    """Test that the in-memory registry follows changes of API keys."""
+
+    def test_delete_revokes_key(self):
+        """A deleted key is rejected immediately."""
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+        self.api.get('/apikeys', token=key['token'], status_code=200)
+
+        self.api.delete('/apikeys/%s' % key['_id'],
+                        headers={'If-Match': key['_etag']},
+                        token=self.get_root_token(), status_code=204)
+        self.api.get('/apikeys', token=key['token'], status_code=401)
+
+    def test_update_changes_permissions(self):
+        """Updated permissions are used immediately."""
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+        self.api.get('/users', token=key['token'], status_code=403)
+
+        self.api.patch('/apikeys/%s' % key['_id'],
+                       data={'permissions': {'users': 'read'}},
+                       headers={'If-Match': key['_etag']},
+                       token=self.get_root_token(), status_code=200)
+        self.api.get('/users', token=key['token'], status_code=200)
+
+    def test_changes_by_other_processes(self):
+        """Changes signaled by the version counter are picked up after the
+        refresh interval."""
+        interval = self.app.config['APIKEY_REFRESH_INTERVAL']
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+
+        with freeze_time(datetime.utcnow()) as frozen_time:
+            self.api.get('/apikeys', token=key['token'], status_code=200)
+
+            # Simulate another process deleting the key
+            self.db['apikeys'].delete_one({'_id': key['_id']})
+            self.db['config'].update_one(
+                {'_id': 'APIKEYS_VERSION'},
+                {'$inc': {'APIKEYS_VERSION': 1}})
+
+            self.api.get('/apikeys', token=key['token'], status_code=200)
+            frozen_time.tick(delta=interval)
+            self.api.get('/apikeys', token=key['token'], status_code=401)
+
+    def test_concurrent_changes(self):
+        """Concurrent changes use a single version counter and all threads
+        see a complete map of keys."""
+        keys = [self.new_object("apikeys", permissions={'apikeys': 'read'})
+                for _ in range(5)]
+        self.db['config'].delete_many({'_id': 'APIKEYS_VERSION'})
+        registry = self.app.config['apikey_registry']
+
+        threads = 10
+        barrier = Barrier(threads)
+        missing = []
+
+        def change_and_lookup():
+            with self.app.app_context():
+                barrier.wait()
+                registry.changed()
+                missing.extend(key['_id'] for key in keys
+                               if registry.get(key['token']) is None)
+
+        workers = [Thread(target=change_and_lookup) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(missing, [])
+        versions = list(self.db['config'].find(
+            {'APIKEYS_VERSION': {'$exists': True}}))
+        self.assertEqual(len(versions), 1)
+        self.assertGreaterEqual(versions[0]['APIKEYS_VERSION'], threads)
@@ -26,6 +26,7 @@ from amivapi.auth.auth import (
     only_amiv_token_auth,
     only_if_auth_required
 )
+from amivapi.auth.timestamps import flush_timestamps
 from amivapi.tests.auth.fake_auth import FakeAuthTest
 from amivapi.tests.utils import WebTest
 
@@ -303,6 +304,8 @@ class AuthFunctionTest(FakeAuthTest):
             with self.app.test_request_context(
                     headers={'Authorization': session['token']}):
                 authenticate()
+                # Timestamps are written in bulk, force writing now
+                flush_timestamps()
 
                 # g.current_user shoudl be a string
                 expected_user = str(session['user'])
@@ -16,7 +16,7 @@ Note on link setup. The links in eve are a little inconsistent
 from copy import deepcopy
 import json
 
-from flask import g, Response
+from flask import g
 
 from amivapi.auth.link_methods import (
     add_methods_to_item_links,
@@ -29,11 +29,7 @@ from amivapi.auth.link_methods import (
 )
 from amivapi.tests.auth.fake_auth import FakeAuthTest
 from amivapi.tests.utils import WebTest
-
-
-def get_response_data(response):
-    """Helper to check data of response object."""
-    return json.loads(response.get_data(as_text=True))
+from amivapi.utils import JSONRenderer
 
 
 class LinkTest(FakeAuthTest):
@@ -255,42 +251,41 @@ class LinkTest(FakeAuthTest):
 
     def test_add_permitted_methods_after_update(self):
         """Test update hook."""
-        data = {
+        data_template = {
             '_id': 'something',
             '_links': {
                 'self': {},
             }
         }
 
-        response = Response(json.dumps(data))
+        data = deepcopy(data_template)
 
         with self.app.app_context():
             # Nothing without amiv auth
             for resource in ['fake_nothing', 'fake_no_amiv']:
-                add_permitted_methods_after_update(resource, None, response)
-                response_data = get_response_data(response)
-                self.assertEqual(response_data, data)
+                add_permitted_methods_after_update(resource, None, data)
+                self.assertEqual(data, data_template)
 
-            add_permitted_methods_after_update('fake', None, response)
-            response_data = get_response_data(response)
-            self.assertMethodsAdded(response_data)
+            add_permitted_methods_after_update('fake', None, data)
+            self.assertMethodsAdded(data)
 
     def test_no_methods_after_patch_error(self):
-        """Test that no methods are added for errors."""
-        data = "somethingsomething error"
-        response = Response(data)
-        response.status_code = 400
+        """Test that render hooks are not called for errors."""
+        data = {'_status': 'ERR', '_error': 'somethingsomething error'}
+        self.app.on_render_PATCH += add_permitted_methods_after_update
+
+        with self.app.test_request_context(method='PATCH'):
+            rendered = JSONRenderer().render(data)
 
-        add_permitted_methods_after_update('fale', None, response)
-        self.assertEqual(data, response.get_data().decode('utf-8'))
+        self.assertEqual(json.loads(rendered), data)
 
     # Test home endpoint links
 
     def test_link_methods_read_home(self):
         """Check link methods for home endpoint.
 
-        We have no dedicated hook here, instead a generic post GET hook will
-        parse and modify the flask response.
+        We have no dedicated hook here, instead a generic render GET hook will
+        modify the payload.
         """
         # Copy the fake resource so we can use the second one as admin resource
         self.app.config['DOMAIN']['fake_2'] = self.app.config['DOMAIN']['fake']
@@ -303,8 +298,6 @@ class LinkTest(FakeAuthTest):
             {'href': "fake_nothing"},
         ]}}
 
-        response = Response(json.dumps(response_data))
-
         # Add a hook that set resource admin for second resource
         # In reality a group or something would do this.
         def admin_hook(resource):
@@ -314,9 +307,9 @@ class LinkTest(FakeAuthTest):
         self.app.after_auth += admin_hook
 
         with self.app.test_request_context():
-            add_permitted_methods_for_home(None, None, response)
+            add_permitted_methods_for_home(None, None, response_data)
 
-            links = get_response_data(response)['_links']['child']
+            links = response_data['_links']['child']
 
             # No admin, public methods
             self.assertItemsEqual(links[0]['methods'],
@@ -452,6 +445,18 @@ class LinkIntegrationTest(WebTest):
         self.assertItemsEqual(self._get_methods(response, 'self'),
                               ['GET', 'HEAD', 'OPTIONS'])
 
+    def test_omit_link_methods(self):
+        """Test that clients can omit the methods in all links."""
+        for url in ('/', '/users', '/users/' + self.user_id):
+            response = self.api.get(url + '?link_methods=false',
+                                    token=self.user_token,
+                                    status_code=200).json
+
+            for item in [response] + response.get('_items', []):
+                for link in item['_links'].values():
+                    for link in (link if isinstance(link, list) else [link]):
+                        self.assertNotIn('methods', link)
+
     def test_item_admin(self):
         """Test GET on item for user with permissions."""
         response = self.api.get("/users/" + self.other_user_id,
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the in-process session cache."""
+
+from datetime import datetime, timedelta
+
+from freezegun import freeze_time
+
+from amivapi.auth.session_cache import SessionCache, get_identity
+from amivapi.auth.sessions import delete_expired_sessions
+from amivapi.tests.utils import WebTest
+
+
+class SessionCacheTest(WebTest):
+    """Test that sessions are cached and evicted correctly."""
+
+    def _cache(self):
+        return self.app.config['session_cache']
+
+    def test_hits_and_misses(self):
+        """Only the first request with a token queries the database."""
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+        cache = self._cache()
+
+        self.api.get('/users/%s' % user['_id'], token=token, status_code=200)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        self.api.get('/users/%s' % user['_id'], token=token, status_code=200)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_unknown_tokens_are_cached(self):
+        """Tokens without session are cached as well."""
+        cache = self._cache()
+
+        for _ in range(3):
+            self.api.get('/users', token='unknown', status_code=401)
+
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_evict_on_delete(self):
+        """Deleting a session via /sessions removes it from the cache."""
+        user = self.new_object('users', password='password')
+        session = self.new_object('sessions', username=str(user['_id']),
+                                  password='password')
+        token = session['token']
+
+        self.api.get('/sessions', token=token, status_code=200)
+        self.api.delete('/sessions/%s' % session['_id'], token=token,
+                        headers={'If-Match': session['_etag']},
+                        status_code=204)
+        self.api.get('/sessions', token=token, status_code=401)
+
+    def test_evict_on_user_delete(self):
+        """All sessions of a deleted user are removed from the cache."""
+        user = self.new_object('users')
+        tokens = [self.get_user_token(user['_id']) for _ in range(2)]
+
+        for token in tokens:
+            self.api.get('/users/%s' % user['_id'], token=token,
+                         status_code=200)
+
+        self.api.delete('/users/%s' % user['_id'], token=self.get_root_token(),
+                        headers={'If-Match': user['_etag']}, status_code=204)
+
+        for token in tokens:
+            self.api.get('/users', token=token, status_code=401)
+
+    def test_membership_is_cached(self):
+        """The membership is loaded once per session and reloaded after it
+        is changed via the API."""
+        user = self.new_object('users', membership='none')
+        self.new_object('users', membership='regular')
+        token = self.get_user_token(user['_id'])
+
+        def visible_users():
+            return len(self.api.get('/users', token=token,
+                                    status_code=200).json['_items'])
+        self.assertEqual(visible_users(), 1)
+
+        # Changes in the database are not noticed until the TTL expires
+        self.db['users'].update_one({'_id': user['_id']},
+                                    {'$set': {'membership': 'regular'}})
+        self.assertEqual(visible_users(), 1)
+
+        # Changes via the API evict the session
+        user = self.api.get('/users/%s' % user['_id'], token=token,
+                            status_code=200).json
+        self.api.patch('/users/%s' % user['_id'],
+                       data={'membership': 'honorary'},
+                       headers={'If-Match': user['_etag']},
+                       token=self.get_root_token(), status_code=200)
+        self.assertEqual(visible_users(), 2)
+
+    def test_identity_without_session(self):
+        """Without session, the identity is loaded once per request and
+        requests without user don't query the database."""
+        user = self.new_object('users', membership='regular')
+
+        with self.app.test_request_context():
+            self.assertEqual(get_identity(None), {})
+            self.assertEqual(get_identity(str(user['_id'])),
+                             {'membership': 'regular'})
+
+            self.db['users'].update_one({'_id': user['_id']},
+                                        {'$set': {'membership': 'none'}})
+            self.assertEqual(get_identity(str(user['_id'])),
+                             {'membership': 'regular'})
+
+        with self.app.test_request_context():
+            self.assertEqual(get_identity(str(user['_id'])),
+                             {'membership': 'none'})
+
+    def test_expired_sessions_are_not_used(self):
+        """Cached sessions exceeding SESSION_TIMEOUT are not valid."""
+        timeout = self.app.config['SESSION_TIMEOUT']
+        user = self.new_object('users')
+
+        with freeze_time(datetime.utcnow()) as frozen_time:
+            token = self.get_user_token(user['_id'])
+            self.api.get('/users/%s' % user['_id'], token=token,
+                         status_code=200)
+
+            frozen_time.tick(delta=timeout + timedelta(days=1))
+            with self.app.app_context():
+                delete_expired_sessions()
+
+            self.assertEqual(self._cache().stats()['size'], 0)
+            self.api.get('/users', token=token, status_code=401)
+
+    def test_ttl_and_size(self):
+        """Entries expire after the TTL and the least recently used entry is
+        evicted when the cache is full."""
+        cache = SessionCache(2, timedelta(seconds=10))
+        sessions = {token: {'user': token, 'token': token}
+                    for token in ('a', 'b', 'c')}
+
+        with freeze_time(datetime.utcnow()) as frozen_time:
+            for token in 'a', 'b', 'a', 'c':
+                cache.get(token, sessions.get)
+            # 'b' was least recently used
+            self.assertEqual(cache.stats()['size'], 2)
+            cache.get('b', sessions.get)
+            self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+            frozen_time.tick(delta=timedelta(seconds=11))
+            cache.get('b', sessions.get)
+            self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+    def test_eviction_during_load(self):
+        """A value loaded before an eviction is not stored."""
+        cache = SessionCache(10)
+
+        def load_and_evict(token):
+            # E.g. another thread deletes the session during the query
+            session = {'user': 'user', 'token': token}
+            cache.evict(token)
+            return session
+
+        self.assertIsNotNone(cache.get('a', load_and_evict))
+        self.assertEqual(cache.stats()['size'], 0)
+
+        cache.get('a', lambda token: {'user': 'user', 'token': token})
+        self.assertEqual(cache.stats()['size'], 1)
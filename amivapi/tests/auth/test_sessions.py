@@ -4,6 +4,8 @@
 #          you to buy us beer if we meet and you like the software.
 """Tests for session."""
 
+from datetime import timedelta
+
 from bson import ObjectId
 from passlib.context import CryptContext
 from passlib.hash import pbkdf2_sha256
@@ -275,3 +277,40 @@ class PasswordVerificationTest(WebTest):
 
         # Check database
         self.assertRehashed(user_id, password, weak_hash)
+
+
+class PasswordHashingPoolTest(WebTest):
+    """Test hashing passwords in worker processes."""
+
+    def setUp(self):
+        super().setUp(PASSWORD_HASH_WORKERS=2,
+                      PASSWORD_HASH_QUEUE_SIZE=1,
+                      PASSWORD_HASH_QUEUE_TIMEOUT=timedelta(seconds=0))
+        self.hasher = self.app.config['password_hasher']
+
+    def tearDown(self):
+        self.hasher.shutdown()
+        super().tearDown()
+
+    def test_login(self):
+        """Passwords hashed and verified by the pool work for login."""
+        user = self.new_object('users', password='password')
+        self.assertTrue(pbkdf2_sha256.verify('password', self.db['users']
+                                             .find_one()['password']))
+
+        self.api.post('/sessions', data={'username': str(user['_id']),
+                                         'password': 'password'},
+                      status_code=201)
+        self.api.post('/sessions', data={'username': str(user['_id']),
+                                         'password': 'wrong'},
+                      status_code=401)
+
+    def test_full_queue(self):
+        """Logins are rejected if the hashing queue is full."""
+        user = self.new_object('users', password='password')
+
+        # Occupy the only slot in the queue
+        with self.hasher.slot():
+            self.api.post('/sessions', data={'username': str(user['_id']),
+                                             'password': 'password'},
+                          status_code=503)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the write-behind buffer of session and API key timestamps."""
+
+from datetime import datetime, timedelta
+import signal
+from time import sleep
+from unittest.mock import MagicMock, patch
+
+from freezegun import freeze_time
+
+from amivapi.auth.sessions import delete_expired_sessions
+from amivapi.auth import timestamps
+from amivapi.auth.timestamps import TimestampBuffer
+from amivapi.tests.utils import WebTest
+
+
+class TimestampBufferTest(WebTest):
+    """Test that timestamps are coalesced and flushed."""
+
+    def setUp(self):
+        super().setUp(TIMESTAMP_FLUSH_INTERVAL=timedelta(seconds=30),
+                      TIMESTAMP_FLUSH_SIZE=2)
+
+    def _db_timestamp(self, collection, _id):
+        return self.db[collection].find_one({'_id': _id})['_updated']
+
+    def test_flush_after_interval(self):
+        """Timestamps are written once the interval has passed."""
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+        session_id = self.db['sessions'].find_one({'token': token})['_id']
+
+        with freeze_time(datetime.utcnow()) as frozen_time:
+            self.api.get('/users', token=token, status_code=200)
+            self.assertNotIn('_updated',
+                             self.db['sessions'].find_one({'_id': session_id}))
+
+            frozen_time.tick(delta=timedelta(seconds=31))
+            self.api.get('/users', token=token, status_code=200)
+            self.assertEqual(self._db_timestamp('sessions', session_id),
+                             datetime.utcnow().replace(microsecond=0))
+
+    def test_flush_after_size(self):
+        """Timestamps are written once enough documents are waiting."""
+        user = self.new_object('users')
+        key = self.new_object('apikeys', permissions={'users': 'read'})
+        token = self.get_user_token(user['_id'])
+        session_id = self.db['sessions'].find_one({'token': token})['_id']
+        key_updated = self._db_timestamp('apikeys', key['_id'])
+
+        with freeze_time(datetime.utcnow() + timedelta(seconds=5)):
+            # Same session multiple times: only one document is waiting
+            for _ in range(3):
+                self.api.get('/users', token=token, status_code=200)
+            self.assertNotIn('_updated',
+                             self.db['sessions'].find_one({'_id': session_id}))
+
+            # Second document
+            self.api.get('/users', token=key['token'], status_code=200)
+            now = datetime.utcnow().replace(microsecond=0)
+            self.assertEqual(self._db_timestamp('sessions', session_id), now)
+            self.assertEqual(self._db_timestamp('apikeys', key['_id']), now)
+            self.assertGreater(now, key_updated)
+
+    def test_session_expiry(self):
+        """Buffered usage is written before expired sessions are removed."""
+        timeout = self.app.config['SESSION_TIMEOUT']
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+        session_id = self.db['sessions'].find_one({'token': token})['_id']
+
+        with freeze_time(datetime.utcnow()) as frozen_time, \
+                self.app.app_context():
+            used = datetime.utcnow().replace(microsecond=0)
+            self.api.get('/users', token=token, status_code=200)
+
+            frozen_time.tick(delta=timeout - timedelta(days=1))
+            delete_expired_sessions()
+            self.assertEqual(self._db_timestamp('sessions', session_id), used)
+
+            frozen_time.tick(delta=timedelta(days=2))
+            delete_expired_sessions()
+            self.assertEqual(self.db['sessions'].count_documents({}), 0)
+            self.api.get('/users', token=token, status_code=401)
+
+    def test_flush_in_background(self):
+        """Idle workers flush their timestamps after the interval as well."""
+        user = self.new_object('users')
+        session_id = self.db['sessions'].find_one(
+            {'token': self.get_user_token(user['_id'])})['_id']
+        used = datetime.utcnow().replace(microsecond=0)
+
+        buffer = TimestampBuffer(self.app, timedelta(milliseconds=50), 1000)
+        buffer.record('sessions', session_id, used)
+        buffer.start()
+        try:
+            for _ in range(100):
+                if '_updated' in self.db['sessions'].find_one(
+                        {'_id': session_id}):
+                    break
+                sleep(0.05)
+        finally:
+            buffer.stop()
+
+        self.assertEqual(self._db_timestamp('sessions', session_id), used)
+
+    def test_flush_on_signal(self):
+        """On termination, the flushing thread flushes before the previous
+        signal handler is called."""
+        user = self.new_object('users')
+        session_id = self.db['sessions'].find_one(
+            {'token': self.get_user_token(user['_id'])})['_id']
+        used = datetime.utcnow().replace(microsecond=0)
+
+        buffer = TimestampBuffer(self.app, timedelta(hours=1), 1000)
+        buffer.record('sessions', session_id, used)
+        buffer.start()
+
+        previous = MagicMock()
+        with patch.object(timestamps, '_buffers', {buffer}), \
+                patch.dict(timestamps._previous_handlers,
+                           {signal.SIGTERM: previous}):
+            timestamps._flush_on_signal(signal.SIGTERM, None)
+
+        previous.assert_called_once_with(signal.SIGTERM, None)
+        self.assertEqual(self._db_timestamp('sessions', session_id), used)
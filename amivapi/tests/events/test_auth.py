@@ -241,3 +241,32 @@ class EventAuthTest(WebTest):
                        data={'checked_in': 'True'},
                        headers={'If-Match': etag},
                        status_code=200)
+
+    def test_registration_window_link_methods(self):
+        """Test that the methods of a page of signups follow the registration
+        window of each event."""
+        user = self.new_object("users")
+        token = self.get_user_token(user['_id'])
+
+        events = [self.new_object("events", spots=100,
+                                  time_register_start=datetime(2016, 1, 1),
+                                  time_register_end=end)
+                  for end in (datetime(2016, 12, 31), datetime(2016, 12, 31),
+                              datetime(2016, 3, 1))]
+        open_events = [str(event['_id']) for event in events[:2]]
+        for event in events:
+            self.new_object("eventsignups", event=event['_id'],
+                            user=user['_id'])
+
+        with freeze_time(datetime(2016, 6, 1)):
+            for embedded in ('', '?embedded={"event":1}'):
+                signups = self.api.get("/eventsignups" + embedded,
+                                       token=token,
+                                       status_code=200).json['_items']
+                self.assertEqual(len(signups), 3)
+                for signup in signups:
+                    event_id = (signup['event']['_id'] if embedded
+                                else signup['event'])
+                    methods = signup['_links']['self']['methods']
+                    self.assertEqual('DELETE' in methods,
+                                     event_id in open_events)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Test the signup counters stored on events."""
+
+from datetime import timedelta
+
+from freezegun import freeze_time
+
+from amivapi.cron import run_scheduled_tasks
+from amivapi.events.counters import (
+    ADMISSION_TIMEOUT,
+    finish_admission,
+    recount_signups,
+    reserve_accepted,
+)
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class SignupCounterTest(WebTestNoAuth):
+    def assertCounts(self, event, signup_count, accepted_count):
+        stored = self.db['events'].find_one({'_id': event['_id']})
+        self.assertEqual(stored['signup_count'], signup_count)
+        self.assertEqual(stored['accepted_count'], accepted_count)
+
+    def test_counters_follow_signups(self):
+        """Test that signups, accepting and deleting update the counters."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        self.assertCounts(event, 0, 0)
+
+        first, second = (self.new_object('eventsignups', event=event['_id'],
+                                         user=self.new_object('users')['_id'])
+                         for _ in range(2))
+        self.assertTrue(first['accepted'])
+        self.assertFalse(second['accepted'])
+        self.assertCounts(event, 2, 1)
+
+        # The waiting list moves up
+        self.api.delete('/eventsignups/%s' % first['_id'],
+                        headers={'If-Match': first['_etag']},
+                        status_code=204)
+        self.assertCounts(event, 1, 1)
+
+        # Admins can unaccept signups
+        second = self.api.get('/eventsignups/%s' % second['_id'],
+                              status_code=200).json
+        self.api.patch('/eventsignups/%s' % second['_id'],
+                       data={'accepted': False},
+                       headers={'If-Match': second['_etag']},
+                       status_code=200)
+        self.assertCounts(event, 1, 0)
+
+        fetched = self.api.get('/events/%s' % event['_id'],
+                               status_code=200).json
+        self.assertEqual(fetched['signup_count'], 1)
+        self.assertEqual(fetched['accepted_count'], 0)
+
+    def test_user_deletion_recounts_events(self):
+        """Test that the cascade deleting all signups of a user is counted."""
+        events = self.load_fixture({'events': [{'spots': 0} for _ in range(3)]})
+        user = self.new_object('users')
+        for event in events:
+            self.new_object('eventsignups', event=event['_id'],
+                            user=user['_id'])
+            self.assertCounts(event, 1, 1)
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        for event in events:
+            self.assertCounts(event, 0, 0)
+
+    def test_reconciliation(self):
+        """Test that drifted or missing counters are corrected."""
+        event = self.new_object('events', spots=0)
+        self.new_object('eventsignups', event=event['_id'],
+                        user=self.new_object('users')['_id'])
+        unchanged = self.new_object('events', spots=0)
+
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$unset': {'signup_count': '',
+                                                 'accepted_count': ''}})
+
+        # Events without counters are counted on fetch
+        fetched = self.api.get('/events/%s' % event['_id'],
+                               status_code=200).json
+        self.assertEqual(fetched['signup_count'], 1)
+
+        with self.app.app_context():
+            self.assertEqual(recount_signups(), 1)
+        self.assertCounts(event, 1, 1)
+        self.assertCounts(unchanged, 0, 0)
+
+        # Also runs periodically
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$set': {'signup_count': 5}})
+        with self.app.app_context():
+            run_scheduled_tasks()
+        self.assertCounts(event, 1, 1)
+
+    def test_reconciliation_skips_admissions(self):
+        """Test that spots reserved for signups which are not accepted yet
+        are not recounted."""
+        event = self.new_object('events', spots=3, selection_strategy='fcfs')
+
+        with self.app.app_context():
+            reserve_accepted({'_id': event['_id']}, 2)
+            self.assertEqual(recount_signups(), 0)
+            self.assertCounts(event, 0, 2)
+
+            # Unfinished admissions only block recounting for a while
+            with freeze_time() as frozen_time:
+                frozen_time.tick(ADMISSION_TIMEOUT + timedelta(seconds=1))
+                self.assertEqual(recount_signups(), 1)
+            self.assertCounts(event, 0, 0)
+
+            reserve_accepted({'_id': event['_id']}, 1)
+            finish_admission(event['_id'], released=1)
+            self.db['events'].update_one({'_id': event['_id']},
+                                         {'$set': {'signup_count': 5}})
+            self.assertEqual(recount_signups(), 1)
+            self.assertCounts(event, 0, 0)
@@ -150,6 +150,43 @@ class EventModelTest(WebTestNoAuth):
             })
         }, status_code=201)
 
+    def test_additional_fields_validator_cache(self):
+        """Test that compiled schemas are reused until the event changes."""
+        def schema(max_length):
+            return json.dumps({
+                "$schema": "http://json-schema.org/draft-04/schema#",
+                "type": "object",
+                "additionalProperties": False,
+                'properties': {'field1': {'type': 'string',
+                                          'maxLength': max_length}},
+            })
+
+        ev = self.new_object("events", spots=100,
+                             additional_fields=schema(10))
+        cache = self.app.config['signup_validator_cache']
+
+        def signup(value, status_code):
+            user = self.new_object("users")
+            self.api.post("/eventsignups", data={
+                'user': str(user['_id']),
+                'event': str(ev['_id']),
+                'additional_fields': json.dumps({'field1': value})
+            }, status_code=status_code)
+
+        signup('short', 201)
+        signup('also short', 201)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # The updated schema is used immediately
+        self.api.patch("/events/%s" % ev['_id'],
+                       data={'additional_fields': schema(2)},
+                       headers={'If-Match': ev['_etag']},
+                       status_code=200)
+        self.assertEqual(cache.stats()['size'], 0)
+        signup('short', 422)
+        signup('ok', 201)
+
     def test_email_signup_only_when_allowed(self):
         """Test that email signup is only possible if enabled."""
         ev = self.new_object("events", spots=100, allow_email_signup=False)
@@ -12,6 +12,7 @@ from datetime import timedelta
 
 from freezegun import freeze_time
 
+from amivapi.events.queue import rebuild_queue_ranks
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -31,6 +32,23 @@ class EventProjectionTest(WebTestNoAuth):
         events = self.api.get('/events', status_code=200).json
         self.assertEqual(events['_items'][0]['signup_count'], 10)
 
+    def test_signup_count_collection(self):
+        """Test that every event of a page gets its own signup count"""
+        events = [self.new_object('events', spots=100) for _ in range(3)]
+        users = self.load_fixture({'users': [{} for _ in range(3)]})
+
+        # Event i has i signups
+        for index, event in enumerate(events):
+            for user in users[:index]:
+                self.new_object('eventsignups', event=event['_id'],
+                                user=user['_id'])
+
+        response = self.api.get('/events', status_code=200).json
+        counts = {item['_id']: item['signup_count']
+                  for item in response['_items']}
+        self.assertEqual(counts, {str(event['_id']): index
+                                  for index, event in enumerate(events)})
+
     def test_waitinglist_position_projection(self):
         """Test that waiting list position is correctly inserted into a
         signup information"""
@@ -67,6 +85,86 @@ class EventProjectionTest(WebTestNoAuth):
                 status_code=200).json
             self.assertEqual(signup_info['position'], 4)
 
+    def test_position_after_delete(self):
+        """Test that positions in a collection close the gap of a deleted
+        signup and match the positions of single items."""
+        event = self.new_object('events', spots=100)
+        users = self.load_fixture({'users': [{} for _ in range(4)]})
+        signups = [self.new_object('eventsignups', event=event['_id'],
+                                   user=user['_id']) for user in users]
+        self.assertEqual([signup['queue_rank'] for signup in signups],
+                         [1, 2, 3, 4])
+
+        self.api.delete('/eventsignups/%s' % signups[1]['_id'],
+                        headers={'If-Match': signups[1]['_etag']},
+                        status_code=204)
+
+        items = self.api.get('/eventsignups', status_code=200).json['_items']
+        positions = {item['_id']: item['position'] for item in items}
+        expected = {str(signups[index]['_id']): position
+                    for index, position in ((0, 1), (2, 2), (3, 3))}
+        self.assertEqual(positions, expected)
+
+        for signup_id, position in expected.items():
+            item = self.api.get('/eventsignups/%s' % signup_id,
+                                status_code=200).json
+            self.assertEqual(item['position'], position)
+
+    def test_rebuild_queue_ranks(self):
+        """Test that signups without rank get ranks in order of creation."""
+        event = self.new_object('events', spots=100)
+        with freeze_time("2016-01-01 00:00:00") as frozen_time:
+            signups = []
+            for user in self.load_fixture({'users': [{} for _ in range(3)]}):
+                signups.append(self.new_object(
+                    'eventsignups', event=event['_id'], user=user['_id']))
+                frozen_time.tick(delta=timedelta(seconds=1))
+
+        # Remove the ranks, e.g. signups from before ranks existed
+        self.db['eventsignups'].update_many({},
+                                            {'$unset': {'queue_rank': ''}})
+        items = self.api.get('/eventsignups', status_code=200).json['_items']
+        self.assertItemsEqual([item['position'] for item in items], [1, 2, 3])
+
+        with self.app.app_context():
+            self.assertEqual(rebuild_queue_ranks(), 1)
+
+        ranks = [self.db['eventsignups'].find_one(
+            {'_id': signup['_id']})['queue_rank'] for signup in signups]
+        self.assertEqual(ranks, sorted(ranks))
+        self.assertEqual(len(set(ranks)), 3)
+
+        # New signups continue after the rebuilt ranks
+        signup = self.new_object('eventsignups', event=event['_id'],
+                                 user=self.new_object('users')['_id'])
+        self.assertGreater(signup['queue_rank'], ranks[-1])
+
+    def test_position_with_unranked_signups(self):
+        """Test that signups without rank are in front of ranked signups."""
+        event = self.new_object('events', spots=100)
+        users = self.load_fixture({'users': [{} for _ in range(4)]})
+        with freeze_time("2016-01-01 00:00:00") as frozen_time:
+            signups = []
+            for user in users:
+                signups.append(self.new_object(
+                    'eventsignups', event=event['_id'], user=user['_id']))
+                frozen_time.tick(delta=timedelta(seconds=1))
+
+        # The two last signups were created before ranks existed
+        self.db['eventsignups'].update_many(
+            {'_id': {'$in': [signup['_id'] for signup in signups[2:]]}},
+            {'$unset': {'queue_rank': ''}})
+        expected = {str(signups[index]['_id']): position
+                    for index, position in ((2, 1), (3, 2), (0, 3), (1, 4))}
+
+        items = self.api.get('/eventsignups', status_code=200).json['_items']
+        self.assertEqual({item['_id']: item['position'] for item in items},
+                         expected)
+        for signup_id, position in expected.items():
+            item = self.api.get('/eventsignups/%s' % signup_id,
+                                status_code=200).json
+            self.assertEqual(item['position'], position)
+
     def test_signup_email_correct(self):
         """Test that signups display the correct email address"""
         event = self.new_object('events', spots=100)
@@ -86,6 +184,24 @@ class EventProjectionTest(WebTestNoAuth):
                               status_code=200).json
         self.assertEqual(signup['email'], 'testemail@amiv.com')
 
+    def test_signup_email_collection(self):
+        """Test that all signups of a page get the correct email address,
+        with and without embedding, for users and email signups."""
+        event = self.new_object('events', spots=100, additional_fields=None,
+                                allow_email_signup=True)
+        users = [self.new_object('users') for _ in range(3)]
+        for user in users:
+            self.new_object('eventsignups', event=str(event['_id']),
+                            user=str(user['_id']))
+        self.new_object('eventsignups', event=str(event['_id']),
+                        email='external@amiv.com')
+
+        expected = [user['email'] for user in users] + ['external@amiv.com']
+        for url in '/eventsignups', '/eventsignups?embedded={"user":1}':
+            signups = self.api.get(url, status_code=200).json['_items']
+            self.assertItemsEqual([signup['email'] for signup in signups],
+                                  expected)
+
     def test_confirmed_projected(self):
         """Test that an external signups gets the confirmed field"""
         event = self.new_object('events', spots=100, additional_fields=None,
@@ -4,6 +4,9 @@
 #          you to buy us beer if we meet and you like the software.
 """Test that people are correctly added and removed from the waiting list"""
 
+from threading import Barrier, Thread
+
+from amivapi.events.queue import admit_waiting_signups
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -95,3 +98,82 @@ class EventsignupQueueTest(WebTestNoAuth):
         self.api.delete('/eventsignups/%s' % signup2['_id'],
                         headers={'If-Match': signup2['_etag']},
                         status_code=204)
+
+    def test_fcfs_concurrent_signups(self):
+        """Test that simultaneous signups never accept more than the spots."""
+        spots, signups = 50, 300
+        event = self.new_object('events', spots=spots,
+                                selection_strategy='fcfs')
+        users = self.load_fixture({'users': [{} for _ in range(signups)]})
+
+        # Start all requests at the same time
+        barrier = Barrier(signups)
+        responses = []
+
+        def signup(user):
+            client = self.app.test_client()
+            barrier.wait()
+            responses.append(client.post('/eventsignups', data={
+                'user': str(user['_id']),
+                'event': str(event['_id'])
+            }, status_code=201).json)
+
+        threads = [Thread(target=signup, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # A response can show a signup as waiting which another request
+        # accepted right after, so only the stored signups are checked
+        self.assertEqual(len(responses), signups)
+        self.assertEqual(self.db['eventsignups'].count_documents(
+            {'event': event['_id'], 'accepted': True}), spots)
+        stored = self.db['events'].find_one({'_id': event['_id']})
+        self.assertEqual(stored['signup_count'], signups)
+        self.assertEqual(stored['accepted_count'], spots)
+
+        # Everyone got exactly one notification
+        self.assertEqual(len(self.app.test_mails), spots)
+
+        # Free spots are still filled in queue order
+        fetched = [self.api.get('/eventsignups/%s' % response['_id'],
+                                status_code=200).json
+                   for response in responses]
+        waiting = sorted((r for r in fetched if not r['accepted']),
+                         key=lambda signup: signup['queue_rank'])
+        accepted = next(r for r in fetched if r['accepted'])
+        self.api.delete('/eventsignups/%s' % accepted['_id'],
+                        headers={'If-Match': accepted['_etag']},
+                        status_code=204)
+        first_waiting = self.api.get('/eventsignups/%s' % waiting[0]['_id'],
+                                     status_code=200).json
+        self.assertTrue(first_waiting['accepted'])
+        self.assertEqual(self.db['events'].find_one(
+            {'_id': event['_id']})['accepted_count'], spots)
+
+    def test_admission_without_counters(self):
+        """Test that signups are accepted for events without counters and
+        that no internal fields are left on the signups."""
+        event = self.new_object('events', spots=2,
+                                selection_strategy='manual')
+        signup = self.api.post('/eventsignups', data={
+            'user': str(self.new_object('users')['_id']),
+            'event': str(event['_id'])
+        }, status_code=201).json
+        self.assertFalse(signup['accepted'])
+
+        # E.g. an event from before the counters existed
+        self.db['events'].update_one({'_id': event['_id']}, {'$unset': {
+            'signup_count': '', 'accepted_count': ''}})
+
+        with self.app.app_context():
+            accepted = admit_waiting_signups(
+                self.db['events'].find_one({'_id': event['_id']}))
+
+        self.assertEqual([str(item['_id']) for item in accepted],
+                         [signup['_id']])
+        self.assertEqual(self.db['events'].find_one(
+            {'_id': event['_id']})['accepted_count'], 1)
+        self.assertEqual(self.db['eventsignups'].count_documents(
+            {'_admission': {'$exists': True}}), 0)
@@ -7,8 +7,12 @@
 Since this hook will be added for all requests (the after auth hook) and this
 is tested for auth.py we only get get on resource level to test functionality.
 """
+from datetime import datetime, timedelta
+
 from flask import g
+from freezegun import freeze_time
 
+from amivapi.groups import remove_expired_group_members
 from amivapi.tests.utils import WebTest
 
 
@@ -60,3 +64,77 @@ class PermissionsTest(WebTest):
         """Test that 'readwrite' gives admin permissions."""
         self.permission_fixture({'groups': 'read'})
         self.assertAdminReadonly()
+
+    def test_permissions_are_cached(self):
+        """Permissions are resolved once per user, not per resource."""
+        self.permission_fixture({'groups': 'read'})
+        cache = self.app.config['permission_cache']
+
+        self.assertAdminReadonly()
+        self.assertAdminReadonly()
+        self.api.get('/', token=self.get_user_token(self.UID),
+                     status_code=200)
+        self.assertEqual(cache.misses, 1)
+
+    def test_group_update_invalidates(self):
+        """Changing group permissions takes effect immediately."""
+        self.permission_fixture({'groups': 'read'})
+        self.assertAdminReadonly()
+
+        group = self.api.get('/groups/%s' % (24 * '1'),
+                             token=self.get_root_token(),
+                             status_code=200).json
+        self.api.patch('/groups/%s' % group['_id'],
+                       data={'permissions': {'groups': 'readwrite'}},
+                       headers={'If-Match': group['_etag']},
+                       token=self.get_root_token(),
+                       status_code=200)
+        self.assertAdmin()
+
+    def test_membership_delete_invalidates(self):
+        """Removing a membership takes effect immediately."""
+        self.permission_fixture({'groups': 'readwrite'})
+        self.assertAdmin()
+
+        membership = self.db['groupmemberships'].find_one()
+        etag = self.api.get('/groupmemberships/%s' % membership['_id'],
+                            token=self.get_root_token(),
+                            status_code=200).json['_etag']
+        self.api.delete('/groupmemberships/%s' % membership['_id'],
+                        headers={'If-Match': etag},
+                        token=self.get_root_token(),
+                        status_code=204)
+        self.assertNothing()
+
+    def test_changes_by_other_processes(self):
+        """Changes signaled by the version counter are picked up after the
+        refresh interval."""
+        interval = self.app.config['PERMISSION_REFRESH_INTERVAL']
+        self.permission_fixture({'groups': 'readwrite'})
+
+        with freeze_time(datetime.utcnow()) as frozen_time:
+            self.assertAdmin()
+
+            # Simulate another process removing the membership
+            self.db['groupmemberships'].delete_many({})
+            self.db['config'].update_one(
+                {'_id': 'PERMISSIONS_VERSION'},
+                {'$inc': {'PERMISSIONS_VERSION': 1}}, upsert=True)
+
+            self.assertAdmin()
+            frozen_time.tick(delta=interval)
+            self.assertNothing()
+
+    def test_expired_membership(self):
+        """Removing expired memberships changes the version counter."""
+        self.permission_fixture({'groups': 'readwrite'})
+        self.db['groupmemberships'].update_many(
+            {}, {'$set': {'expiry': datetime.utcnow() - timedelta(days=1)}})
+        with self.app.app_context():
+            before = self.db['config'].find_one(
+                {'_id': 'PERMISSIONS_VERSION'}) or {}
+            remove_expired_group_members()
+
+        after = self.db['config'].find_one({'_id': 'PERMISSIONS_VERSION'})
+        self.assertEqual(after['PERMISSIONS_VERSION'],
+                         before.get('PERMISSIONS_VERSION', 0) + 1)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the full-text search of studydocuments."""
+
+import json
+
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class StudydocsSearchTest(WebTestNoAuth):
+    """Test the `search` query parameter."""
+
+    def _load_data(self):
+        self.load_fixture({
+            'studydocuments': [{
+                'title': 'Exam',
+                'lecture': 'Analysis',
+                'professor': 'a',
+            }, {
+                'title': 'Analysis summary',
+                'lecture': 'Analysis',
+                'professor': 'b',
+            }, {
+                'title': 'Old exam',
+                'lecture': 'Signals',
+                'professor': 'b',
+            }]
+        })
+
+    def test_search_ranking(self):
+        """Results are sorted by relevance, matches in titles first."""
+        self._load_data()
+
+        response = self.api.get("/studydocuments?search=analysis",
+                                status_code=200).json
+
+        self.assertEqual([item['title'] for item in response['_items']],
+                         ['Analysis summary', 'Exam'])
+        self.assertGreater(response['_items'][0]['_score'],
+                           response['_items'][1]['_score'])
+
+        # Also with other filters, which Eve combines with the search
+        match = json.dumps({'professor': {'$in': ['a', 'b']}})
+        response = self.api.get(
+            "/studydocuments?search=analysis&where=%s" % match,
+            status_code=200).json
+
+        self.assertEqual([item['title'] for item in response['_items']],
+                         ['Analysis summary', 'Exam'])
+        self.assertGreater(response['_items'][0]['_score'],
+                           response['_items'][1]['_score'])
+
+    def test_search_with_sort(self):
+        """A sort requested by the client is kept."""
+        self._load_data()
+
+        response = self.api.get("/studydocuments?search=analysis&sort=-title",
+                                status_code=200).json
+
+        self.assertEqual([item['title'] for item in response['_items']],
+                         ['Exam', 'Analysis summary'])
+
+    def test_search_summary(self):
+        """The summary is computed over the search results."""
+        self._load_data()
+
+        response = self.api.get("/studydocuments?search=exam",
+                                status_code=200).json
+        self.assertEqual(response['_summary'], {
+            'lecture': {'Analysis': 1, 'Signals': 1},
+            'professor': {'a': 1, 'b': 1},
+        })
+
+        match = json.dumps({'professor': 'b'})
+        response = self.api.get("/studydocuments?search=exam&where=%s" % match,
+                                status_code=200).json
+        self.assertEqual([item['title'] for item in response['_items']],
+                         ['Old exam'])
+        self.assertEqual(response['_summary'], {
+            'lecture': {'Signals': 1},
+            'professor': {'b': 1},
+        })
@@ -5,7 +5,10 @@
 """Tests for studydocuments summaries."""
 
 import json
+from threading import Barrier, Thread
 
+from amivapi.cron import run_scheduled_tasks
+from amivapi.studydocs.summary import rebuild_summary
 from amivapi.tests.utils import WebTestNoAuth
 
 
@@ -65,3 +68,111 @@ class StudydocsSummaryTest(WebTestNoAuth):
                 'b': 1,  # The document with title `third` is ignored
             }
         }
+
+    def test_summary_follows_writes(self):
+        """The materialized and the cached summaries are updated on writes."""
+        self._load_data()
+        match = json.dumps({'professor': 'b'})
+
+        def summary(url):
+            return self.api.get(url, status_code=200).json['_summary']
+
+        # Fill the cache
+        self.assertEqual(summary("/studydocuments?where=%s" % match),
+                         {'lecture': {'a': 1}, 'professor': {'b': 2}})
+
+        docs = {doc['title']: doc for doc in
+                self.api.get("/studydocuments", status_code=200).json['_items']}
+        self.api.patch("/studydocuments/%s" % docs['second']['_id'],
+                       data={'lecture': 'c'},
+                       headers={'If-Match': docs['second']['_etag']},
+                       status_code=200)
+        self.api.delete("/studydocuments/%s" % docs['first']['_id'],
+                        headers={'If-Match': docs['first']['_etag']},
+                        status_code=204)
+        self.new_object('studydocuments', lecture='c', professor='c')
+
+        self.assertEqual(summary("/studydocuments"), {
+            'lecture': {'c': 2},
+            'professor': {'b': 2, 'c': 1},
+        })
+        self.assertEqual(summary("/studydocuments?where=%s" % match),
+                         {'lecture': {'c': 1}, 'professor': {'b': 2}})
+
+    def test_filtered_summary_is_cached(self):
+        """Filtered summaries are only aggregated once per `where`."""
+        self._load_data()
+        cache = self.app.config['studydoc_summary_cache']
+
+        for match in ({'lecture': 'a', 'professor': 'b'},
+                      {'professor': 'b', 'lecture': 'a'}):
+            self.api.get("/studydocuments?where=%s" % json.dumps(match),
+                         status_code=200)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_rebuild_summary(self):
+        """The counters can be rebuilt from the documents in the database."""
+        self.db['studydocuments'].insert_many([
+            {'title': 'first', 'lecture': 'a'},
+            {'title': 'second', 'lecture': 'a', 'professor': None},
+        ])
+        with self.app.app_context():
+            rebuild_summary()
+
+        response = self.api.get("/studydocuments", status_code=200).json
+        self.assertEqual(response['_summary'], {'lecture': {'a': 2}})
+
+    def test_build_on_first_use(self):
+        """The counters are built by the first request needing them."""
+        self.assertIsNone(
+            self.db['studydocsummary'].find_one({'_id': 'initialized'}))
+        self.db['studydocuments'].insert_many([
+            {'title': 'first', 'lecture': 'a'},
+            {'title': 'second', 'lecture': 'b'},
+        ])
+
+        response = self.api.get("/studydocuments", status_code=200).json
+        self.assertEqual(response['_summary'], {'lecture': {'a': 1, 'b': 1}})
+        self.assertIsNotNone(
+            self.db['studydocsummary'].find_one({'_id': 'initialized'}))
+
+    def test_periodic_rebuild(self):
+        """Changes made without the hooks are corrected periodically."""
+        self.api.get("/studydocuments", status_code=200)
+        self.db['studydocuments'].insert_one({'title': 'new', 'lecture': 'a'})
+
+        with self.app.app_context():
+            run_scheduled_tasks()
+
+        response = self.api.get("/studydocuments", status_code=200).json
+        self.assertEqual(response['_summary'], {'lecture': {'a': 1}})
+
+    def test_concurrent_rebuild(self):
+        """Several workers can build the counters at the same time."""
+        self.db['studydocuments'].insert_many([
+            {'title': str(index), 'lecture': str(index % 10)}
+            for index in range(100)
+        ])
+
+        workers = 10
+        barrier = Barrier(workers)
+        errors = []
+
+        def rebuild():
+            with self.app.app_context():
+                barrier.wait()
+                try:
+                    rebuild_summary()
+                except Exception as error:
+                    errors.append(error)
+
+        threads = [Thread(target=rebuild) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        response = self.api.get("/studydocuments", status_code=200).json
+        self.assertEqual(response['_summary'],
+                         {'lecture': {str(index): 10 for index in range(10)}})
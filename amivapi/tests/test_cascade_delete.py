@@ -51,3 +51,43 @@ class CascadingDeleteTest(WebTestNoAuth):
         sessions = self.db['sessions'].find({
             'user': ObjectId('deadbeefdeadbeefdeadbeef')})
         self.assertEqual(sessions.count(), 0)
+
+    def test_delete_cascades_in_batches(self):
+        """Test that many referencing objects are deleted and their hooks
+        are called, even if they span several batches."""
+        self.app.config['CASCADE_BATCH_SIZE'] = 3
+        user = self.new_object('users')
+        other = self.new_object('users')
+        self.load_fixture({'sessions': [{'username': user['nethz']}
+                                        for _ in range(7)] +
+                                       [{'username': other['nethz']}]})
+        events = self.load_fixture({'events': [{'spots': 0}
+                                               for _ in range(5)]})
+        for event in events:
+            self.new_object('eventsignups', event=event['_id'],
+                            user=user['_id'])
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        self.assertEqual(self.db['sessions'].count_documents({}), 1)
+        self.assertEqual(self.db['eventsignups'].count_documents({}), 0)
+        # The signup hooks have run for every signup
+        for event in events:
+            stored = self.db['events'].find_one({'_id': event['_id']})
+            self.assertEqual(stored['signup_count'], 0)
+
+    def test_delete_removes_references(self):
+        """Test that nullable references are set to None."""
+        user = self.new_object('users')
+        group = self.new_object('groups', moderator=user['_id'])
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        updated = self.api.get('/groups/%s' % group['_id'],
+                               status_code=200).json
+        self.assertIsNone(updated['moderator'])
+        self.assertNotEqual(updated['_etag'], group['_etag'])
@@ -7,17 +7,24 @@
 """ Test scheduler """
 
 from datetime import datetime, timedelta
+from threading import Barrier, Event, Thread
+from time import sleep
+from unittest.mock import patch
+
+from bson import ObjectId
 from freezegun import freeze_time
 
 from amivapi import cron
 from amivapi.cron import (
+    _claim_task,
     NotSchedulable,
     periodic,
     run_scheduled_tasks,
     schedulable,
     schedule_once_soon,
     schedule_task,
-    update_scheduled_task
+    update_scheduled_task,
+    wait_for_next_task
 )
 from amivapi.tests.utils import WebTestNoAuth
 
@@ -139,3 +146,215 @@ class CronTest(WebTestNoAuth):
 
             self.assertTrue(CronTest.has_run)
             self.assertEqual(CronTest.received_arg, "new-arg")
+
+    def test_failed_task_is_retried_with_backoff(self):
+        self.app.config.update(CRON_RETRY_DELAY=timedelta(minutes=1),
+                               CRON_MAX_ATTEMPTS=3)
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def failing():
+                CronTest.run_count += 1
+                raise ValueError("Failed on purpose")
+
+            schedule_task(datetime.utcnow(), failing)
+            timings = run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+            name = 'amivapi.tests.test_cron.failing'
+            self.assertEqual(timings[name]['failures'], 1)
+
+            # Retried after 1 minute, then after 2 minutes more
+            frozen_time.tick(delta=timedelta(seconds=59))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+            frozen_time.tick(delta=timedelta(seconds=1))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 2)
+            frozen_time.tick(delta=timedelta(minutes=2))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 3)
+
+            # Dropped after the last attempt
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': name}), 0)
+
+    def test_task_of_crashed_runner_runs_after_lease(self):
+        self.app.config['CRON_LEASE_TIMEOUT'] = timedelta(minutes=10)
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def inc():
+                CronTest.run_count += 1
+
+            schedule_task(datetime.utcnow(), inc)
+
+            # Another runner claims the task and crashes
+            self.assertIsNotNone(_claim_task())
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 0)
+
+            frozen_time.tick(delta=timedelta(minutes=10))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+            frozen_time.tick(delta=timedelta(minutes=10))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+    def test_lease_is_renewed(self):
+        """A task running longer than the lease timeout is not claimed by
+        another runner."""
+        self.app.config['CRON_LEASE_TIMEOUT'] = timedelta(milliseconds=300)
+        claimed = []
+
+        @schedulable
+        def long_task():
+            CronTest.run_count += 1
+            with self.app.app_context():
+                for _ in range(10):
+                    sleep(0.1)
+                    claimed.append(_claim_task())
+
+        with self.app.app_context():
+            # Run the initial tasks, so nothing else can be claimed
+            run_scheduled_tasks()
+            schedule_task(datetime.utcnow(), long_task)
+            run_scheduled_tasks()
+
+        self.assertEqual(CronTest.run_count, 1)
+        self.assertEqual(claimed, [None] * 10)
+        self.assertEqual(self.db['scheduled_tasks'].count_documents(
+            {'function': 'amivapi.tests.test_cron.long_task'}), 0)
+
+    def test_update_running_task(self):
+        """A running task is not modified, the update is scheduled as a new
+        task."""
+        with self.app.app_context():
+            @schedulable
+            def tester(arg):
+                pass
+
+            name = 'amivapi.tests.test_cron.tester'
+            schedule_task(datetime.utcnow(), tester, "arg")
+            running = _claim_task()
+
+            update_scheduled_task(datetime.utcnow(), tester, "new-arg")
+
+            self.assertEqual(
+                self.db['scheduled_tasks'].find_one(
+                    {'_id': running['_id']})['args'],
+                running['args'])
+            self.assertEqual(self.db['scheduled_tasks'].count_documents(
+                {'function': name, 'lease': {'$exists': False}}), 1)
+
+    def test_tasks_run_in_parallel(self):
+        workers = 4
+        self.app.config['CRON_WORKERS'] = workers
+        barrier = Barrier(workers)
+
+        @schedulable
+        def wait_for_others():
+            # Fails, unless all tasks run at the same time
+            barrier.wait(timeout=5)
+            sleep(0.1)
+
+        with self.app.app_context():
+            for _ in range(workers):
+                schedule_task(datetime.utcnow(), wait_for_others)
+            timings = run_scheduled_tasks()
+
+        timing = timings['amivapi.tests.test_cron.wait_for_others']
+        self.assertEqual(timing['runs'], workers)
+        self.assertEqual(timing['failures'], 0)
+        # Every run takes at least as long as the sleep
+        self.assertGreaterEqual(timing['max'], 0.1)
+        self.assertGreaterEqual(timing['total'], workers * 0.1)
+
+    def test_dispatch_latency(self):
+        """Test that the scheduler wakes up for new tasks and due tasks.
+
+        The scheduler sleeps much longer than the test takes, so tasks
+        only run in time if it is woken up.
+        """
+        received = []
+        stop = Event()
+
+        @schedulable
+        def record(scheduled_time):
+            received.append((scheduled_time, datetime.utcnow()))
+
+        def scheduler():
+            with self.app.app_context():
+                while not stop.is_set():
+                    run_scheduled_tasks()
+                    wait_for_next_task(timedelta(seconds=30))
+
+        thread = Thread(target=scheduler)
+        thread.start()
+        try:
+            with self.app.app_context():
+                # Let the scheduler run the initial tasks and fall asleep
+                sleep(0.5)
+
+                # A task due now wakes up the scheduler
+                schedule_task(datetime.utcnow(), record, datetime.utcnow())
+
+                # A task in the near future is run when it is due
+                soon = datetime.utcnow() + timedelta(seconds=1)
+                schedule_task(soon, record, soon)
+
+                # Wait for both tasks, but not for the sleep interval
+                for _ in range(100):
+                    if len(received) == 2:
+                        break
+                    sleep(0.1)
+
+            # Tasks run in order, not before they are due, and well before
+            # the scheduler would wake up on its own (generous bound for slow
+            # machines)
+            self.assertEqual(len(received), 2)
+            self.assertLess(received[0][0], received[1][0])
+            for due, run in received:
+                self.assertGreaterEqual(run, due)
+                self.assertLess(run - due, timedelta(seconds=10))
+        finally:
+            stop.set()
+            # Wake up the scheduler to stop it
+            with self.app.app_context():
+                schedule_task(datetime.utcnow(), record, datetime.utcnow())
+            thread.join()
+
+    def test_wake_up_after_lost_signal(self):
+        """Test that the scheduler still wakes up if the last signal it has
+        seen was removed from the capped collection."""
+        @schedulable
+        def task():
+            pass
+
+        with self.app.app_context():
+            run_scheduled_tasks()
+
+        # Pretend the newest signal was removed right after it was read
+        newest_signal_id = cron._newest_signal_id
+        removed = iter([ObjectId()])
+
+        def newest_signal(signals):
+            return next(removed, None) or newest_signal_id(signals)
+
+        woken_up = Event()
+
+        def waiter():
+            with self.app.app_context():
+                wait_for_next_task(timedelta(seconds=30))
+            woken_up.set()
+
+        with patch.object(cron, '_newest_signal_id', newest_signal):
+            thread = Thread(target=waiter)
+            thread.start()
+            try:
+                sleep(0.5)
+                with self.app.app_context():
+                    schedule_task(datetime.utcnow(), task)
+                self.assertTrue(woken_up.wait(10))
+            finally:
+                thread.join()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Test the request-scoped identity map of the data layer."""
+
+from amivapi.data import IdentityMapMongo, forget
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class IdentityMapTest(WebTestNoAuth):
+    """Lookups by id are answered from the map within one request."""
+
+    def test_lookups_by_id_are_cached(self):
+        """Test that the document is fetched once and can be modified."""
+        event = self.new_object('events', spots=10)
+        saved = IdentityMapMongo.saved_queries
+
+        with self.app.test_request_context():
+            first = self.app.data.find_one('events', None, _id=event['_id'])
+            first['title_en'] = 'modified by caller'
+            # String ids are converted like Eve does
+            second = self.app.data.find_one('events', None,
+                                            _id=str(event['_id']))
+
+        self.assertEqual(IdentityMapMongo.saved_queries, saved + 1)
+        self.assertEqual(second['title_en'], event['title_en'])
+
+    def test_map_is_request_scoped(self):
+        """Test that a new request queries the database again."""
+        event = self.new_object('events', spots=10)
+        saved = IdentityMapMongo.saved_queries
+
+        for title in ('first', 'second'):
+            self.db['events'].update_one({'_id': event['_id']},
+                                         {'$set': {'title_en': title}})
+            with self.app.test_request_context():
+                found = self.app.data.find_one('events', None,
+                                               _id=event['_id'])
+                self.assertEqual(found['title_en'], title)
+
+        # Without request context, nothing is cached
+        with self.app.app_context():
+            self.app.data.find_one('events', None, _id=event['_id'])
+            self.app.data.find_one('events', None, _id=event['_id'])
+
+        self.assertEqual(IdentityMapMongo.saved_queries, saved)
+
+    def test_writes_invalidate(self):
+        """Test that writes through the data layer or `forget` evict."""
+        event = self.new_object('events', spots=10)
+
+        with self.app.test_request_context():
+            original = self.app.data.find_one('events', None,
+                                              _id=event['_id'])
+            self.app.data.update('events', event['_id'],
+                                 {'title_en': 'updated'}, original)
+            self.assertEqual(self.app.data.find_one(
+                'events', None, _id=event['_id'])['title_en'], 'updated')
+
+            self.db['events'].update_one({'_id': event['_id']},
+                                         {'$set': {'title_en': 'direct'}})
+            forget('events', event['_id'])
+            self.assertEqual(self.app.data.find_one(
+                'events', None, _id=event['_id'])['title_en'], 'direct')
+
+            self.app.data.remove('events', {'_id': event['_id']})
+            self.assertIsNone(self.app.data.find_one('events', None,
+                                                     _id=event['_id']))
+
+    def test_signup_saves_queries(self):
+        """Test that a signup POST reuses the event for all validators."""
+        event = self.new_object('events', spots=10)
+        user = self.new_object('users')
+        saved = IdentityMapMongo.saved_queries
+
+        self.api.post('/eventsignups', data={
+            'user': str(user['_id']),
+            'event': str(event['_id']),
+        }, status_code=201)
+
+        self.assertGreater(IdentityMapMongo.saved_queries, saved)
@@ -153,3 +153,65 @@ class MediaTest(WebTestNoAuth):
         self.api.get(obj['test_file']['file'], headers={
             'If-Modified-Since': 'Mon, 12 Dec 2016 12:23:46 GMT'},
             status_code=200)
+
+    def test_range(self):
+        """Test that parts of a file can be downloaded."""
+        url = self._post_file()['test_file']['file']
+        size = len(lenadata)
+
+        response = self.api.get(url, headers={'Range': 'bytes=100-199'},
+                                status_code=206)
+        self.assertEqual(response.data, lenadata[100:200])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 100-199/%i' % size)
+
+        # Open ranges
+        response = self.api.get(url, headers={'Range': 'bytes=-100'},
+                                status_code=206)
+        self.assertEqual(response.data, lenadata[-100:])
+        response = self.api.get(url, headers={'Range': 'bytes=100-'},
+                                status_code=206)
+        self.assertEqual(response.data, lenadata[100:])
+
+        # Out of the file
+        response = self.api.get(url, headers={'Range': 'bytes=%i-' % size},
+                                status_code=416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */%i' % size)
+
+        # Multiple ranges are ignored
+        response = self.api.get(url, headers={'Range': 'bytes=0-1,5-6'},
+                                status_code=200)
+        self.assertEqual(response.data, lenadata)
+
+    def test_conditional_get(self):
+        """Test ETag and caching headers."""
+        url = self._post_file()['test_file']['file']
+
+        response = self.api.get(url, status_code=200)
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'],
+                         self.app.config['MEDIA_CACHE_CONTROL'])
+
+        response = self.api.get(url, headers={'If-None-Match': etag},
+                                status_code=304)
+        self.assertEqual(response.data, b'')
+        self.api.get(url, headers={'If-None-Match': '"other"'},
+                     status_code=200)
+
+        # Ranges are only sent if the file was not changed
+        response = self.api.get(url, headers={'Range': 'bytes=0-9',
+                                              'If-Range': etag},
+                                status_code=206)
+        self.assertEqual(response.data, lenadata[:10])
+        response = self.api.get(url, headers={'Range': 'bytes=0-9',
+                                              'If-Range': '"other"'},
+                                status_code=200)
+        self.assertEqual(response.data, lenadata)
+
+    def test_etag_differs(self):
+        """Test that different files have different ETags."""
+        etags = set()
+        for data in (lenadata, b'other'):
+            url = self._post_file(data=data)['test_file']['file']
+            etags.add(self.api.get(url, status_code=200).headers['ETag'])
+        self.assertEqual(len(etags), 2)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Test the mail outbox and the SMTP sender."""
+
+from datetime import datetime, timedelta
+import smtplib
+from unittest.mock import patch
+
+from amivapi.outbox import SMTPConnection, send_mails
+from amivapi.tests.utils import WebTestNoAuth
+from amivapi.utils import mail
+
+
+class OutboxTest(WebTestNoAuth):
+    """Mails are stored in the outbox and sent in batches."""
+
+    def setUp(self):
+        super().setUp()
+        # Store mails in the outbox instead of `test_mails`
+        self.app.config.update(TESTING=False,
+                               SMTP_SERVER='smtp.example.com',
+                               SMTP_PORT=587)
+
+    def add_mails(self, count):
+        with self.app.app_context():
+            for index in range(count):
+                mail('api@test.ch', 'user%i@test.ch' % index,
+                     'Subject %i' % index, 'Text')
+
+    def send(self, smtp):
+        """Send one batch with a mocked SMTP class."""
+        smtp.return_value.starttls.return_value = (220, b'ready')
+        with self.app.app_context(), \
+                patch('amivapi.outbox.smtplib.SMTP', smtp):
+            connection = SMTPConnection(self.app.config)
+            processed = send_mails(connection)
+            connection.close()
+        return processed
+
+    def test_requests_only_enqueue(self):
+        """Test that `mail` does not connect to the server."""
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            self.add_mails(2)
+            smtp.assert_not_called()
+
+        mails = list(self.db['outbox'].find())
+        self.assertEqual(len(mails), 2)
+        self.assertEqual(mails[0]['to'], ['user0@test.ch'])
+        self.assertEqual(mails[0]['attempts'], 0)
+
+    def test_batch_uses_one_connection(self):
+        """Test that a batch is sent over a single connection."""
+        self.app.config['MAIL_BATCH_SIZE'] = 3
+        self.add_mails(5)
+
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            self.assertEqual(self.send(smtp), 3)
+            smtp.assert_called_once()
+            self.assertEqual(smtp.return_value.sendmail.call_count, 3)
+
+        self.assertEqual(self.db['outbox'].count_documents({}), 2)
+
+    def test_retry_with_backoff(self):
+        """Test that failed mails are retried later and finally dropped."""
+        self.app.config['MAIL_MAX_ATTEMPTS'] = 2
+        self.add_mails(3)
+
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = \
+                smtplib.SMTPServerDisconnected('gone')
+            self.assertEqual(self.send(smtp), 3)
+            # Only the first mail was attempted
+            self.assertEqual(smtp.return_value.sendmail.call_count, 1)
+
+        mails = list(self.db['outbox'].find().sort('_created'))
+        self.assertEqual([m['attempts'] for m in mails], [1, 0, 0])
+        now = datetime.utcnow()
+        for message in mails:
+            self.assertGreater(message['next_attempt'],
+                               now + timedelta(seconds=30))
+
+        # Nothing is due now
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            self.assertEqual(self.send(smtp), 0)
+
+        # Second failure drops the first mail (due first)
+        self.db['outbox'].update_many({}, {'$set': {'next_attempt': now}})
+        self.db['outbox'].update_one(
+            {'attempts': 1},
+            {'$set': {'next_attempt': now - timedelta(seconds=1)}})
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = \
+                smtplib.SMTPServerDisconnected('gone')
+            self.send(smtp)
+        self.assertEqual(self.db['outbox'].count_documents({}), 2)
+
+        # And the others are sent as soon as the server is back
+        self.db['outbox'].update_many({}, {'$set': {'next_attempt': now}})
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            self.assertEqual(self.send(smtp), 2)
+        self.assertEqual(self.db['outbox'].count_documents({}), 0)
+
+    def test_refused_recipients_are_dropped(self):
+        """Test that mails to refused recipients are not retried."""
+        self.add_mails(1)
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp:
+            smtp.return_value.sendmail.side_effect = \
+                smtplib.SMTPRecipientsRefused({})
+            self.send(smtp)
+        self.assertEqual(self.db['outbox'].count_documents({}), 0)
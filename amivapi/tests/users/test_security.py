@@ -8,6 +8,8 @@ Includes item and field permissions as well as password hashing.
 """
 
 import json
+from threading import Barrier, Thread
+
 from bson import ObjectId
 
 from passlib.hash import pbkdf2_sha256
@@ -220,6 +222,35 @@ class UserFieldsTest(utils.WebTest):
         self.assertItemsEqual(resp['user'].keys(),
                               set(self.BASIC_FIELDS) - set(['_links']))
 
+    def test_embedded_read_resource(self):
+        """Test that hide hooks are called for all users embedded in a page,
+        even if the same user is embedded several times."""
+        self.app.register_resource('test', {
+            'schema': {
+                'user': {
+                    'data_relation': {
+                        'resource': 'users',
+                        'embeddable': True
+                    },
+                    'type': 'objectid'
+                }
+            }
+        })
+
+        self.create_users()
+        for user in (self.user, self.other_user, self.other_user):
+            self.new_object('test', user=str(user['_id']))
+
+        resp = self.api.get('/test?embedded={"user":1}',
+                            token=self.user_token, status_code=200).json
+        self.assertEqual(len(resp['_items']), 3)
+        for item in resp['_items']:
+            fields = (self.ALL_FIELDS
+                      if item['user']['_id'] == str(self.user['_id'])
+                      else self.BASIC_FIELDS)
+            self.assertItemsEqual(item['user'].keys(),
+                                  set(fields) - set(['_links']))
+
     def test_password_status(self):
         user = self.new_object('users', password='abcdefg')
         user_no_pass = self.new_object('users', password=None)
@@ -321,3 +352,43 @@ class UserFieldsTest(utils.WebTest):
 
                 # Admin is allowed
                 self.api.get(url, token=root_token, status_code=200)
+
+    def test_invalid_nested_filters(self):
+        """Test that logical operators only accept lists of sub-queries."""
+        user_token = self.get_user_token(str(self.new_object('users')['_id']))
+
+        for operand in ({'email': 'something'}, ['email'],
+                        [{'firstname': 'a'}, 'email']):
+            query = json.dumps({'$or': operand})
+            self.api.get('/users?where=%s' % query,
+                         token=user_token, status_code=400)
+
+    def test_concurrent_filter_restrictions(self):
+        """Test that the filters of one request don't leak into another
+        request running at the same time."""
+        user_token = self.get_user_token(str(self.new_object('users')['_id']))
+        root_token = self.get_root_token()
+        url = '/users?where=%s' % json.dumps({'email': 'something'})
+
+        requests = 50
+        barrier = Barrier(2 * requests)
+        errors = []
+
+        def get(token, status_code):
+            client = self.app.test_client()
+            barrier.wait()
+            for _ in range(5):
+                response = client.get(url, token=token)
+                if response.status_code != status_code:
+                    errors.append(response.status_code)
+
+        threads = [Thread(target=get, args=args) for args in
+                   [(user_token, 400), (root_token, 200)] * requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            self.app.config['DOMAIN']['users']['allowed_filters'], ['*'])
@@ -37,11 +37,12 @@ def init_app(app):
     app.on_replace_user += hash_on_update
     app.on_replaced_user += project_password_status_on_updated
 
-    # on_post_METHOD, triggered before sending the response by Eve
+    # on_render_METHOD, triggered before rendering the response
     for method in ['GET', 'POST', 'PATCH']:
-        event = getattr(app, 'on_post_%s_users' % method)
+        event = getattr(app, 'on_render_%s_users' % method)
         event += hide_after_request
 
     app.on_fetched_item_users += hide_fields
+    app.on_fetched_resource_users += hide_fields
 
     init_subscriber_list(app)
@@ -5,12 +5,12 @@
 
 """User Auth class."""
 
-from bson import ObjectId
-
-from flask import current_app, g
+from flask import g
 
 from amivapi.auth import AmivTokenAuth
-from amivapi.utils import on_post_hook
+from amivapi.auth.passwords import hash_password
+from amivapi.auth.session_cache import get_identity
+from amivapi.data import set_allowed_filters
 
 
 class UserAuth(AmivTokenAuth):
@@ -65,13 +65,8 @@ class UserAuth(AmivTokenAuth):
             dict: The filter, will be combined with other filters in the hook.
                 Return None if no filters should be applied.
         """
-        # Find out if not member
-        collection = current_app.data.driver.db['users']
-        # set projection to only return membership
-        result = collection.find_one({'_id': ObjectId(user_id)},
-                                     {'membership': 1})
-
-        if result['membership'] == "none":
+        # Find out if not member (cached with the session)
+        if get_identity(user_id).get('membership', 'none') == "none":
             # Can't see others
             return {'_id': user_id}
         else:
@@ -79,15 +74,14 @@ class UserAuth(AmivTokenAuth):
             return None
 
 
-@on_post_hook
-def hide_after_request(request, response, payload):
+def hide_after_request(request, payload):
     """Hide user fields after all requests to /users.
 
     Wrapper around `hide_fields` to work reliably with GET, POST as well as
     PATCH.
 
     Args:
-        request, response: unused
+        request: unused
         payload (dict): response data
     """
     # Use either the '_items' field (resource requests) or the
@@ -96,7 +90,7 @@ def hide_after_request(request, response, payload):
         hide_fields(item)
 
 
-def hide_fields(item):
+def hide_fields(response):
     """Show only meta fields, nethz and name from others in response.
 
     The user can only see his personal data completely.
@@ -104,35 +98,34 @@ def hide_fields(item):
     Nobody can see passwords.
 
     Args:
-        item (dict): User data
+        response (dict): User data, or response with users in `_items`
     """
-    # Always remove password
-    item.pop('password', None)
+    # Compatibility with both item and resource hook
+    for item in response.get('_items', [response]):
+        # Always remove password
+        item.pop('password', None)
 
-    # Remove other fields
-    if not (g.get('resource_admin') or
-            g.get('resource_admin_readonly') or
-            g.get('current_user') == str(item['_id'])):
-        for key in list(item):
-            if (key[0] != '_' and
-                    key not in ('firstname', 'lastname', 'nethz')):
-                item.pop(key)
+        # Remove other fields
+        if not (g.get('resource_admin') or
+                g.get('resource_admin_readonly') or
+                g.get('current_user') == str(item['_id'])):
+            for key in list(item):
+                if (key[0] != '_' and
+                        key not in ('firstname', 'lastname', 'nethz')):
+                    item.pop(key)
 
 
 def restrict_filters(*_):
     """If the user is not an admin, restrict the query filters.
 
-    Changing the config modifies subsequent requests, so we need to set
-    it explicitly for each request.
+    The filters are only restricted for the current request, the domain
+    is shared by all requests.
     """
-    userdomain = current_app.config['DOMAIN']['users']
     if not (g.get('resource_admin') or g.get('resource_admin_readonly')):
-        userdomain['allowed_filters'] = [
+        set_allowed_filters('users', [
             '_id', '_etag', '_updated', '_created', '_links',
             'firstname', 'lastname', 'nethz',
-        ]
-    else:
-        userdomain['allowed_filters'] = ['*']
+        ])
 
 
 # Project password status
@@ -191,10 +184,8 @@ def _hash_password(user):
     Args:
         user (dict): dict of user data.
     """
-    password_context = current_app.config['PASSWORD_CONTEXT']
-
     if user.get('password', None) is not None:
-        user['password'] = password_context.encrypt(user['password'])
+        user['password'] = hash_password(user['password'])
 
 
 def hash_on_insert(items):
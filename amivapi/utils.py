@@ -6,19 +6,22 @@
 
 
 from base64 import b64encode
+from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
-from email.mime.text import MIMEText
+from datetime import datetime as dt
 from os import urandom
 from binascii import hexlify
-import smtplib
-from functools import wraps
-import json
+from threading import Lock
 
 from bson import ObjectId
-from eve.utils import config
+import eve.render
 from flask import current_app as app
-from flask import g
+from flask import g, request
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from amivapi.outbox import enqueue_mail
 
 
 def token_urlsafe(nbytes=32):
@@ -77,12 +80,17 @@ def get_id(item):
 def mail(sender, to, subject, text):
     """Send a mail to a list of recipients.
 
+    The mail is only stored in the outbox, `amivapi send_mails` sends it.
+
     Args:
         from(string): From address
         to(list of strings): List of recipient addresses
         subject(string): Subject string
         text(string): Mail content
     """
+    if isinstance(to, str):
+        to = [to]
+
     if app.config.get('TESTING', False):
         app.test_mails.append({
             'subject': subject,
@@ -90,36 +98,158 @@ def mail(sender, to, subject, text):
             'receivers': to,
             'text': text
         })
-    elif config.SMTP_SERVER and config.SMTP_PORT:
-        msg = MIMEText(text)
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = ';'.join(to)
-
-        try:
-            with smtplib.SMTP(config.SMTP_SERVER,
-                              port=config.SMTP_PORT,
-                              timeout=config.SMTP_TIMEOUT) as smtp:
-                status_code, _ = smtp.starttls()
-                if status_code != 220:
-                    app.logger.error("Failed to create secure "
-                                     "SMTP connection!")
-                    return
-
-                if config.SMTP_USERNAME and config.SMTP_PASSWORD:
-                    smtp.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
-                else:
-                    smtp.ehlo()
-
-                try:
-                    smtp.sendmail(msg['From'], to, msg.as_string())
-                except smtplib.SMTPRecipientsRefused:
-                    error = ("Failed to send mail:\n"
-                             "From: %s\nTo: %s\n"
-                             "Subject: %s\n\n%s")
-                    app.logger.error(error % (sender, str(to), subject, text))
-        except smtplib.SMTPException as e:
-            app.logger.error("SMTP error trying to send mails: %s" % e)
+    elif app.config.get('SMTP_SERVER') and app.config.get('SMTP_PORT'):
+        enqueue_mail(sender, to, subject, text)
+
+
+class LRUCache(object):
+    """Bounded, thread-safe LRU cache with optional time-to-live.
+
+    Values are deep-copied when stored and returned, so callers can modify
+    them freely. Hit and miss counters can be used to size the cache.
+
+    Every eviction increases a generation counter. A value loaded by `get`
+    is not stored if anything was evicted during loading, as it may have been
+    loaded before the change that caused the eviction.
+
+    Args:
+        maxsize (int): Maximum number of entries. 0 disables the cache.
+        ttl (timedelta): Maximum age of an entry. None means no expiry.
+        copy (bool): Set to False to store and return values as they are,
+            e.g. for immutable or expensive to copy objects.
+    """
+
+    def __init__(self, maxsize, ttl=None, copy=True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._copy = deepcopy if copy else (lambda value: value)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, valid_until)
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self, key, load):
+        """Return the cached value for key, call `load(key)` on a miss."""
+        if not self.maxsize:
+            return load(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or
+                                      entry[1] > dt.utcnow()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._copy(entry[0])
+            self.misses += 1
+            generation = self._generation
+
+        value = load(key)
+        self.put(key, value, generation)
+        return self._copy(value)
+
+    def put(self, key, value, generation=None):
+        """Store a value, replacing any previous entry.
+
+        If `generation` is given, the value is only stored if nothing has
+        been evicted since.
+        """
+        if not self.maxsize:
+            return
+
+        valid_until = dt.utcnow() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (self._copy(value), valid_until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def update(self, key, func):
+        """Modify the cached value of key in place with `func(value)`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                func(entry[0])
+
+    def evict(self, key):
+        """Remove a key."""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+
+    def evict_where(self, predicate):
+        """Remove all entries for which `predicate(key, value)` is true."""
+        with self._lock:
+            self._generation += 1
+            for key, (value, _) in list(self._entries.items()):
+                if predicate(key, value):
+                    del self._entries[key]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Return the counters and current size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+
+def get_version(name):
+    """Read a version counter shared by all processes.
+
+    Counters are stored in the `config` collection with the name as `_id`.
+    Processes increase them with `increment_version` to notify others about
+    changes, e.g. to invalidate their caches.
+    """
+    result = app.data.driver.db['config'].find_one({'_id': name})
+    return result[name] if result else 0
+
+
+def increment_version(name):
+    """Increase a version counter (see `get_version`) and return it."""
+    def increment():
+        return app.data.driver.db['config'].find_one_and_update(
+            {'_id': name}, {'$inc': {name: 1}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+
+    try:
+        result = increment()
+    except DuplicateKeyError:
+        # Another process created the counter at the same time, now it exists
+        result = increment()
+    return result[name]
+
+
+def get_embedded_fields(resource):
+    """Get all fields of a resource which may contain embedded objects.
+
+    The map is computed in `register_domain`, resources registered otherwise
+    are added on first use.
+
+    Returns:
+        dict: Name of the related resource for every field.
+    """
+    embedded_fields = app.config.setdefault('embedded_fields', {})
+    if resource not in embedded_fields:
+        embedded_fields[resource] = _find_embedded_fields(
+            app.config['DOMAIN'][resource]['schema'])
+    return embedded_fields[resource]
+
+
+def _find_embedded_fields(schema):
+    return {field: field_schema['data_relation']['resource']
+            for field, field_schema in schema.items()
+            if 'data_relation' in field_schema}
 
 
 def run_embedded_hooks_fetched_item(resource, item):
@@ -130,14 +260,7 @@ def run_embedded_hooks_fetched_item(resource, item):
         resource: Name of the resource of the main request.
         item: Object including embedded objects.
     """
-    # Find schema for all embedded fields
-    schema = app.config['DOMAIN'][resource]['schema']
-    embedded_fields = {field: field_schema
-                       for field, field_schema in schema.items()
-                       if 'data_relation' in field_schema}
-
-    for field, field_schema in embedded_fields.items():
-        rel_resource = field_schema['data_relation']['resource']
+    for field, rel_resource in get_embedded_fields(resource).items():
         # Call hooks on every embedded item in the response
         if field in item and isinstance(item[field], dict):
             getattr(app, "on_fetched_item")(rel_resource, item[field])
@@ -148,12 +271,28 @@ def run_embedded_hooks_fetched_resource(resource, response):
     """Run fetched hooks on embedded resources. Eve doesn't execute hooks
     for those and we depend on it for auth and filtering of hidden fields.
 
+    The embedded objects of all items are grouped by resource, and the
+    fetched_resource hooks are called once for each group.
+
     Args:
         resource: Name of the resource of the main request.
         items: Objects including embedded objects.
     """
-    for item in response['_items']:
-        run_embedded_hooks_fetched_item(resource, item)
+    embedded = {}
+    for field, rel_resource in get_embedded_fields(resource).items():
+        for item in response['_items']:
+            if field in item and isinstance(item[field], dict):
+                # Objects embedded multiple times may be the same dict,
+                # which must not be processed twice
+                embedded.setdefault(rel_resource, {}).setdefault(
+                    id(item[field]), item[field])
+
+    for rel_resource, objects in embedded.items():
+        # Embedded objects have no links, so the response has none as well
+        embedded_response = {'_items': list(objects.values())}
+        getattr(app, "on_fetched_resource")(rel_resource, embedded_response)
+        getattr(app, "on_fetched_resource_%s" % rel_resource)(
+            embedded_response)
 
 
 def register_domain(app, domain):
@@ -180,6 +319,10 @@ def register_domain(app, domain):
         app.register_resource(resource, settings)
         _better_schema_defaults(app, resource, settings)
 
+        # Precompute fields to run hooks on embedded objects
+        app.config.setdefault('embedded_fields', {})[resource] = \
+            _find_embedded_fields(app.config['DOMAIN'][resource]['schema'])
+
 
 def _better_schema_defaults(app, resource, resource_domain):
     """Use better schema defaults than Eve.
@@ -280,32 +423,45 @@ def register_validator(app, validator_class):
                          {})
 
 
-def on_post_hook(func):
-    """Wrapper for an Eve `on_post_METHOD_resource` hook.
+class JSONRenderer(eve.render.JSONRenderer):
+    """JSON renderer calling `on_render` hooks before serializing.
 
-    The hook receives only a flask response object, which is difficult to
-    manipulate.
-    This wrapper extracts the data as dict and set the data again after the
-    wrapped function has manipulated it.
-    The function is only called for successful requests, otherwise there
-    is no payload.
+    Eve's `on_post_METHOD` hooks only receive the rendered flask response,
+    which would have to be parsed and serialized again for every hook.
+    Instead, hooks can modify the payload before it is rendered:
 
-    The wrapped function can look like this:
+        app.on_render_GET += my_hook
+        app.on_render_PATCH_users += my_resource_hook
 
-        my_hook(payload):
+    and look like this:
+
+        my_hook(resource, request, payload):
             ...
 
     or, for hooks that don't specify the resource:
 
-        my_hook(payload):
+        my_resource_hook(request, payload):
             ...
+
+    The hooks are only called for successful requests with a dict payload,
+    otherwise there is nothing to modify. The resource is None for endpoints
+    like home.
     """
-    @wraps(func)
-    def wrapped(*args):
-        """This is the hook eve will see."""
-        response = args[-1]
-        if response.status_code in range(200, 300):
-            payload = json.loads(response.get_data(as_text=True))
-            func(*args, payload)
-            response.set_data(json.dumps(payload))
-    return wrapped
+
+    def render(self, data):
+        """Call the hooks and serialize the payload once."""
+        method = request.method
+        if (method in ('GET', 'POST', 'PATCH', 'PUT', 'DELETE') and
+                isinstance(data, dict) and data and
+                data.get('_status') != 'ERR'):
+            endpoint = request.endpoint or ''
+            resource = endpoint.split('|')[0] if '|' in endpoint else None
+
+            # general hook
+            getattr(app, 'on_render_' + method)(resource, request, data)
+            if resource:
+                # resource hook
+                getattr(app, 'on_render_%s_%s' % (method, resource))(
+                    request, data)
+
+        return super().render(data)
@@ -11,6 +11,7 @@ from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import BytesIO
 from itertools import count
+import json
 import random
 import requests
 import statistics
@@ -107,11 +108,12 @@ def create_event():
     return post(BASE_URL + '/events', json=data, auth=(ROOT_PW, '')).json()
 
 
-def create_studydoc():
+def create_studydoc(**fields):
     data = {
         'author': 'einstein',
         'name': 'doc%i' % next(counter)
     }
+    data.update(fields)
     files = {'files': ('test.txt', BytesIO(b'A' * 10000))}
     return post(BASE_URL + '/studydocuments', data=data,
                 files=files, auth=(ROOT_PW, '')).json()
@@ -183,6 +185,217 @@ def do_random_all():
         traceback.print_exc()
 
 
+def login_burst(n_logins, n_requests):
+    """ Measure GET latency while n_logins logins happen at the same time.
+
+    Returns:
+        Tuple of login times and request times (seconds).
+    """
+    def login():
+        user = random.choice(SESSIONS)
+        get_token(user['id'], 'pass')
+
+    with ThreadPoolExecutor(max_workers=n_logins + 10) as executor:
+        logins = [executor.submit(time_func, login) for _ in range(n_logins)]
+        requests = []
+        for _ in range(n_requests // 10):
+            batch = [executor.submit(time_func, get_events)
+                     for _ in range(10)]
+            requests.extend(future.result() for future in batch)
+
+        return [future.result() for future in logins], requests
+
+
+def login_test():
+    """ Compare GET latency with and without a concurrent burst of logins.
+    Use the config `PASSWORD_HASH_WORKERS` on the server to compare hashing
+    on the request thread to hashing in worker processes. """
+    print("Measuring request latency during login bursts...")
+    print("%30s|%10s|%10s|%10s" % ("Description", "GET mean", "GET max",
+                                   "Login/s"))
+    print("-"*63)
+    for n_logins in [0, 50, 200]:
+        start = time()
+        login_times, get_times = login_burst(n_logins, 200)
+        elapsed = time() - start
+        print("%30s|%10.3f|%10.3f|%10.1f" % (
+            "%i concurrent logins" % n_logins,
+            statistics.mean(get_times), max(get_times),
+            len(login_times) / elapsed))
+
+
+def event_list_test():
+    """ Measure the time to list pages of 25, 100 and 500 events with
+    signups. The server must allow pages of this size, i.e. set
+    `PAGINATION_LIMIT = 500` in its config. Run against two versions of the
+    API to compare them. """
+    print("Creating events with signups...")
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        events = list(executor.map(lambda _: create_event(), range(500)))
+
+        def signup(event):
+            for user in random.sample(SESSIONS, 5):
+                post(BASE_URL + '/eventsignups',
+                     data={'user': user['id'], 'event': event['_id']},
+                     auth=(ROOT_PW, ''))
+        list(executor.map(signup, events))
+
+    print("%30s|%10s|%10s" % ("Description", "Mean time", "Stdev"))
+    print("-"*52)
+    for page_size in [25, 100, 500]:
+        url = BASE_URL + '/events?max_results=%i' % page_size
+        times = [time_func(lambda: get(url)) for _ in range(20)]
+        print("%30s|%10.3f|%10.3f" % ("%i events per page" % page_size,
+                                      statistics.mean(times),
+                                      statistics.stdev(times)))
+
+
+def user_list_test():
+    """ Measure the time to list pages of 25, 100 and 500 users, for admins
+    and for users, who only see some fields of others. The server must allow
+    pages of this size, i.e. set `PAGINATION_LIMIT = 500` in its config. Run
+    against two versions of the API to compare them. """
+    print("Creating more users...")
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        list(executor.map(lambda _: create_user(), range(400)))
+
+    print("%30s|%10s|%10s" % ("Description", "Mean time", "Stdev"))
+    print("-"*52)
+    for description, token in [("admin", ROOT_PW),
+                               ("user", SESSIONS[0]['token'])]:
+        for page_size in [25, 100, 500]:
+            url = BASE_URL + '/users?max_results=%i' % page_size
+            times = [time_func(lambda: get(url, auth=(token, '')))
+                     for _ in range(20)]
+            print("%30s|%10.3f|%10.3f" % (
+                "%i users per page (%s)" % (page_size, description),
+                statistics.mean(times), statistics.stdev(times)))
+
+
+def signup_validation_test():
+    """ Measure the throughput of signups to events with `additional_fields`.
+    Every user signs up for every event, so the JSON schema of the event is
+    validated for each signup. Run the server with
+    `SIGNUP_VALIDATOR_CACHE_SIZE = 0` to compare with uncached validation. """
+    schema = {
+        '$schema': 'http://json-schema.org/draft-04/schema#',
+        'type': 'object',
+        'additionalProperties': False,
+        'properties': {
+            'food': {'type': 'string',
+                     'enum': ['vegi', 'vegan', 'omnivore']},
+            'sbb_abo': {'type': 'string',
+                        'enum': ['none', 'GA', 'halbtax', 'gleis7']},
+            'comment': {'type': 'string', 'maxLength': 200},
+        },
+        'required': ['food', 'sbb_abo'],
+    }
+
+    print("Creating events with additional fields...")
+    events = []
+    for _ in range(10):
+        event = create_event()
+        req_session.patch(BASE_URL + '/events/%s' % event['_id'],
+                          json={'additional_fields': json.dumps(schema)},
+                          headers={'If-Match': event['_etag']},
+                          auth=(ROOT_PW, ''))
+        events.append(event)
+
+    def signup(event):
+        for user in SESSIONS:
+            data = {
+                'user': user['id'],
+                'event': event['_id'],
+                'additional_fields': json.dumps({
+                    'food': random.choice(['vegi', 'vegan', 'omnivore']),
+                    'sbb_abo': random.choice(['none', 'GA', 'halbtax']),
+                }),
+            }
+            post(BASE_URL + '/eventsignups', data=data, auth=(ROOT_PW, ''))
+
+    print("Signing up every user for every event...")
+    with ThreadPoolExecutor(max_workers=len(events)) as executor:
+        start = time()
+        list(executor.map(signup, events))
+        elapsed = time() - start
+
+    n_signups = len(events) * len(SESSIONS)
+    print("%i signups in %.2f s (%.1f signups/s)" % (
+        n_signups, elapsed, n_signups / elapsed))
+
+
+def cascade_delete_test():
+    """ Measure the time to delete a user with 10000 sessions, which are
+    deleted by the cascade. Run against two versions of the API to compare
+    them. """
+    user_id = create_user()
+    print("Creating 10000 sessions for one user...")
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        list(executor.map(lambda _: get_token(user_id, 'pass'), range(10000)))
+
+    user = get(BASE_URL + '/users/%s' % user_id, auth=(ROOT_PW, '')).json()
+    start = time()
+    req_session.delete(BASE_URL + '/users/%s' % user_id,
+                       headers={'If-Match': user['_etag']},
+                       auth=(ROOT_PW, ''))
+    print("Deleted user with 10000 sessions in %.2f s" % (time() - start))
+
+
+def studydoc_summary_test():
+    """ Measure the time to list studydocs with the summary of 100000
+    documents, with and without filter. Run against two versions of the API to
+    compare them. """
+    def create(_):
+        create_studydoc(
+            author='author%i' % random.randrange(100),
+            lecture='lecture%i' % random.randrange(200),
+            professor='professor%i' % random.randrange(50),
+            department=random.choice(['itet', 'mavt']),
+            semester=random.choice(['1', '2', '3', '4', '5+']),
+            type=random.choice(['exams', 'cheat sheets', 'exercises']),
+            course_year=random.randint(2000, 2020))
+
+    print("Creating 100000 studydocs...")
+    with ThreadPoolExecutor(max_workers=50) as executor:
+        list(executor.map(create, range(100000)))
+
+    print("%30s|%10s|%10s" % ("Description", "Mean time", "Stdev"))
+    print("-"*52)
+    for description, where in [("all documents", None),
+                               ("filtered", {'department': 'itet',
+                                             'semester': '1'})]:
+        url = BASE_URL + '/studydocuments?max_results=1'
+        if where is not None:
+            url += '&where=' + json.dumps(where)
+        times = [time_func(lambda: get(url, auth=(ROOT_PW, '')))
+                 for _ in range(20)]
+        print("%30s|%10.3f|%10.3f" % (
+            "summary of %s" % description,
+            statistics.mean(times), statistics.stdev(times)))
+
+
+def studydoc_search_test():
+    """ Measure the time to find studydocs with the full-text search compared
+    to regex filters on title, lecture and professor, which can't use an
+    index. Run the SUMMARY test first to create enough documents. """
+    print("%30s|%10s|%10s" % ("Description", "Mean time", "Stdev"))
+    print("-"*52)
+
+    term = 'lecture%i' % random.randrange(200)
+    regex = {'$regex': term, '$options': 'i'}
+    where = {'$or': [{field: regex}
+                     for field in ('title', 'lecture', 'professor')]}
+    for description, query in [
+            ("regex", 'where=' + json.dumps(where)),
+            ("search", 'search=' + term)]:
+        url = BASE_URL + '/studydocuments?' + query
+        times = [time_func(lambda: get(url, auth=(ROOT_PW, '')))
+                 for _ in range(20)]
+        print("%30s|%10.3f|%10.3f" % (
+            "%s for a lecture" % description,
+            statistics.mean(times), statistics.stdev(times)))
+
+
 def time_func(func):
     """ Run the supplied function and return the time taken in seconds """
     start = time()
@@ -217,7 +430,8 @@ if len(argv) < 3:
     print("Usage: %s <API URL> <root password> [test type] [debug]" % argv[0])
     print("")
     print("Arguments:")
-    print("test type: GET or ALL")
+    print("test type: GET, ALL, LOGIN, EVENTLIST, USERLIST, SIGNUP, "
+          "CASCADE, SUMMARY or SEARCH")
     print("debug: True or False")
     exit(1)
 
@@ -230,6 +444,20 @@ if len(argv) > 3:
         TEST_FUNC = do_random_get
     elif argv[3] == 'ALL':
         TEST_FUNC = do_random_all
+    elif argv[3] == 'LOGIN':
+        TEST_FUNC = login_test
+    elif argv[3] == 'EVENTLIST':
+        TEST_FUNC = event_list_test
+    elif argv[3] == 'USERLIST':
+        TEST_FUNC = user_list_test
+    elif argv[3] == 'SIGNUP':
+        TEST_FUNC = signup_validation_test
+    elif argv[3] == 'CASCADE':
+        TEST_FUNC = cascade_delete_test
+    elif argv[3] == 'SUMMARY':
+        TEST_FUNC = studydoc_summary_test
+    elif argv[3] == 'SEARCH':
+        TEST_FUNC = studydoc_search_test
     else:
         print("Error: Invalid test type %s" % argv[3])
         exit(1)
@@ -255,6 +483,12 @@ EVENTS = [create_event() for _ in range(100)]
 print("Creating some studydocs...")
 STUDYDOCS = [create_studydoc() for _ in range(100)]
 
+if TEST_FUNC in (login_test, event_list_test, user_list_test,
+                 signup_validation_test, cascade_delete_test,
+                 studydoc_summary_test, studydoc_search_test):
+    TEST_FUNC()
+    exit(0)
+
 times_desc = []
 times_mean = []
 times_stdev = []